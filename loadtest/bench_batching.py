@@ -0,0 +1,79 @@
+"""Benchmark of the batched item submissions: the submission queue sends submissions to the fake item
+API one by one and in gzip-compressed batches, at a steady rate and in a burst, and the number of
+requests and the latency from `put` until the answer are reported.
+
+    python loadtest/bench_batching.py --latency 0.05 --rate 1000 --seconds 30 --burst 1000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from fake_apis import FakeItemAPI
+from run import ROOT, percentile
+
+sys.path.insert(0, os.path.join(ROOT, "src"))
+from submission_client import SubmissionClient
+from submission_queue import SubmissionQueue
+
+PAYLOAD = {"content": "Loadtest Nachricht " + "x" * 300, "contact": "family", "frequency": "2", "channel": "Telegram"}
+
+
+def run(batched, latency, submissions, rate=None, timeout=600):
+    """Puts `submissions` (at `rate` per second, or all at once) and waits for their answers. Returns
+    (seconds in all, latencies, requests by path)."""
+    api = FakeItemAPI(latency=latency).start()
+    client = SubmissionClient(api.url)
+    put_at, answered_at = {}, {}
+    all_answered = threading.Event()
+
+    def on_result(key, submission, response):
+        answered_at[key] = time.perf_counter()
+        if len(answered_at) == submissions:
+            all_answered.set()
+
+    with tempfile.TemporaryDirectory(prefix="loadtest") as workdir:
+        queue = SubmissionQueue(os.path.join(workdir, "submission_queue.db"), client, on_result=on_result,
+                                batch_endpoint="/item_submissions" if batched else None,
+                                batch_size=100 if batched else 20, batch_window=0.5)
+        queue.start()
+        try:
+            start = time.perf_counter()
+            for i in range(submissions):
+                if rate:
+                    time.sleep(max(0, start + i / rate - time.perf_counter()))
+                put_at[queue.put(PAYLOAD)] = time.perf_counter()
+            if not all_answered.wait(timeout):
+                raise RuntimeError("Only {} of {} submissions were answered".format(len(answered_at), submissions))
+            seconds = max(answered_at.values()) - start
+        finally:
+            queue.stop()
+            client.close()
+            api.stop()
+    return seconds, [answered_at[key] - put_at[key] for key in put_at], dict(api.requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per item API request")
+    parser.add_argument("--rate", type=float, default=1000, help="Submissions per minute of the steady runs")
+    parser.add_argument("--seconds", type=float, default=30, help="Duration of the steady runs")
+    parser.add_argument("--burst", type=int, default=1000, help="Submissions of the burst runs (0 to skip)")
+    args = parser.parse_args()
+
+    runs = [("steady", int(args.rate / 60 * args.seconds), args.rate / 60)]
+    if args.burst:
+        runs.append(("burst", args.burst, None))
+    print("run     mode    submissions  requests  p50 put->answer  p99 put->answer  seconds")
+    for name, submissions, rate in runs:
+        for batched in (False, True):
+            seconds, latencies, requests = run(batched, args.latency, submissions, rate)
+            print("{:<7} {:<7} {:11d} {:9d} {:14.0f}ms {:14.0f}ms {:8.1f}".format(
+                name, "batch" if batched else "single", submissions, sum(requests.values()),
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, seconds))
+
+
+if __name__ == '__main__':
+    main()
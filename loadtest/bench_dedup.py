@@ -0,0 +1,82 @@
+"""Benchmark of the duplicate index: build time, memory and lookups (hit rate and latency) of exact
+duplicates, near duplicates and unrelated texts in an index of random 30-word texts.
+
+    python loadtest/bench_dedup.py --items 1000000
+"""
+import argparse
+import gc
+import os
+import random
+import resource
+import sys
+import time
+
+from run import ROOT, percentile
+
+sys.path.insert(0, os.path.join(ROOT, "src"))
+from dedup import DuplicateIndex
+
+VOCABULARY = ["wort{}".format(i) for i in range(20000)]
+
+
+def random_text(words=30):
+    return " ".join(random.choices(VOCABULARY, k=words))
+
+
+def changed(text, words=1):
+    """The text with `words` random words replaced, other punctuation, partly upper case and an emoji."""
+    words_of_text = text.split()
+    for _ in range(words):
+        words_of_text[random.randrange(len(words_of_text))] = random.choice(VOCABULARY)
+    return ", ".join(words_of_text[:10]) + "!!! " + " ".join(words_of_text[10:]).upper() + " 😱"
+
+
+def lookups(index, texts):
+    """(Hits, latencies in seconds) of looking up the texts."""
+    hits, latencies = 0, []
+    for text in texts:
+        start = time.perf_counter()
+        hits += index.find(text) is not None
+        latencies.append(time.perf_counter() - start)
+    return hits, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", type=int, default=100000, help="Texts in the index")
+    parser.add_argument("--lookups", type=int, default=1000, help="Lookups per kind")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the random texts")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    index = DuplicateIndex(max_items=args.items)
+    samples = []
+    every = max(1, args.items // args.lookups)
+    start = time.perf_counter()
+    for i in range(args.items):
+        text = random_text()
+        if i % every == 0:
+            samples.append(text)
+        index.add(text, i)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("{} texts indexed in {:.1f}s ({:.0f}us per text), max RSS +{:.0f} MB".format(
+        len(index), seconds, seconds / args.items * 1e6, (rss_after - rss_before) / 1024))
+
+    kinds = [
+        ("exact (case, punctuation)", [text.upper() + " !!" for text in samples]),
+        ("near, 1 word changed", [changed(text) for text in samples]),
+        ("near, 3 words changed", [changed(text, 3) for text in samples]),
+        ("near, 6 words appended", [text + " bitte teilen an alle kontakte weiterleiten" for text in samples]),
+        ("unrelated", [random_text() for _ in samples]),
+    ]
+    for name, texts in kinds:
+        hits, latencies = lookups(index, texts)
+        print("{:<26} found {:5.1f}%  p50 {:5.0f}us  p99 {:5.0f}us".format(
+            name, hits * 100 / len(texts), percentile(latencies, 50) * 1e6, percentile(latencies, 99) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Benchmark of concurrent conversations with the "scheduled" and "asyncio" typing modes: users walk
+through every path of the conversation at once against a slow fake Bot API, and the throughput and
+the latency per step are reported for every mode and number of users.
+
+In the "scheduled" mode a handler holds a thread of the handler pool while it waits for its
+messages to be sent; in the "asyncio" mode the handler coroutines wait on one event loop.
+
+    python loadtest/bench_flow.py --users 200 1000 --bot-api-latency 0.05
+"""
+import argparse
+
+from run import run_load, running_bot
+from scenarios import all_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[200], help="Numbers of concurrent users")
+    parser.add_argument("--modes", nargs="+", default=["scheduled", "asyncio"], help="TYPING_MODEs to run")
+    parser.add_argument("--typing-seconds", type=float, default=0.75, help="TYPING_SECONDS of the bot")
+    parser.add_argument("--bot-api-latency", type=float, default=0.05, help="Seconds per Bot API request")
+    parser.add_argument("--senders", type=int, default=32, help="OUTBOUND_SENDERS of the bot")
+    parser.add_argument("--handler-workers", type=int, default=8, help="HANDLER_WORKERS of the bot")
+    parser.add_argument("--think-time", type=float, default=0.3, help="Seconds between answer and next step")
+    parser.add_argument("--step-timeout", type=float, default=120, help="Seconds after which a user is given up")
+    args = parser.parse_args()
+
+    paths = all_paths()
+    print("mode        users  finished  updates/s  step p50  step p99")
+    for mode in args.modes:
+        env = {"TYPING_MODE": mode, "TYPING_SECONDS": str(args.typing_seconds), "PERSISTENCE": "none",
+               "OUTBOUND_SENDERS": str(args.senders), "HANDLER_WORKERS": str(args.handler_workers)}
+        for users in args.users:
+            with running_bot(env, bot_api_latency=args.bot_api_latency) as (bot, bot_api, item_api):
+                load = run_load(bot_api, paths, users, 10 ** 6, args.step_timeout, args.think_time)
+            print("{:<10} {:6d} {:9d} {:10.0f} {:7.0f}ms {:7.0f}ms".format(
+                mode, users, load["finished"], load["updates_per_second"], load["step_p50_ms"], load["step_p99_ms"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Benchmark of the memory per open conversation: parks users in the middle of the conversation
+(everything but the last two answers given), reports the growth of the bot's RSS per conversation,
+then waits until the idle conversations have been ended (CONVERSATION_IDLE_TIMEOUT) and reports the
+conversations that are still open.
+
+    python loadtest/bench_memory.py --park 2000 10000 --idle-timeout 60
+"""
+import argparse
+import socket
+import time
+import urllib.request
+
+from run import run_memory, running_bot, wait_for
+from scenarios import all_paths
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def open_conversations(port):
+    """Sum of the bot_open_conversations gauge of all personas."""
+    with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(port)) as response:
+        lines = response.read().decode().splitlines()
+    return sum(float(line.rsplit(" ", 1)[1]) for line in lines if line.startswith("bot_open_conversations{"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--park", type=int, nargs="+", default=[2000], help="Numbers of parked conversations")
+    parser.add_argument("--idle-timeout", type=float, default=60, help="CONVERSATION_IDLE_TIMEOUT of the bot")
+    parser.add_argument("--think-time", type=float, default=0.3, help="Seconds between answer and next step")
+    parser.add_argument("--step-timeout", type=float, default=120, help="Seconds after which a user is given up")
+    args = parser.parse_args()
+
+    paths = all_paths()
+    print("parked  RSS before  RSS after  bytes/conversation  open  open after the idle timeout")
+    for parked in args.park:
+        port = free_port()
+        env = {"TYPING_SECONDS": "0", "PERSISTENCE": "none", "METRICS_PORT": str(port),
+               "CONVERSATION_IDLE_TIMEOUT": str(args.idle_timeout), "CONVERSATION_SWEEP_INTERVAL": "1"}
+        with running_bot(env) as (bot, bot_api, item_api):
+            start = time.monotonic()
+            memory = run_memory(bot_api, bot, paths, parked, 10 ** 6, args.step_timeout, args.think_time)
+            # Only the parked conversations are open (the ones of the startup check ended)
+            before_timeout = open_conversations(port)
+            wait_for(lambda: open_conversations(port) == 0,
+                     max(0, start + args.idle_timeout - time.monotonic()) + args.step_timeout)
+            print("{:6d} {:8.1f} MB {:7.1f} MB {:19.0f} {:5.0f} {:28.0f}".format(
+                memory["conversations"], memory["rss_before_mb"], memory["rss_after_mb"],
+                memory["bytes_per_conversation"], before_timeout, open_conversations(port)))
+
+
+if __name__ == '__main__':
+    main()
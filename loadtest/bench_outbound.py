@@ -0,0 +1,139 @@
+"""Benchmark of the outbound scheduler against the fake Bot API with Telegram's flood limits (429 above
+30 calls/s or above 1 call/s per chat with bursts of 3).
+
+Every chat sends at once: a typing action, two replies, the answer to a callback query, two more
+typing actions (merged by the scheduler) and a third reply. "direct" makes the calls from a thread
+pool without any limits, as the handlers used to; calls answered with 429 are lost. "scheduler"
+sends them through the `OutboundScheduler`, which also keeps the replies of a chat in order.
+
+    python loadtest/bench_outbound.py --chats 150 --latency 0.05
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_apis import FakeBotAPI
+from run import ROOT, percentile
+
+sys.path.insert(0, os.path.join(ROOT, "src"))
+from outbound import OutboundScheduler
+from telegram import Bot, ChatAction
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+
+
+def operations(chat_id):
+    return [("action",), ("message", "a"), ("message", "b"), ("callback", "{}-1".format(chat_id)), ("action",),
+            ("action",), ("message", "c")]
+
+
+class Results:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.message_latencies = []
+        self.callback_latencies = []
+        self.replies = defaultdict(list)
+        self.lost = 0
+
+    def sent(self, chat_id, operation, error=None):
+        if error is not None:
+            self.lost += 1
+        elif operation[0] == "message":
+            self.message_latencies.append(time.perf_counter() - self.start)
+            self.replies[chat_id].append(operation[1])
+        elif operation[0] == "callback":
+            self.callback_latencies.append(time.perf_counter() - self.start)
+
+    def report(self, name, api):
+        seconds = time.perf_counter() - self.start
+        out_of_order = sum(replies != sorted(replies) for replies in self.replies.values())
+        print("{:<10} {:5.1f}s  {:4d} 429s  {:4d} lost  {:4d} out of order  message p50 {:5.2f}s p99 {:5.2f}s  "
+              "callback answer p50 {:5.2f}s p99 {:5.2f}s".format(
+                  name, seconds, api.calls["429"], self.lost, out_of_order,
+                  percentile(self.message_latencies, 50) or 0, percentile(self.message_latencies, 99) or 0,
+                  percentile(self.callback_latencies, 50) or 0, percentile(self.callback_latencies, 99) or 0))
+
+
+def make_bot(api, connections):
+    return Bot("123456:loadtest", base_url=api.url + "/bot", request=Request(con_pool_size=connections))
+
+
+def direct(api, chats, threads):
+    bot = make_bot(api, threads)
+    results = Results()
+
+    def run(chat_id):
+        for operation in operations(chat_id):
+            try:
+                if operation[0] == "action":
+                    bot.send_chat_action(chat_id, ChatAction.TYPING)
+                elif operation[0] == "callback":
+                    bot.answer_callback_query(operation[1])
+                else:
+                    bot.send_message(chat_id, operation[1])
+            except RetryAfter as e:
+                results.sent(chat_id, operation, e)
+            else:
+                results.sent(chat_id, operation)
+
+    with ThreadPoolExecutor(threads) as executor:
+        for chat_id in range(1, chats + 1):
+            executor.submit(run, chat_id)
+    return results
+
+
+def scheduled(api, chats, senders, global_rate, chat_rate):
+    bot = make_bot(api, senders)
+    scheduler = OutboundScheduler(senders=senders, global_rate=global_rate, chat_rate=chat_rate)
+    scheduler.start()
+    results = Results()
+    futures = []
+    for chat_id in range(1, chats + 1):
+        for operation in operations(chat_id):
+            if operation[0] == "action":
+                future = scheduler.send_chat_action(bot, chat_id, ChatAction.TYPING)
+            elif operation[0] == "callback":
+                future = scheduler.answer_callback_query(bot, chat_id, operation[1])
+            else:
+                future = scheduler.send_message(bot, chat_id, operation[1])
+            future.add_done_callback(
+                lambda future, chat_id=chat_id, operation=operation: results.sent(chat_id, operation, future.exception()))
+            futures.append(future)
+    for future in futures:
+        future.exception()
+    scheduler.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--chats", type=int, default=150, help="Chats that send at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per Bot API request")
+    parser.add_argument("--threads", type=int, default=8, help="Threads of the direct calls")
+    parser.add_argument("--senders", type=int, default=4, help="Sender threads of the scheduler")
+    parser.add_argument("--global-rate", type=float, default=28, help="Global rate of the scheduler")
+    parser.add_argument("--chat-rate", type=float, default=0.95, help="Rate per chat of the scheduler")
+    parser.add_argument("--runs", nargs="+", default=["direct", "scheduler"], help="Runs: direct, scheduler")
+    args = parser.parse_args()
+    # The scheduler logs every 429
+    logging.basicConfig(level=logging.ERROR)
+
+    for name in args.runs:
+        api = FakeBotAPI(latency=args.latency, flood_limits=True).start()
+        try:
+            if name == "direct":
+                results = direct(api, args.chats, args.threads)
+            else:
+                results = scheduled(api, args.chats, args.senders, args.global_rate, args.chat_rate)
+            results.report(name, api)
+        finally:
+            api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Microbenchmark of the callback query routing: time to find the handler of a button with one
+regex `CallbackQueryHandler` per button (checked in order, as the conversation states used to be
+registered) and with the routing table of the menu (`routing.CallbackRouteHandler`, one dict lookup).
+
+    python loadtest/bench_routing.py --menu CHANNEL_MENU
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+from run import ROOT
+
+# The bot creates its state files in the working directory when it is imported
+os.chdir(tempfile.mkdtemp(prefix="loadtest"))
+os.environ.setdefault("STAGE", "loadtest")
+os.environ.setdefault("METRICS_PORT", "0")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+import telegram_bot
+from telegram import Update
+from telegram.ext import CallbackQueryHandler
+
+
+def callback_update(data):
+    user = {"id": 1, "is_bot": False, "first_name": "Load"}
+    return Update.de_json({"update_id": 1, "callback_query": {
+        "id": "1", "from": user, "chat_instance": "1", "data": data,
+        "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "..."}}}, None)
+
+
+def seconds_per_call(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--menu", default="CHANNEL_MENU", help="Menu of src/telegram_bot.py")
+    parser.add_argument("--number", type=int, default=20000, help="Lookups per measurement")
+    args = parser.parse_args()
+
+    menu = getattr(telegram_bot, args.menu)
+    regex_handlers = [CallbackQueryHandler(callback, pattern="^{}$".format(re.escape(data)))
+                      for data, callback in menu.routes.items()]
+    route_handler = menu.handler()
+
+    def regex_lookup():
+        for handler in regex_handlers:
+            if handler.check_update(update):
+                return handler
+
+    print("{} with {} buttons".format(args.menu, len(regex_handlers)))
+    for data in (list(menu.routes)[0], list(menu.routes)[-1]):
+        update = callback_update(data)
+        print("  {:<16} regex handlers {:6.2f}us  routing table {:6.2f}us".format(
+            repr(data), seconds_per_call(regex_lookup, args.number) * 1e6,
+            seconds_per_call(lambda: route_handler.check_update(update), args.number) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
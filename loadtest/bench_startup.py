@@ -0,0 +1,87 @@
+"""Benchmark of the startup: median time to import the bot in a new interpreter, as it is (boto3 is
+only imported when a secret is read from the Secrets Manager) and with boto3 imported up front (as
+it used to be), the time to create a Secrets Manager client (which used to happen for every token
+fetch) and the time until the bot answers its first update.
+
+    python loadtest/bench_startup.py --runs 9
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_apis import FakeBotAPI, FakeItemAPI
+from run import ROOT, Bot
+from scenarios import START, User
+
+IMPORT_BOT = """
+import time
+start = time.perf_counter()
+{}
+import telegram_bot
+print(time.perf_counter() - start)
+"""
+
+CREATE_CLIENT = """
+import time
+import boto3
+start = time.perf_counter()
+boto3.session.Session().client(service_name="secretsmanager", region_name="eu-central-1")
+print(time.perf_counter() - start)
+"""
+
+
+def median_seconds(code, runs):
+    """Median of the seconds the code prints, each run in a new interpreter."""
+    env = dict(os.environ, STAGE="loadtest", SECRET_SOURCE="env", METRICS_PORT="0",
+               PYTHONPATH=os.path.join(ROOT, "src"))
+    seconds = []
+    with tempfile.TemporaryDirectory(prefix="loadtest") as workdir:
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env, check=True,
+                                    stdout=subprocess.PIPE).stdout
+            seconds.append(float(output.decode().split()[-1]))
+    return statistics.median(seconds)
+
+
+def first_reply_seconds(timeout=60):
+    """Seconds from starting the bot process until it has answered an update that was waiting for it."""
+    bot_api, item_api = FakeBotAPI().start(), FakeItemAPI().start()
+    bot_api.push_update(User(10 ** 6, "start", [START]).update(bot_api))
+    try:
+        with tempfile.TemporaryDirectory(prefix="loadtest") as workdir:
+            bot = Bot(bot_api, item_api, workdir, {"TYPING_SECONDS": "0"})
+            start = time.perf_counter()
+            bot.start(bot_api.ready, timeout)
+            try:
+                while not bot_api.calls["sendMessage"]:
+                    if time.perf_counter() - start > timeout:
+                        raise RuntimeError("The bot didn't answer within {}s".format(timeout))
+                    time.sleep(0.005)
+                return time.perf_counter() - start
+            finally:
+                bot.stop()
+    finally:
+        bot_api.stop()
+        item_api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=9, help="Interpreters started per measurement")
+    args = parser.parse_args()
+
+    print("import telegram_bot               {:7.1f}ms".format(
+        median_seconds(IMPORT_BOT.format(""), args.runs) * 1000))
+    print("import boto3, telegram_bot        {:7.1f}ms".format(
+        median_seconds(IMPORT_BOT.format("import boto3"), args.runs) * 1000))
+    print("create a Secrets Manager client   {:7.1f}ms".format(median_seconds(CREATE_CLIENT, args.runs) * 1000))
+    print("first reply after the start       {:7.1f}ms".format(
+        statistics.median(first_reply_seconds() for _ in range(args.runs)) * 1000))
+
+
+if __name__ == '__main__':
+    main()
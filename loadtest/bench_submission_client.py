@@ -0,0 +1,71 @@
+"""Benchmark of the pooled item API client: latency of item submissions against the fake item API
+with one-shot `requests.post` calls (a new connection per request, no retries) and with
+`SubmissionClient` (pooled connections, retries of 5xx responses), and the time `submit` takes on
+the calling thread (the handler).
+
+    python loadtest/bench_submission_client.py --requests 500 --latency 0.005 --error-rate 0.05
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import requests
+
+from fake_apis import FakeItemAPI
+from run import ROOT, percentile
+
+sys.path.insert(0, os.path.join(ROOT, "src"))
+from submission_client import SubmissionClient
+
+PAYLOAD = {"content": "Loadtest Nachricht", "contact": "family", "frequency": "2", "channel": "Telegram"}
+
+
+def timed(call, count):
+    """Latencies (seconds) of `count` calls."""
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, latencies, api):
+    print("{:<28} p50 {:6.1f}ms  p99 {:6.1f}ms  {} requests, {} answered with 503".format(
+        name, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        api.requests["/item_submission"], api.requests["503"]))
+    api.requests.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=500, help="Submissions per run")
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds per item API request")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="Share of requests answered with 503")
+    args = parser.parse_args()
+    # The client logs every retry
+    logging.basicConfig(level=logging.ERROR)
+
+    api = FakeItemAPI(latency=args.latency, error_rate=args.error_rate).start()
+    url = api.url + "/item_submission"
+    client = SubmissionClient(api.url, backoff=0.01)
+    try:
+        report("requests.post (no retries)", timed(lambda: requests.post(url, json=PAYLOAD), args.requests), api)
+        report("SubmissionClient.post", timed(lambda: client.post("/item_submission", PAYLOAD), args.requests), api)
+
+        start = time.perf_counter()
+        futures = [client.submit("/item_submission", PAYLOAD) for _ in range(args.requests)]
+        submitted = time.perf_counter() - start
+        for future in futures:
+            future.result()
+        print("SubmissionClient.submit      {:.3f}ms per call on the calling thread".format(
+            submitted / args.requests * 1000))
+    finally:
+        client.close()
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
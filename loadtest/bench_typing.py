@@ -0,0 +1,46 @@
+"""Benchmark of the typing delay: how many /start updates of distinct users the bot handles per second
+with each TYPING_MODE.
+
+In the "sleep" mode the dispatcher thread sleeps for the typing delay of every update, so the bot
+handles about 1 / TYPING_SECONDS updates per second. The "scheduled" (JobQueue and handler pool) and
+"asyncio" (shared event loop) modes wait for the delay without holding the dispatcher.
+
+    python loadtest/bench_typing.py --users 50 --modes sleep scheduled asyncio
+"""
+import argparse
+import time
+
+from run import running_bot, wait_for
+from scenarios import START, User, replies_expected
+
+
+def run_mode(mode, users, typing_seconds, bot_api_latency, timeout):
+    """Pushes one /start per user at once and returns the seconds until all of them were answered."""
+    env = {"TYPING_MODE": mode, "TYPING_SECONDS": str(typing_seconds), "PERSISTENCE": "none"}
+    with running_bot(env, bot_api_latency=bot_api_latency) as (bot, bot_api, item_api):
+        expected = bot_api.calls["sendMessage"] + users * replies_expected(START)
+        start = time.perf_counter()
+        for i in range(users):
+            bot_api.push_update(User(10 ** 6 + i, "start", [START]).update(bot_api))
+        if not wait_for(lambda: bot_api.calls["sendMessage"] >= expected, timeout):
+            raise RuntimeError("{}: not all updates were answered within {}s".format(mode, timeout))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=50, help="Users that send /start at once")
+    parser.add_argument("--modes", nargs="+", default=["sleep", "scheduled", "asyncio"], help="TYPING_MODEs to run")
+    parser.add_argument("--typing-seconds", type=float, default=0.75, help="TYPING_SECONDS of the bot")
+    parser.add_argument("--bot-api-latency", type=float, default=0, help="Seconds per Bot API request")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds after which a run is given up")
+    args = parser.parse_args()
+
+    print("mode        users  seconds  updates/s")
+    for mode in args.modes:
+        seconds = run_mode(mode, args.users, args.typing_seconds, args.bot_api_latency, args.timeout)
+        print("{:<10} {:6d} {:8.2f} {:10.1f}".format(mode, args.users, seconds, args.users / seconds))
+
+
+if __name__ == '__main__':
+    main()
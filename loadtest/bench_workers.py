@@ -0,0 +1,98 @@
+"""Benchmark of the worker processes: runs the same load with different numbers of WORKERS and reports
+the throughput, the step latencies and the CPU time of the bot's processes per update.
+
+The workers only help while the bot is CPU bound, so the load has no typing delay, and the scaling
+can only show on a machine with at least as many CPUs as workers plus one (the ingress process).
+The CPUs the benchmark may use are printed first. With `--kill` a worker is sent the signal in the
+middle of the run (with 2 or more workers), to see how many conversations finish anyway.
+
+    python loadtest/bench_workers.py --workers 0 1 2 4 --users 1000
+"""
+import argparse
+import os
+import signal
+import threading
+import time
+
+from run import run_load, running_bot
+from scenarios import all_paths
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def processes(pid):
+    """The process and its child processes, recursively (Linux)."""
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    return [pid] + [descendant for child in children for descendant in processes(child)]
+
+
+def cpu_seconds(pid):
+    """User and system CPU time of the process and its child processes that are still running."""
+    seconds = 0
+    for process in processes(pid):
+        try:
+            with open("/proc/{}/stat".format(process)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are the fields 14 and 15 of the stat file, the name (field 2) is cut off
+        seconds += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return seconds
+
+
+def kill_worker(bot, signal_number, delay):
+    """Sends a signal to one of the worker processes after `delay` seconds."""
+    time.sleep(delay)
+    workers = []
+    for process in processes(bot.process.pid)[1:]:
+        try:
+            with open("/proc/{}/cmdline".format(process), "rb") as f:
+                # The spawned workers (unlike e.g. the resource tracker of multiprocessing) run spawn_main
+                if b"spawn_main" in f.read():
+                    workers.append(process)
+        except OSError:
+            continue
+    if workers:
+        print("Sending {} to worker process {}".format(signal.Signals(signal_number).name, workers[-1]))
+        os.kill(workers[-1], signal_number)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2], help="Numbers of WORKERS to run")
+    parser.add_argument("--users", type=int, default=500, help="Users of every run")
+    parser.add_argument("--persistence", default="sqlite", help="PERSISTENCE of the bot")
+    parser.add_argument("--think-time", type=float, default=0.3, help="Seconds between answer and next step")
+    parser.add_argument("--step-timeout", type=float, default=60, help="Seconds after which a user is given up")
+    parser.add_argument("--kill", choices=["SIGTERM", "SIGKILL"], help="Signal sent to a worker during the run")
+    parser.add_argument("--kill-after", type=float, default=4, help="Seconds after which the worker is killed")
+    args = parser.parse_args()
+
+    cpus = len(os.sched_getaffinity(0))
+    print("CPUs available: {} (of {})".format(cpus, os.cpu_count()))
+    if cpus < max(args.workers) + 1:
+        print("Fewer CPUs than worker processes plus ingress, the workers can't run in parallel")
+
+    paths = all_paths()
+    print("workers  finished  updates/s  step p50  step p99  CPU per update")
+    for workers in args.workers:
+        env = {"WORKERS": str(workers), "TYPING_SECONDS": "0", "PERSISTENCE": args.persistence}
+        with running_bot(env) as (bot, bot_api, item_api):
+            if args.kill and workers >= 2:
+                threading.Thread(target=kill_worker, args=(bot, getattr(signal, args.kill), args.kill_after),
+                                 daemon=True).start()
+            cpu_before = cpu_seconds(bot.process.pid)
+            load = run_load(bot_api, paths, args.users, 10 ** 6, args.step_timeout, args.think_time)
+            cpu = cpu_seconds(bot.process.pid) - cpu_before
+        updates = load["updates_per_second"] * load["seconds"]
+        print("{:7d} {:6d}/{:<4d} {:8.0f} {:7.0f}ms {:7.0f}ms {:11.2f}ms".format(
+            workers, load["finished"], args.users, load["updates_per_second"], load["step_p50_ms"],
+            load["step_p99_ms"], cpu / max(1, updates) * 1000))
+
+
+if __name__ == '__main__':
+    main()
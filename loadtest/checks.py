@@ -0,0 +1,266 @@
+"""Checks of cases that the load test (run.py) doesn't reach with its default configuration, each
+against its own bot and fakes. Exits with 1 if a check fails.
+
+- delayed_with_workers: with WORKERS=2 and the admission control delaying every /start, all paths
+  are walked, and the /start commands that are still delayed when the bot stops are handed off.
+- quick_updates: the first two steps of every path are sent at once, the second one while the bot is
+  still typing its answer to the first, and the rest of the path is walked (in both typing modes and
+  with WORKERS=2).
+- redis_persistence: `RedisPersistence` against a fake Redis: user and conversation data are only
+  written by a flush, in one batch per flush, kept after a failed write and read back by a new
+  instance (chat data isn't stored); then the bot walks the paths with PERSISTENCE=redis and
+  conversations parked before a restart of the bot are continued after it.
+- submissions_on_stop: item submissions that are still queued when the bot gets SIGTERM (behind a
+  slow item API, or waiting for a long batch window) are sent before it exits.
+
+    python loadtest/checks.py [delayed_with_workers ...]
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from fake_apis import FakeBotAPI, FakeItemAPI, FakeRedis
+from run import ROOT, Bot, check_paths, running_bot, wait_for
+from scenarios import START, Driver, User, all_paths, expected_submission, replies_expected
+
+sys.path.insert(0, os.path.join(ROOT, "src"))
+from persistence import RedisPersistence
+
+logger = logging.getLogger("loadtest")
+
+
+def handed_off(workdir):
+    """The updates the bot wrote to its HANDOFF_DIR."""
+    updates = []
+    for path in glob.glob(os.path.join(workdir, "handoff", "*.jsonl")):
+        with open(path) as f:
+            updates += [json.loads(line)["update"] for line in f]
+    return updates
+
+
+def delayed_with_workers():
+    """The admission control delays the /start commands (ADMISSION_DELAY_DEPTH below 0), which the
+    worker processes dispatch again themselves. Returns the failures."""
+    failed = []
+    env = {"WORKERS": "2", "TYPING_SECONDS": "0", "PERSISTENCE": "sqlite", "ADMISSION_DELAY_DEPTH": "-1",
+           "ADMISSION_DELAY": "0.5"}
+    with running_bot(env) as (bot, bot_api, item_api):
+        failed += ["path:" + name for name in check_paths(bot_api, item_api, all_paths(), 10 ** 6, 30, 0.3)]
+
+    # Stopped before the delay is due, the ingress process hands the /start commands off
+    env["ADMISSION_DELAY"] = "60"
+    user_ids = range(2 * 10 ** 6, 2 * 10 ** 6 + 20)
+    with running_bot(env) as (bot, bot_api, item_api):
+        for user_id in user_ids:
+            bot_api.push_update(User(user_id, "start", [START]).update(bot_api))
+        wait_for(lambda: not bot_api.pending(), 10)
+        # Routed and delayed by the workers
+        time.sleep(2)
+        bot.stop()
+        updates = handed_off(bot.workdir)
+    missing = set(user_ids) - {update["message"]["chat"]["id"] for update in updates if "message" in update}
+    if missing:
+        logger.error("The delayed /start of %s user(s) wasn't handed off, got %s", len(missing), updates)
+        failed.append("handoff")
+    return failed
+
+
+def quick_updates():
+    """Sends the second step of every path right after the first one, then walks the rest of the
+    path. Returns the failures."""
+    failed = []
+    for env in ({"TYPING_MODE": "asyncio"}, {"TYPING_MODE": "scheduled"}, {"TYPING_MODE": "asyncio", "WORKERS": "2"}):
+        name = "+".join(env.values())
+        env.update(TYPING_SECONDS="0.5", PERSISTENCE="sqlite")
+        with running_bot(env) as (bot, bot_api, item_api):
+            paths = all_paths()
+            users = [User(4 * 10 ** 6 + i, path_name, steps) for i, (path_name, steps) in enumerate(paths.items())]
+            expected = {user.user_id: replies_expected(user.steps[0]) + replies_expected(user.steps[1])
+                        for user in users}
+            replies = Counter()
+            bot_api.on_reply = lambda chat_id, method, data: replies.update([chat_id])
+            for user in users:
+                bot_api.push_update(user.update(bot_api))
+                user.position = 1
+                bot_api.push_update(user.update(bot_api))
+            wait_for(lambda: all(replies[user_id] >= count for user_id, count in expected.items()), 30)
+            answered = [user for user in users if replies[user.user_id] >= expected[user.user_id]]
+            for user in users:
+                if user not in answered:
+                    logger.error("%s: path %s got %s of %s replies to its first two steps", name, user.path_name,
+                                 replies[user.user_id], expected[user.user_id])
+                    failed.append("{}:{}".format(name, user.path_name))
+                user.position = 2
+
+            # The rest of the paths, which only finish if the second step was handled after the first
+            driver = Driver(bot_api, step_timeout=30, think_time=0.1)
+            driver.run([user for user in answered if user.position < len(user.steps)])
+            for user in driver.failed:
+                logger.error("%s: path %s got no answer to step %s", name, user.path_name, user.position)
+                failed.append("{}:{}".format(name, user.path_name))
+            contents = {user.content: expected_submission(user.steps, user.content) for user in answered}
+            wait_for(lambda: {s.get("content") for s in item_api.submissions.values()}
+                     >= {content for content, submission in contents.items() if submission is not None}, 30)
+            received = {s.get("content"): s for s in item_api.submissions.values()}
+            for user in answered:
+                submission = contents[user.content]
+                got = received.get(user.content)
+                if submission is not None and "media" not in submission and got != submission:
+                    logger.error("%s: path %s expected submission %s, got %s", name, user.path_name, submission, got)
+                    failed.append("{}:{}".format(name, user.path_name))
+    return sorted(set(failed))
+
+
+def redis_persistence():
+    """Checks the `RedisPersistence` itself, then the bot with it. Returns the failures."""
+    failed = []
+
+    def check(name, condition, message, *args):
+        if not condition:
+            logger.error("Redis persistence: " + message, *args)
+            failed.append("redis:" + name)
+
+    redis = FakeRedis().start()
+    try:
+        persistence = RedisPersistence(redis.url, prefix="check", flush_interval=0.2)
+        persistence.update_user_data(1, {"persona": "default", "draft": {"content": "Nachricht"}})
+        persistence.update_user_data(1, {"persona": "default", "draft": {"content": "Nachricht 2"}})
+        persistence.update_user_data(2, {"persona": "default"})
+        persistence.update_chat_data(1, {"ignored": True})
+        persistence.update_conversation("submission", (1, 1), 2)
+        persistence.update_conversation("submission", (2, 2), 3)
+        check("batched", not redis.commands, "written before the flush: %s", dict(redis.commands))
+        persistence.flush()
+        check("flush", redis.commands == {"SET": 4}, "one flush of 2 users and 2 conversations sent %s",
+              dict(redis.commands))
+
+        # A failed write is written again with the next flush, together with the changes since
+        redis.fail_writes = True
+        persistence.update_user_data(2, {})
+        persistence.update_conversation("submission", (2, 2), None)
+        try:
+            persistence.flush()
+            check("failed_write", False, "a failed write didn't raise")
+        except Exception:
+            pass
+        redis.fail_writes = False
+        persistence.update_conversation("submission", (1, 1), 4)
+        redis.commands.clear()
+        persistence.flush()
+        check("retry", redis.commands == {"SET": 1, "DEL": 2}, "the flush after a failed write sent %s",
+              dict(redis.commands))
+
+        # The flush thread writes the changes every flush_interval seconds
+        persistence.start()
+        persistence.update_user_data(3, {"persona": "default"})
+        check("flush_interval", wait_for(lambda: b"check:user_data:3" in redis.data, 2),
+              "not written by the flush thread")
+        persistence.stop()
+
+        loaded = RedisPersistence(redis.url, prefix="check")
+        user_data = loaded.get_user_data()
+        check("user_data", user_data == {1: {"persona": "default", "draft": {"content": "Nachricht 2"}},
+                                         3: {"persona": "default"}}, "user data read back: %s", dict(user_data))
+        conversations = loaded.get_conversations("submission")
+        check("conversations", conversations == {(1, 1): 4}, "conversations read back: %s", conversations)
+        check("chat_data", not loaded.get_chat_data(), "chat data was stored: %s", loaded.get_chat_data())
+    finally:
+        redis.stop()
+
+    # The bot with the persistence: the paths, and conversations that continue after a restart
+    redis = FakeRedis().start()
+    bot_api = FakeBotAPI().start()
+    item_api = FakeItemAPI().start()
+    env = {"TYPING_SECONDS": "0", "PERSISTENCE": "redis", "REDIS_URL": redis.url, "PERSISTENCE_FLUSH_INTERVAL": "0.5",
+           "OUTBOUND_GLOBAL_RATE": "1000000", "OUTBOUND_CHAT_RATE": "1000000"}
+    paths = all_paths()
+    try:
+        with tempfile.TemporaryDirectory(prefix="loadtest") as workdir:
+            bot = Bot(bot_api, item_api, workdir, env)
+            bot.start(bot_api.ready)
+            try:
+                failed += ["redis:path:" + name for name in check_paths(bot_api, item_api, paths, 5 * 10 ** 6, 30, 0.1)]
+                parked = [User(6 * 10 ** 6 + i, name, steps, park_at=4) for i, (name, steps) in enumerate(paths.items())
+                          if len(steps) > 4]
+                driver = Driver(bot_api, step_timeout=30, think_time=0.1)
+                driver.run(parked)
+                failed += ["redis:park:" + user.path_name for user in driver.failed]
+            finally:
+                bot.stop()
+        check("conversations_stored", any(key.startswith(b"telegram_bot:default:conversation:") for key in redis.data),
+              "no conversation stored after the bot stopped")
+
+        with tempfile.TemporaryDirectory(prefix="loadtest") as workdir:
+            bot = Bot(bot_api, item_api, workdir, env)
+            bot.start(bot_api.ready)
+            try:
+                resumed = []
+                for user in parked:
+                    user = User(user.user_id, user.path_name, paths[user.path_name])
+                    user.position = 4
+                    resumed.append(user)
+                driver = Driver(bot_api, step_timeout=30, think_time=0.1)
+                driver.run(resumed)
+                for user in driver.failed:
+                    logger.error("Redis persistence: path %s wasn't continued after the restart (step %s)",
+                                 user.path_name, user.position)
+                    failed.append("redis:resume:" + user.path_name)
+            finally:
+                bot.stop()
+    finally:
+        bot_api.stop()
+        item_api.stop()
+        redis.stop()
+    return failed
+
+
+def submissions_on_stop():
+    """Walks the paths with small batches to a slow item API and a batch window longer than the test,
+    and stops the bot right after the last step. Returns the failures."""
+    env = {"TYPING_SECONDS": "0", "PERSISTENCE": "sqlite", "SUBMISSION_BATCH_SIZE": "2",
+           "SUBMISSION_BATCH_WINDOW": "120"}
+    with running_bot(env, item_api_latency=0.3) as (bot, bot_api, item_api):
+        users = [User(3 * 10 ** 6 + i, name, steps) for i, (name, steps) in enumerate(all_paths().items())]
+        driver = Driver(bot_api, step_timeout=30, think_time=0.1)
+        driver.run(users)
+        exit_code = bot.stop()
+        contents = {s.get("content") for s in item_api.submissions.values()}
+    failed = ["exit_code"] if exit_code else []
+    for user in driver.failed:
+        failed.append("path:" + user.path_name)
+    for user in driver.finished:
+        if expected_submission(user.steps, user.content) is not None and user.content not in contents:
+            logger.error("Path %s: the submission wasn't sent before the bot stopped", user.path_name)
+            failed.append("submission:" + user.path_name)
+    return failed
+
+
+CHECKS = {"delayed_with_workers": delayed_with_workers, "quick_updates": quick_updates,
+          "redis_persistence": redis_persistence, "submissions_on_stop": submissions_on_stop}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("checks", nargs="*", help="Checks to run ({}). Default: all".format(", ".join(CHECKS)))
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error("unknown checks: " + ", ".join(sorted(unknown)))
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    failed = []
+    for name in args.checks or sorted(CHECKS):
+        failures = CHECKS[name]()
+        logger.info("Check %s: %s", name, "failed: " + ", ".join(failures) if failures else "passed")
+        failed += failures
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,383 @@
+"""Local fakes of the Telegram Bot API, of the item API and of Redis for the load test."""
+import gzip
+import json
+import logging
+import random
+import socketserver
+import threading
+import time
+from collections import Counter, deque
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so the bot's connection pools are used like with the real APIs
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.startswith("/file/"):
+            return self._send_file(self.server.api.file_size(self.path))
+        self._handle({})
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self._handle(json.loads(body) if body else {})
+
+    def do_PUT(self):
+        size = sum(len(chunk) for chunk in self._body_chunks())
+        self._handle_result(self.server.api.handle_upload(self.path, size, self.headers))
+
+    def _body_chunks(self):
+        """Reads the request body in chunks (with Content-Length or chunked encoding)."""
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            while True:
+                length = int(self.rfile.readline().split(b";")[0], 16)
+                if not length:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(length)
+                self.rfile.readline()
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 65536))
+            remaining -= len(chunk)
+            yield chunk
+
+    def _send_file(self, size):
+        if size is None:
+            return self._handle_result((404, {"ok": False}, None, None))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        chunk = bytes(65536)
+        for start in range(0, size, len(chunk)):
+            self.wfile.write(chunk[:size - start])
+
+    def _handle(self, data):
+        self._handle_result(self.server.api.handle(self.path, data, self.headers))
+
+    def _handle_result(self, result):
+        status, payload, headers, done = result
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if done:
+            done()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FakeServer:
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate, self.burst, self.tokens, self.updated = rate, burst, burst, time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FakeBotAPI(_FakeServer):
+    """Serves the Bot API methods the bot uses. Updates pushed with `push_update` are returned by
+    (long polling) getUpdates; messages the bot sends or edits are reported to `on_reply`. Files
+    with the id "loadtest-<size>" can be downloaded (as <size> zero bytes).
+
+    Parameters
+    ----------
+    latency: float, optional
+        Seconds every request takes. Default: 0
+    flood_limits: bool, optional
+        Answer with 429 above 30 calls/s or above 1 call/s per chat (bursts of 3). Default: False
+    """
+
+    def __init__(self, latency=0.0, flood_limits=False):
+        super().__init__()
+        self.latency = latency
+        self.flood_limits = flood_limits
+        self.on_reply = None
+        self.calls = Counter()
+        # Results of the answered inline queries by query id
+        self.inline_answers = {}
+        self.ready = threading.Event()
+
+        self._updates = deque()
+        self._next_update_id = 1
+        self._updates_changed = threading.Condition()
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._message_ids = {}
+        self._global_bucket = _TokenBucket(30, 30)
+        self._chat_buckets = {}
+
+    def push_update(self, update):
+        """Queues an update (dict without update_id) for getUpdates."""
+        with self._updates_changed:
+            update["update_id"] = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._updates_changed.notify_all()
+
+    def pending(self):
+        """Number of updates the bot hasn't fetched and confirmed yet."""
+        with self._updates_changed:
+            return sum(update["update_id"] >= self._offset for update in self._updates)
+
+    def last_message_id(self, chat_id):
+        with self._lock:
+            return self._message_ids.get(chat_id, 0)
+
+    def handle(self, path, data, headers):
+        method = path.rsplit("/", 1)[-1]
+        with self._lock:
+            self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(data)}, None, None
+
+        if self.latency:
+            time.sleep(self.latency)
+        # python-telegram-bot sends numbers as strings
+        chat_id = int(data["chat_id"]) if "chat_id" in data else None
+        if self.flood_limits and method not in ("getMe", "deleteWebhook", "getMyCommands") and not self._allow(chat_id):
+            with self._lock:
+                self.calls["429"] += 1
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}}, None, None
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Derrick", "username": "loadtest_bot"}
+        elif method == "getMyCommands":
+            result = []
+        elif method == "getFile":
+            size = int(data["file_id"].rsplit("-", 1)[1])
+            result = {"file_id": data["file_id"], "file_unique_id": data["file_id"], "file_size": size,
+                      "file_path": "photos/{}.jpg".format(data["file_id"])}
+        elif method in ("sendMessage", "editMessageText"):
+            with self._lock:
+                if method == "sendMessage":
+                    self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+                message_id = int(data.get("message_id") or self._message_ids[chat_id])
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+            if self.on_reply:
+                # Like in Telegram, the user sees the message once the bot got the response
+                return 200, {"ok": True, "result": result}, None, lambda: self.on_reply(chat_id, method, data)
+        elif method == "answerInlineQuery":
+            results = data.get("results") or []
+            with self._lock:
+                self.inline_answers[data["inline_query_id"]] = json.loads(results) if isinstance(results, str) else results
+            result = True
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}, None, None
+
+    def file_size(self, path):
+        """Size of the file at a download URL path, or None if it doesn't exist."""
+        with self._lock:
+            self.calls["download"] += 1
+        name = path.rsplit("/", 1)[-1]
+        if not name.startswith("loadtest-"):
+            return None
+        return int(name[len("loadtest-"):].split(".")[0])
+
+    def _allow(self, chat_id):
+        with self._lock:
+            if chat_id is not None:
+                bucket = self._chat_buckets.setdefault(chat_id, _TokenBucket(1, 3))
+                if not bucket.take():
+                    return False
+            return self._global_bucket.take()
+
+    def _get_updates(self, data):
+        offset = int(data.get("offset") or 0)
+        deadline = time.monotonic() + float(data.get("timeout") or 0)
+        self.ready.set()
+        with self._updates_changed:
+            self._offset = max(self._offset, offset)
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._updates_changed.wait(remaining)
+            return list(self._updates)[:int(data.get("limit") or 100)]
+
+
+class FakeItemAPI(_FakeServer):
+    """Accepts item submissions and keeps them by idempotency key. Media uploads (PUT) are
+    counted, their sizes are kept by path. Items marked with `resolve` are listed by
+    /resolved_items (the cursor is the number of resolved items seen), with their submitted
+    content, so they can be found by the bot's search. Batches of submissions are accepted on
+    /item_submissions.
+
+    Parameters
+    ----------
+    latency: float, optional
+        Seconds every request takes. Default: 0
+    error_rate: float, optional
+        Share of requests answered with 503. Default: 0
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.submissions = {}
+        self.item_ids = {}
+        self.uploads = {}
+        self.resolved = []
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    def resolve(self, item_ids):
+        """Marks items as resolved, with the URL https://loadtest/items/<id>."""
+        with self._lock:
+            contents = {item_id: self.submissions[key].get("content") for key, item_id in self.item_ids.items()}
+            self.resolved.extend({"id": item_id, "url": "https://loadtest/items/{}".format(item_id),
+                                  "title": "Loadtest Fall {}".format(item_id), "content": contents.get(item_id),
+                                  "result": "falsch"} for item_id in item_ids)
+
+    def handle(self, path, data, headers):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests[path.split("?")[0]] += 1
+            if random.random() < self.error_rate:
+                self.requests["503"] += 1
+                return 503, {"message": "unavailable"}, None, None
+            if path.startswith("/resolved_items"):
+                since = int(parse_qs(urlsplit(path).query).get("since", ["0"])[0])
+                return 200, {"items": self.resolved[since:], "cursor": str(len(self.resolved))}, None, None
+            if path == "/item_submissions":
+                results = [{"idempotency_key": item["idempotency_key"], "status": 201,
+                            "body": {"id": self._submit(item["idempotency_key"], item["item"])},
+                            "new_item_created": True} for item in data["items"]]
+                return 200, {"results": results}, None, None
+            item_id = self._submit(headers.get("Idempotency-Key"), data)
+        return 201, {"id": item_id}, {"new-item-created": "True"}, None
+
+    def _submit(self, key, data):
+        self.submissions.setdefault(key, data)
+        return self.item_ids.setdefault(key, len(self.item_ids) + 1)
+
+    def handle_upload(self, path, size, headers):
+        with self._lock:
+            self.requests["PUT"] += 1
+            self.uploads[path] = size
+        return 201, {}, None, None
+
+
+class _RedisHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            # Commands are arrays of bulk strings: *<count> then $<length> and the argument per argument
+            arguments = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                arguments.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self._encode(self.server.redis.execute(arguments)))
+
+    def _encode(self, value):
+        if isinstance(value, Exception):
+            return "-ERR {}\r\n".format(value).encode()
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return ":{}\r\n".format(value).encode()
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(self._encode(item) for item in value)
+        if value == "OK":
+            return b"+OK\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class FakeRedis:
+    """Serves the Redis commands of the bot's `RedisPersistence` (SET, DEL, MGET, SCAN) from a dict,
+    over the Redis protocol, so the real client is used. The commands are counted by name.
+
+    With `fail_writes` set, SET and DEL are answered with an error.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.commands = Counter()
+        self.fail_writes = False
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _RedisHandler)
+        self.server.daemon_threads = True
+        self.server.redis = self
+        self.url = "redis://127.0.0.1:{}/0".format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="FakeRedis", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def execute(self, arguments):
+        command, arguments = arguments[0].decode().upper(), arguments[1:]
+        with self._lock:
+            self.commands[command] += 1
+            if command in ("SET", "DEL") and self.fail_writes:
+                return RuntimeError("fake write error")
+            if command == "SET":
+                self.data[arguments[0]] = arguments[1]
+                return "OK"
+            if command == "DEL":
+                return sum(self.data.pop(key, None) is not None for key in arguments)
+            if command == "MGET":
+                return [self.data.get(key) for key in arguments]
+            if command == "SCAN":
+                # All matching keys at once, with the cursor 0 (the scan is complete)
+                options = {name.decode().upper(): value for name, value in zip(arguments[1::2], arguments[2::2])}
+                pattern = options.get("MATCH", b"*").decode()
+                return [b"0", [key for key in self.data if fnmatchcase(key.decode(), pattern)]]
+        return RuntimeError("unknown command {}".format(command))
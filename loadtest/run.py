@@ -0,0 +1,402 @@
+"""Offline replay and load test of the conversation flow.
+
+Starts the bot (src/telegram_bot.py) as a child process against a local fake Bot API and a fake
+item API, then
+1. walks every path through the conversation once and checks the submissions the item API got,
+   the notifications about the resolved items and the search for them,
+2. runs `--users` synthetic users (round robin over all paths) and reports the throughput and the
+   latency per step,
+3. parks `--park` users in the middle of the conversation and reports the memory of the bot per
+   active conversation.
+
+Recorded updates (one Bot API update as JSON per line, e.g. from getUpdates) can be replayed with
+`--replay`. The results are printed and, with `--json`, written to a file, so runs can be compared.
+
+    python loadtest/run.py --users 1000 --park 10000 --json results.json
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from fake_apis import FakeBotAPI, FakeItemAPI, FakeRedis
+from scenarios import Driver, User, all_paths, expected_submission
+
+logger = logging.getLogger("loadtest")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+
+def rss_bytes(pid):
+    """Resident memory of a process and its child processes, e.g. the workers (Linux)."""
+    rss = 0
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    return rss + sum(rss_bytes(child) for child in children)
+
+
+class Bot:
+    """The bot as a child process, configured to use the fake APIs.
+
+    Parameters
+    ----------
+    bot_api: FakeBotAPI
+    item_api: FakeItemAPI
+    workdir: string
+        Directory for the bot's state and submission queue
+    env: dict, optional
+        Additional environment variables (e.g. TYPING_MODE)
+    log_path: string, optional
+        File the log of the bot is written to. Default: bot.log in `workdir`
+    """
+
+    def __init__(self, bot_api, item_api, workdir, env=None, log_path=None):
+        self.env = dict(os.environ, STAGE="loadtest", TELEGRAM_BOT_TOKEN_DEFAULT="123456:loadtest",
+                        BOT_API_URL=bot_api.url, ITEM_API_URL=item_api.url, METRICS_PORT="0",
+                        SUBMISSION_QUEUE_PATH=os.path.join(workdir, "submission_queue.db"),
+                        PERSISTENCE_PATH=os.path.join(workdir, "bot_state.db"),
+                        NOTIFICATION_PATH=os.path.join(workdir, "notifications.db"), NOTIFICATION_POLL_INTERVAL="1",
+                        SEARCH_INDEX_PATH=os.path.join(workdir, "search_index.bin"), SEARCH_SYNC_INTERVAL="1")
+        # e.g. METRICS_PORT, to read the metrics of the bot
+        self.env.update(env or {})
+        self.workdir = workdir
+        self.log_path = log_path or os.path.join(workdir, "bot.log")
+        self.process = None
+
+    def start(self, ready, timeout=60):
+        # The log of the bot goes to a file, writing it to the terminal would slow the bot down
+        self.log = open(self.log_path, "wb")
+        self.process = subprocess.Popen([sys.executable, os.path.join(ROOT, "src", "telegram_bot.py")],
+                                        cwd=self.workdir, env=self.env, stdout=self.log, stderr=subprocess.STDOUT)
+        if not ready.wait(timeout):
+            self.stop()
+            raise RuntimeError("The bot didn't start polling within {}s, see its log: {}".format(
+                timeout, self.tail()))
+
+    @property
+    def rss(self):
+        return rss_bytes(self.process.pid)
+
+    def tail(self, lines=20):
+        with open(self.log.name, errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+
+    def stop(self, timeout=30):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            return self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            return self.process.wait()
+        finally:
+            self.log.close()
+
+
+@contextmanager
+def running_bot(env=None, bot_api_latency=0, item_api_latency=0, flood_limits=False, log_path=None):
+    """Starts the fake APIs and the bot with the environment variables `env` (and, unless
+    `flood_limits`, without outbound rate limits) and yields (bot, bot_api, item_api). Used by the
+    benchmarks (loadtest/bench_*.py)."""
+    bot_api = FakeBotAPI(latency=bot_api_latency, flood_limits=flood_limits).start()
+    item_api = FakeItemAPI(latency=item_api_latency).start()
+    if not flood_limits:
+        env = dict({"OUTBOUND_GLOBAL_RATE": "1000000", "OUTBOUND_CHAT_RATE": "1000000"}, **(env or {}))
+    try:
+        with tempfile.TemporaryDirectory(prefix="loadtest") as workdir:
+            bot = Bot(bot_api, item_api, workdir, env, log_path)
+            bot.start(bot_api.ready)
+            try:
+                yield bot, bot_api, item_api
+            finally:
+                bot.stop()
+    finally:
+        bot_api.stop()
+        item_api.stop()
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def check_paths(bot_api, item_api, paths, first_user_id, step_timeout, think_time):
+    """Walks every path once. Returns the names of the paths that failed or whose submission differs."""
+    users = [User(first_user_id + i, name, steps) for i, (name, steps) in enumerate(paths.items())]
+    driver = Driver(bot_api, step_timeout=step_timeout, think_time=think_time)
+    driver.run(users)
+    failed = {user.path_name for user in driver.failed}
+    for user in driver.failed:
+        logger.error("Path %s: no answer to step %d %s", user.path_name, user.position, user.steps[user.position])
+
+    expected = {user.content: (user.path_name, expected_submission(user.steps, user.content))
+                for user in driver.finished}
+    expected_count = sum(submission is not None for _, submission in expected.values())
+    received = lambda: {s.get("content"): s for s in item_api.submissions.values() if s.get("content") in expected}
+    # Submissions are sent in the background by the submission queue
+    wait_for(lambda: len(received()) >= expected_count, step_timeout)
+    submissions = received()
+    for content, (name, submission) in expected.items():
+        got = submissions.get(content)
+        if got is not None and "media" in got:
+            # The file has to be uploaded with the submitted size, the URL is random
+            got = dict(got, media=dict(got["media"]))
+            url = got["media"].pop("url", "")
+            uploaded = item_api.uploads.get("/" + url.split("/", 3)[-1])
+            if uploaded != got["media"].get("size"):
+                logger.error("Path %s: upload of %s has %s bytes", name, url, uploaded)
+                failed.add(name)
+        if got != submission:
+            logger.error("Path %s: expected submission %s, got %s", name, submission, got)
+            failed.add(name)
+    return sorted(failed)
+
+
+def check_notifications(bot_api, item_api, paths, first_user_id, timeout):
+    """Resolves the items submitted by `check_paths` and waits until every submitter got the
+    notification with the URL of its item. Returns the names of the paths whose user wasn't notified."""
+    users = {first_user_id + i: User(first_user_id + i, name, steps) for i, (name, steps) in enumerate(paths.items())}
+    with item_api._lock:
+        items = {s.get("content"): item_api.item_ids[key] for key, s in item_api.submissions.items()}
+    expected = {user_id: "https://loadtest/items/{}".format(items[user.content])
+                for user_id, user in users.items() if user.content in items}
+
+    notified = {}
+    driver_on_reply = bot_api.on_reply
+
+    def on_reply(chat_id, method, data):
+        if chat_id in expected and "https://loadtest/items/" in data.get("text", ""):
+            notified[chat_id] = data["text"]
+
+    bot_api.on_reply = on_reply
+    try:
+        item_api.resolve(sorted(set(items.values())))
+        wait_for(lambda: len(notified) >= len(expected), timeout)
+    finally:
+        bot_api.on_reply = driver_on_reply
+
+    failed = set()
+    for user_id, url in expected.items():
+        if url not in notified.get(user_id, ""):
+            logger.error("Path %s: no notification with %s, got %s", users[user_id].path_name, url,
+                         notified.get(user_id))
+            failed.add(users[user_id].path_name)
+    return sorted(failed)
+
+
+def check_search(bot_api, item_api, user_id, timeout):
+    """Searches a resolved item (after `check_notifications`) by its content with /search and with
+    an inline query, until the bot has synced it. Returns the names of the failed searches."""
+    with item_api._lock:
+        case = next((case for case in item_api.resolved if case.get("content")), None)
+    if case is None:
+        logger.error("Search: no resolved item to search for")
+        return ["search"]
+    user = {"id": user_id, "is_bot": False, "first_name": "Load", "username": "user{}".format(user_id)}
+    replies = []
+    driver_on_reply = bot_api.on_reply
+
+    def on_reply(chat_id, method, data):
+        if chat_id == user_id:
+            replies.append(data.get("text", ""))
+
+    # The content of the loadtest messages ends with the user id. The inline query is still being
+    # typed: "<user id> Nachr"
+    words = case["content"].split()
+    command = "/search {}".format(case["content"])
+    inline_query = "{} {}".format(words[-1], words[-2][:5])
+    found = {}
+    bot_api.on_reply = on_reply
+    try:
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while len(found) < 2 and time.monotonic() < deadline:
+            attempt += 1
+            if "command" not in found:
+                bot_api.push_update({"message": {
+                    "message_id": attempt, "date": int(time.time()), "from": user, "text": command,
+                    "chat": {"id": user_id, "type": "private", "first_name": "Load"},
+                    "entities": [{"type": "bot_command", "offset": 0, "length": len("/search")}]}})
+            if "inline" not in found:
+                bot_api.push_update({"inline_query": {"id": "{}-{}".format(user_id, attempt), "from": user,
+                                                      "query": inline_query, "offset": ""}})
+            time.sleep(1)
+            if any(case["url"] in reply for reply in replies):
+                found["command"] = True
+            with bot_api._lock:
+                answers = list(bot_api.inline_answers.values())
+            if any(answer and answer[0].get("url") == case["url"] for answer in answers):
+                found["inline"] = True
+    finally:
+        bot_api.on_reply = driver_on_reply
+
+    failed = ["search:{}".format(kind) for kind in ("command", "inline") if kind not in found]
+    for name in failed:
+        logger.error("Search %s: case %s not found within %ss", name, case["id"], timeout)
+    return failed
+
+
+def run_load(bot_api, paths, users, first_user_id, step_timeout, think_time):
+    """Runs `users` users round robin over the paths and returns throughput and step latencies."""
+    names = sorted(paths)
+    load = [User(first_user_id + i, names[i % len(names)], paths[names[i % len(names)]]) for i in range(users)]
+    driver = Driver(bot_api, step_timeout=step_timeout, think_time=think_time)
+    start = time.perf_counter()
+    driver.run(load)
+    seconds = time.perf_counter() - start
+
+    updates = sum(len(user.steps) for user in driver.finished)
+    steps = {}
+    for name, values in sorted(driver.latencies.items()):
+        steps[name] = {"count": len(values), "p50_ms": percentile(values, 50) * 1000,
+                       "p95_ms": percentile(values, 95) * 1000, "p99_ms": percentile(values, 99) * 1000}
+    every_step = [value for values in driver.latencies.values() for value in values]
+    return {
+        "users": users,
+        "finished": len(driver.finished),
+        "failed": len(driver.failed),
+        "seconds": seconds,
+        "updates_per_second": updates / seconds,
+        "conversations_per_second": len(driver.finished) / seconds,
+        "step_p50_ms": round(percentile(every_step, 50) * 1000, 1) if every_step else None,
+        "step_p99_ms": round(percentile(every_step, 99) * 1000, 1) if every_step else None,
+        "steps": steps,
+    }
+
+
+def run_memory(bot_api, bot, paths, parked, first_user_id, step_timeout, think_time):
+    """Leaves `parked` users in the CHANNEL state (everything but the last two answers given) and
+    returns the memory growth of the bot per open conversation."""
+    steps = paths["full_family_1_Telegram"]
+    before = bot.rss
+    driver = Driver(bot_api, step_timeout=step_timeout, think_time=think_time)
+    driver.run([User(first_user_id + i, "parked", steps, park_at=len(steps) - 2) for i in range(parked)])
+    # Let the handlers and the persistence settle
+    time.sleep(2)
+    after = bot.rss
+    return {
+        "conversations": len(driver.finished),
+        "rss_before_mb": before / 2 ** 20,
+        "rss_after_mb": after / 2 ** 20,
+        "bytes_per_conversation": (after - before) / max(1, len(driver.finished)),
+    }
+
+
+def replay(bot_api, path, timeout):
+    """Pushes recorded updates and waits until the bot has fetched all of them."""
+    with open(path) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    start = time.perf_counter()
+    for update in updates:
+        update.pop("update_id", None)
+        bot_api.push_update(update)
+    wait_for(lambda: bot_api.pending() == 0, timeout)
+    return {"updates": len(updates), "seconds": time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=500, help="Users of the throughput run (0 to skip)")
+    parser.add_argument("--park", type=int, default=2000, help="Open conversations of the memory run (0 to skip)")
+    # Users need a moment to read the answer (updates that arrive before the handler of the previous one
+    # has finished are handled after it, see loadtest/checks.py quick_updates)
+    parser.add_argument("--think-time", type=float, default=0.3, help="Seconds between answer and next step")
+    parser.add_argument("--step-timeout", type=float, default=60, help="Seconds after which a user is given up")
+    parser.add_argument("--typing-mode", default="asyncio", help="TYPING_MODE of the bot")
+    parser.add_argument("--typing-seconds", type=float, default=0, help="TYPING_SECONDS of the bot")
+    parser.add_argument("--persistence", default="none",
+                        help="PERSISTENCE of the bot (sqlite, redis or none). Redis is faked unless REDIS_URL is set")
+    parser.add_argument("--workers", type=int, default=0, help="WORKERS of the bot (0: single process)")
+    parser.add_argument("--bot-api-latency", type=float, default=0, help="Seconds per Bot API request")
+    parser.add_argument("--item-api-latency", type=float, default=0, help="Seconds per item API request")
+    parser.add_argument("--flood-limits", action="store_true",
+                        help="Let the fake Bot API enforce Telegram's flood limits (and the bot its default rates)")
+    parser.add_argument("--replay", help="File with recorded updates (JSON lines) to replay")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--bot-log", help="Write the log of the bot to this file")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    bot_api = FakeBotAPI(latency=args.bot_api_latency, flood_limits=args.flood_limits).start()
+    item_api = FakeItemAPI(latency=args.item_api_latency).start()
+    env = {"TYPING_MODE": args.typing_mode, "TYPING_SECONDS": str(args.typing_seconds),
+           "PERSISTENCE": args.persistence, "WORKERS": str(args.workers)}
+    if not args.flood_limits:
+        env.update(OUTBOUND_GLOBAL_RATE="1000000", OUTBOUND_CHAT_RATE="1000000")
+    redis = None
+    if args.persistence == "redis" and "REDIS_URL" not in os.environ:
+        redis = FakeRedis().start()
+        env["REDIS_URL"] = redis.url
+
+    results = {"config": vars(args)}
+    with tempfile.TemporaryDirectory(prefix="loadtest") as workdir:
+        bot = Bot(bot_api, item_api, workdir, env, args.bot_log)
+        bot.start(bot_api.ready)
+        try:
+            results["rss_start_mb"] = bot.rss / 2 ** 20
+            paths = all_paths()
+            # Every phase uses its own user ids, so conversations don't carry over
+            failed = check_paths(bot_api, item_api, paths, 10 ** 6, args.step_timeout, args.think_time)
+            failed = sorted(set(failed) | set(check_notifications(bot_api, item_api, paths, 10 ** 6,
+                                                                  args.step_timeout)))
+            failed = sorted(set(failed) | set(check_search(bot_api, item_api, 4 * 10 ** 6, args.step_timeout)))
+            results["paths"] = {"count": len(paths), "failed": failed}
+            logger.info("Paths: %d checked, failed: %s", len(paths), ", ".join(failed) or "none")
+
+            if args.replay:
+                results["replay"] = replay(bot_api, args.replay, args.step_timeout)
+                logger.info("Replay: %(updates)d updates in %(seconds).1fs", results["replay"])
+            if args.users:
+                results["load"] = run_load(bot_api, paths, args.users, 2 * 10 ** 6, args.step_timeout,
+                                           args.think_time)
+                logger.info("Load: %(finished)d/%(users)d conversations in %(seconds).1fs, "
+                            "%(updates_per_second).0f updates/s, step p50 %(step_p50_ms)sms, "
+                            "p99 %(step_p99_ms)sms", results["load"])
+                for name, step in results["load"]["steps"].items():
+                    logger.info("  %-22s %6d  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms", name, step["count"],
+                                step["p50_ms"], step["p95_ms"], step["p99_ms"])
+            if args.park:
+                results["memory"] = run_memory(bot_api, bot, paths, args.park, 3 * 10 ** 6, args.step_timeout,
+                                               args.think_time)
+                logger.info("Memory: %(conversations)d open conversations, RSS %(rss_before_mb).1f -> "
+                            "%(rss_after_mb).1f MB, %(bytes_per_conversation).0f bytes per conversation",
+                            results["memory"])
+            results["bot_api_calls"] = dict(bot_api.calls)
+            if results["paths"]["failed"]:
+                logger.error("Log of the bot:\n%s", bot.tail())
+        finally:
+            results["exit_code"] = bot.stop()
+            bot_api.stop()
+            item_api.stop()
+            if redis is not None:
+                redis.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if results["paths"]["failed"] or results.get("load", {}).get("failed") else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
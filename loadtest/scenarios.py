@@ -0,0 +1,217 @@
+"""Synthetic users that walk through the conversation of the bot.
+
+A path is a list of steps `(kind, value)`: "command" (e.g. /start), "text" (the message to check,
+the value is replaced by a unique text per user), "photo" (a photo of `value` bytes with the text as
+caption), "forward" (the text, forwarded from a channel) or "callback" (callback_data of a button).
+The paths mirror the menus in src/telegram_bot.py and cover every button, including "back" and
+"skip".
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import defaultdict
+
+CONTACTS = ["family", "acquaintance", "stranger", "internet", "skip"]
+FREQUENCIES = ["1", "2", "3", "4", "5", "6+", "skip"]
+CHANNELS = ["Telegram", "WhatsApp", "Facebook", "Instagram", "Twitter", "YouTube", "messenger", "social_network",
+            "internet", "in_person", "skip"]
+
+START = ("command", "/start")
+CONTENT = ("text", None)
+CONTENT_KINDS = ("text", "photo", "forward")
+# Default MEDIA_MAX_BYTES of the bot
+MEDIA_MAX_BYTES = 20 * 2 ** 20
+FORWARD_DATE = 1600000000
+FORWARD_CHAT = {"id": -1001234567890, "type": "channel", "title": "Loadtest Kanal", "username": "loadtest_kanal"}
+
+
+def _full(contact, frequency, channel):
+    return [START, ("callback", "ja"), CONTENT, ("callback", "ja"), ("callback", contact),
+            ("callback", frequency), ("callback", channel), ("callback", "submit")]
+
+
+def all_paths():
+    """Returns a dict of path name -> steps covering every way through the conversation."""
+    paths = {
+        "gdpr_denied": [START, ("callback", "nein")],
+        "no_additional_info": [START, ("callback", "ja"), CONTENT, ("callback", "nein")],
+    }
+    # Every contact, frequency and channel button at least once
+    for i, channel in enumerate(CHANNELS):
+        contact, frequency = CONTACTS[i % len(CONTACTS)], FREQUENCIES[i % len(FREQUENCIES)]
+        paths["full_{}_{}_{}".format(contact, frequency, channel)] = _full(contact, frequency, channel)
+
+    full = _full("family", "3", "WhatsApp")
+    paths["back_from_frequency"] = full[:5] + [("callback", "back"), ("callback", "stranger")] + full[5:]
+    paths["back_from_channel"] = full[:6] + [("callback", "back"), ("callback", "5")] + full[6:]
+    paths["back_from_submit"] = full[:7] + [("callback", "back"), ("callback", "Telegram")] + full[7:]
+    paths["back_twice"] = full[:6] + [("callback", "back"), ("callback", "back"), ("callback", "acquaintance"),
+                                      ("callback", "2")] + full[6:]
+    paths["photo"] = [START, ("callback", "ja"), ("photo", 300000), ("callback", "nein")]
+    paths["photo_too_large"] = [START, ("callback", "ja"), ("photo", MEDIA_MAX_BYTES + 1), ("photo", 1000),
+                                ("callback", "nein")]
+    paths["forward"] = [START, ("callback", "ja"), ("forward", None)] + full[3:]
+    return paths
+
+
+def expected_submission(steps, content):
+    """The payload the item API should receive for a complete path, or None if nothing is submitted.
+    The URL of uploaded media isn't known in advance and left out."""
+    if steps[1] == ("callback", "nein"):
+        return None
+    # The last message in the CONTENT state is submitted (the bot asks again for files that are too large)
+    index = max(i for i, (kind, _) in enumerate(steps) if kind in CONTENT_KINDS)
+    kind, value = steps[index]
+    submission = {"content": content}
+    if kind == "photo":
+        submission["media"] = {"kind": "photo", "mime_type": "image/jpeg", "size": value}
+    elif kind == "forward":
+        submission["forward"] = {"date": FORWARD_DATE, "chat_id": FORWARD_CHAT["id"], "chat_type": "channel",
+                                 "chat_title": FORWARD_CHAT["title"], "chat_username": FORWARD_CHAT["username"],
+                                 "message_id": 7}
+    if steps[index + 1] == ("callback", "ja"):
+        # contact, frequency and channel up to the final "submit"; "back" returns to the previous question
+        fields, position = ["contact", "frequency", "channel"], 0
+        for _, value in steps[index + 2:-1]:
+            if value == "back":
+                position -= 1
+            else:
+                submission[fields[position]] = value
+                position += 1
+    return {key: value for key, value in submission.items() if value != "skip"}
+
+
+def replies_expected(step):
+    """Number of messages (sent or edited) with which the bot answers a step."""
+    return 2 if step == START else 1
+
+
+class User:
+
+    def __init__(self, user_id, path_name, steps, park_at=None):
+        self.user_id = user_id
+        self.path_name = path_name
+        self.steps = steps if park_at is None else steps[:park_at]
+        self.content = "Loadtest Nachricht {}".format(user_id)
+        self.position = 0
+        self.replies = 0
+        self.sent_at = None
+        self.failed = False
+
+    def update(self, api):
+        kind, value = self.steps[self.position]
+        user = {"id": self.user_id, "is_bot": False, "first_name": "Load", "username": "user{}".format(self.user_id)}
+        chat = {"id": self.user_id, "type": "private", "first_name": "Load"}
+        if kind == "callback":
+            return {"callback_query": {
+                "id": "{}-{}".format(self.user_id, self.position), "from": user, "chat_instance": str(self.user_id),
+                "data": value, "message": {"message_id": api.last_message_id(self.user_id), "date": int(time.time()),
+                                           "chat": chat, "text": "..."}}}
+        message = {"message_id": 1000 + self.position, "date": int(time.time()), "chat": chat, "from": user}
+        if kind == "photo":
+            file_id = "loadtest-{}".format(value)
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960,
+                                 "file_size": value}]
+            message["caption"] = self.content
+            return {"message": message}
+        message["text"] = value if kind == "command" else self.content
+        if kind == "command":
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(value)}]
+        if kind == "forward":
+            message.update(forward_from_chat=FORWARD_CHAT, forward_from_message_id=7, forward_date=FORWARD_DATE)
+        return {"message": message}
+
+
+class Driver:
+    """Sends the steps of many users to the fake Bot API. The next step of a user is sent (after
+    `think_time`) once the bot has answered the previous one; the time until the answer is recorded
+    per step.
+
+    Parameters
+    ----------
+    api: FakeBotAPI
+    step_timeout: float, optional
+        Seconds after which a user that got no answer is given up. Default: 30
+    think_time: float, optional
+        Seconds between the answer of the bot and the next step of the user. Default: 0
+    """
+
+    def __init__(self, api, step_timeout=30, think_time=0):
+        self.api = api
+        self.step_timeout = step_timeout
+        self.think_time = think_time
+        self.latencies = defaultdict(list)
+        self.finished = []
+        self.failed = []
+
+        self._users = {}
+        self._due = []
+        self._sequence = itertools.count()
+        self._lock = threading.Condition()
+        api.on_reply = self._on_reply
+
+    def run(self, users, wait=True):
+        """Starts the users and waits until all of them have finished (or failed)."""
+        with self._lock:
+            for user in users:
+                self._users[user.user_id] = user
+                heapq.heappush(self._due, (time.monotonic(), next(self._sequence), user.user_id))
+            self._lock.notify_all()
+        thread = threading.Thread(target=self._loop, name="driver", daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def active(self):
+        with self._lock:
+            return len(self._users)
+
+    def _on_reply(self, chat_id, method, data):
+        with self._lock:
+            user = self._users.get(chat_id)
+            if user is None or user.sent_at is None:
+                return
+            user.replies += 1
+            step = user.steps[user.position]
+            if user.replies < replies_expected(step):
+                return
+            now = time.monotonic()
+            self.latencies[self._step_name(user)].append(now - user.sent_at)
+            user.position += 1
+            user.sent_at = None
+            if user.position == len(user.steps):
+                self.finished.append(user)
+                del self._users[chat_id]
+            else:
+                heapq.heappush(self._due, (now + self.think_time, next(self._sequence), chat_id))
+            self._lock.notify_all()
+
+    @staticmethod
+    def _step_name(user):
+        kind, value = user.steps[user.position]
+        return "{}:{}".format(kind, value if kind in ("command", "callback", "photo") else "<content>")
+
+    def _loop(self):
+        checked = time.monotonic()
+        with self._lock:
+            while self._users:
+                now = time.monotonic()
+                if now - checked > 1:
+                    # Give up users whose step isn't answered
+                    checked = now
+                    for user in [u for u in self._users.values() if u.sent_at and now - u.sent_at > self.step_timeout]:
+                        user.failed = True
+                        self.failed.append(user)
+                        del self._users[user.user_id]
+                if self._due and self._due[0][0] <= now:
+                    _, _, user_id = heapq.heappop(self._due)
+                    user = self._users.get(user_id)
+                    if user is not None:
+                        user.replies = 0
+                        user.sent_at = time.monotonic()
+                        self.api.push_update(user.update(self.api))
+                    continue
+                timeout = min(self._due[0][0] - now, 1) if self._due else 1
+                self._lock.wait(timeout)
@@ -0,0 +1,276 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import DispatcherHandlerStop, TypeHandler
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+ADMISSION = Counter("bot_admission_total", "Updates by the decision of the admission control", ("result",))
+
+
+class SlidingWindowLimiter:
+    """Allows `limit` events per `window` seconds and key (e.g. user id).
+
+    The rate is estimated from the count of the current fixed window and the count of the previous
+    one, weighted by how much of the previous window is still within the last `window` seconds
+    (sliding window counter). That takes constant time and two counts per key. Keys are kept in
+    the order of their last event, so the keys without events in the last two windows are dropped
+    from the front, and at most `max_keys` are kept.
+
+    Parameters
+    ----------
+    limit: int
+        Events allowed per window
+    window: float
+        Length of the window in seconds
+    max_keys: int, optional
+        Keys kept at most (the least recently seen are dropped first). Default: 100000
+    """
+
+    def __init__(self, limit, window, max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # key -> [index of the current window, count of the current window, count of the previous one]
+        self._counts = OrderedDict()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def allow(self, key, now=None):
+        """Counts an event of `key` and returns True, or returns False if the key is over the limit
+        (rejected events aren't counted)."""
+        now = time.monotonic() if now is None else now
+        index, elapsed = divmod(now, self.window)
+        with self._lock:
+            while self._counts:
+                oldest = next(iter(self._counts.values()))
+                if oldest[0] >= index - 1 and len(self._counts) < self.max_keys:
+                    break
+                self._counts.popitem(last=False)
+
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [index, 0, 0]
+            else:
+                self._counts.move_to_end(key)
+                if counts[0] != index:
+                    counts[2] = counts[1] if counts[0] == index - 1 else 0
+                    counts[0], counts[1] = index, 0
+            if counts[2] * (1 - elapsed / self.window) + counts[1] >= self.limit:
+                return False
+            counts[1] += 1
+            return True
+
+
+class Blocklist:
+    """User and chat ids that the bot ignores, read from a file with one id per line (text after
+    "#" is a comment). The file is shared by all workers and replicas (e.g. on a volume) and read
+    again when it changed, which is checked at most every `reload_interval` seconds.
+
+    Parameters
+    ----------
+    path: string
+        Path of the file. A missing file is an empty blocklist
+    reload_interval: float, optional
+        Seconds between two checks of the file. Default: 10
+    """
+
+    def __init__(self, path, reload_interval=10):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._ids = frozenset()
+        self._mtime = None
+        self._checked = None
+
+    def __contains__(self, id):
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= self.reload_interval:
+            self._checked = now
+            self.reload()
+        return id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            self._ids, self._mtime = frozenset(), None
+            return
+        if mtime == self._mtime:
+            return
+        ids = set()
+        with open(self.path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    ids.add(int(line))
+                except ValueError:
+                    logger.warning("Ignoring line %s of the blocklist %s: %r", number, self.path, line)
+        self._ids, self._mtime = frozenset(ids), mtime
+        logger.info("Blocklist %s loaded with %s id(s)", self.path, len(ids))
+
+
+class AdmissionControl:
+    """Decides before the conversation handlers whether an update is handled, registered as
+    `TypeHandler` in a group before them (see `handler`). Rejected updates end the dispatch of the
+    update with `DispatcherHandlerStop`.
+
+    1. Updates of blocked users and chats are dropped.
+    2. Updates of users and chats over their rate limit (`SlidingWindowLimiter`) are dropped, as
+       are /start commands over `start_limiter` (each /start clears the conversation and sends
+       two messages). Inline queries (sent on every keystroke) only count against `inline_limiter`,
+       so searching doesn't use up the limit of the user's conversation. `on_limited(update, context)` is called at most once per window and chat,
+       e.g. to ask the user to slow down.
+    3. While more than `delay_depth` updates are waiting or being handled (`depth`), updates that
+       aren't `priority` (e.g. the next step of a running conversation) are handled `delay`
+       seconds later (once, handed to `readmit` or put on the update queue again, so they are
+       dispatched in order with the other updates); above `shed_depth` they are dropped.
+
+    Every step takes constant time.
+
+    Parameters
+    ----------
+    user_limiter, chat_limiter, start_limiter, inline_limiter: SlidingWindowLimiter, optional
+        Limits per user id, per chat id, of /start per user id and of inline queries per user id
+    blocklist: Blocklist or set, optional
+        Blocked user and chat ids
+    depth: function, optional
+        Returns the number of updates waiting or being handled
+    priority: function, optional
+        Called with an update, returns True if it must not be delayed or dropped under load.
+        Default: all updates are
+    delay_depth, shed_depth: int, optional
+        Depths above which other updates are delayed and dropped. Default: 1000 and 5000
+    delay: float, optional
+        Seconds an update is delayed. Default: 2
+    on_limited: function, optional
+        Called with (update, context) when an update is dropped for a rate limit
+    readmit: function, optional
+        Called with (update, dispatcher) when a delayed update is due (see also `requeue`), to dispatch
+        it again. Default: puts it on the update queue of the dispatcher
+    """
+
+    def __init__(self, user_limiter=None, chat_limiter=None, start_limiter=None, blocklist=None, depth=None,
+                 priority=None, delay_depth=1000, shed_depth=5000, delay=2, on_limited=None, readmit=None,
+                 inline_limiter=None):
+        self.user_limiter = user_limiter
+        self.chat_limiter = chat_limiter
+        self.start_limiter = start_limiter
+        self.inline_limiter = inline_limiter
+        self.blocklist = blocklist
+        self.depth = depth
+        self.priority = priority
+        self.delay_depth = delay_depth
+        self.shed_depth = shed_depth
+        self.delay = delay
+        self.on_limited = on_limited
+        self.readmit = readmit
+
+        limiters = (user_limiter, chat_limiter, start_limiter, inline_limiter)
+        window = max((limiter.window for limiter in limiters if limiter is not None), default=60)
+        self._notices = SlidingWindowLimiter(1, window)
+        # Delayed updates by id, which aren't counted or delayed again (changed by the dispatcher and
+        # when draining)
+        self._delayed = {}
+        self._delayed_lock = threading.Lock()
+
+    @property
+    def delayed(self):
+        """Number of delayed updates that haven't been handled again yet."""
+        return len(self._delayed)
+
+    def is_delayed(self, update):
+        """True if the update has been delayed and hasn't been dispatched again yet."""
+        return update.update_id in self._delayed
+
+    def take_delayed(self):
+        """Removes the delayed updates (e.g. to hand them off on shutdown) and returns them."""
+        with self._delayed_lock:
+            delayed, self._delayed = self._delayed, {}
+        return list(delayed.values())
+
+    def requeue(self, update, dispatcher):
+        """Dispatches an update again right away (e.g. one that waited for the handler of its
+        conversation). Like a delayed update it isn't counted against the limits again."""
+        with self._delayed_lock:
+            self._delayed[update.update_id] = update
+        self._dispatch_again(update, dispatcher)
+
+    def handler(self):
+        """The `TypeHandler` to register, e.g. `dispatcher.add_handler(admission.handler(), group=-1)`."""
+        return TypeHandler(Update, self.admit)
+
+    def admit(self, update, context):
+        with self._delayed_lock:
+            readmitted = self._delayed.pop(update.update_id, None) is not None
+        if readmitted:
+            if self.depth is not None and self.depth() > self.shed_depth and not self._is_priority(update):
+                self._reject("shed")
+            ADMISSION.inc("admitted")
+            return
+
+        user = update.effective_user
+        chat = update.effective_chat
+        if self.blocklist is not None and ((user and user.id in self.blocklist) or (chat and chat.id in self.blocklist)):
+            self._reject("blocked")
+
+        if update.inline_query is not None:
+            if user and self.inline_limiter is not None and not self.inline_limiter.allow(user.id):
+                self._limited(update, context, "inline_limited")
+        else:
+            if user and self.user_limiter is not None and not self.user_limiter.allow(user.id):
+                self._limited(update, context, "user_limited")
+            if chat and self.chat_limiter is not None and not self.chat_limiter.allow(chat.id):
+                self._limited(update, context, "chat_limited")
+        message = update.message
+        if (user and self.start_limiter is not None and message and message.text and message.text.startswith("/start")
+                and not self.start_limiter.allow(user.id)):
+            self._limited(update, context, "start_limited")
+
+        depth = self.depth() if self.depth is not None else 0
+        if depth > self.delay_depth and not self._is_priority(update):
+            if depth > self.shed_depth:
+                self._reject("shed")
+            with self._delayed_lock:
+                self._delayed[update.update_id] = update
+            context.job_queue.run_once(self._readmit, self.delay, context=update)
+            self._reject("delayed")
+        ADMISSION.inc("admitted")
+
+    def _is_priority(self, update):
+        return self.priority is None or self.priority(update)
+
+    def _limited(self, update, context, reason):
+        chat = update.effective_chat
+        if self.on_limited is not None and chat and self._notices.allow(chat.id):
+            try:
+                self.on_limited(update, context)
+            except Exception:
+                logger.exception("Could not tell chat %s about its rate limit", chat.id)
+        self._reject(reason)
+
+    def _reject(self, reason):
+        ADMISSION.inc(reason)
+        raise DispatcherHandlerStop()
+
+    def _readmit(self, context):
+        self._dispatch_again(context.job.context, context.dispatcher)
+
+    def _dispatch_again(self, update, dispatcher):
+        # Dispatched by the dispatcher thread like any update, not on the calling thread
+        if self.readmit is not None:
+            self.readmit(update, dispatcher)
+        else:
+            dispatcher.update_queue.put(update)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class EventLoopThread:
+    """Runs an asyncio event loop on a background thread, on which the conversation handlers
+    of the "asyncio" mode run. Handlers don't hold a thread while they wait (typing delay,
+    delivery of their messages), so any number of conversations can share the loop.
+
+    Parameters
+    ----------
+    name: string, optional
+        Name of the thread. Default: "asyncio"
+    """
+
+    def __init__(self, name="asyncio"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """Schedules a coroutine on the loop from any thread.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def responsive(self, timeout=5):
+        """Returns True if the loop runs a callback within `timeout` seconds (it isn't blocked)."""
+        if not self._thread.is_alive():
+            return False
+        done = threading.Event()
+        self.loop.call_soon_threadsafe(done.set)
+        return done.wait(timeout)
+
+    def stop(self, timeout=None):
+        """Stops the loop (pending handlers are dropped) and waits for the thread."""
+        if self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
+
+
+def run(coroutine):
+    """Runs a coroutine to completion on the calling thread (threaded modes). Every thread
+    gets its own event loop, which is reused for all coroutines run on the thread."""
+    loop = getattr(_local, "loop", None)
+    if loop is None:
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
@@ -0,0 +1,65 @@
+# Texts and button labels of the bot personas. One process can serve several personas (each with its
+# own bot token), see BOT_PERSONAS in telegram_bot.py.
+#
+# Texts are format strings; available fields: {first_name} (of the user), {api_prefix} (stage
+# prefix of the web links, e.g. "dev."), {max_mb} (largest file accepted, in media_too_large) and
+# {url} (of the result, in case_resolved and search_result), {title} (of a case, in search_result), {results}
+# (the search_result lines, in search_results) and {query} (in search_empty).
+
+DEFAULT_PERSONA = "default"
+
+TEXTS = {
+    "default": {
+        "hello": """
+        Hi {first_name}, hier ist Derrick - die tüchtige Assistenz des DetektivKollektivs. Danke, dass du dich an uns wendest! 🤩
+        \nBevor du einen Fall an unsere Detektiv*innen weiterleiten kannst, müsstest du erst unserer <a href='https://{api_prefix}detective-collective.org/data-privacy'>Datenschutzerklärung</a> zustimmen.
+        """,
+        "gdpr_question": "Bist du mit der Datenschutzerklärung einverstanden?",
+        "gdpr_accepted": "Super, dann kann's ja losgehen! Schicke mir bitte jetzt die Nachricht, die du überprüfen lassen möchtest.",
+        "gdpr_denied": "Alles klar. Schau doch mal in unser Archiv auf https://{api_prefix}detective-collective.org/archive, vielleicht ist Dein Fall ja schon dabei!",
+        "add_info_question": "Möchtest du uns noch ein paar zusätzliche Informationen zu deinem Fall geben?",
+        "contact_question": "Alles klar! Wer hat dir die Nachricht geschickt?",
+        "frequency_question": "Okay. Wie oft hat dich die Nachricht insgesamt erreicht?",
+        "channel_question": "Okay. Auf welchem Weg hat dich die Nachricht erreicht?",
+        "submit_question": "Fertig! Möchtest du den Fall jetzt einreichen?",
+        "duplicate": "Diese Nachricht wurde uns schon gemeldet, unsere Detektiv*innen kümmern sich bereits darum! Schau doch mal in unser Archiv auf https://{api_prefix}detective-collective.org/archive, dort findest du den Fall, sobald er gelöst ist.",
+        "media_too_large": "Diese Datei ist leider zu groß, ich kann nur Dateien bis {max_mb} MB annehmen. Schicke mir bitte eine kleinere Datei oder die Nachricht als Text.",
+        "media_failed": "Diese Datei konnte ich leider nicht speichern. Versuche es bitte noch einmal oder schicke mir die Nachricht als Text.",
+        "submitted": "Vielen Dank, dein Fall wurde nun eingereicht! Wir melden uns bei dir, sobald unsere Detektiv*innen Deinen Fall gelöst haben.",
+        "case_resolved": "Gute Nachrichten: Unsere Detektiv*innen haben deinen Fall gelöst! 🕵️ Das Ergebnis findest du hier: {url}",
+        "rate_limited": "Nicht so schnell! 🐌 Du hast mir gerade sehr viele Nachrichten geschickt, warte bitte eine Minute, bevor du weitermachst.",
+        "search_usage": "Schreibe hinter /search, wonach du im Archiv suchen möchtest, z.B. \"/search Impfung\". 🔎",
+        "search_result": "• {title}\n{url}",
+        "search_results": "Diese gelösten Fälle habe ich im Archiv gefunden: 🔎\n\n{results}",
+        "search_empty": "Zu \"{query}\" habe ich leider keinen gelösten Fall gefunden. Schicke mir die Nachricht mit /start, dann kümmern sich unsere Detektiv*innen darum!",
+    },
+}
+
+# Same texts without emojis
+TEXTS["plain"] = dict(
+    TEXTS["default"],
+    hello="""
+        Hi {first_name}, hier ist Derrick - die tüchtige Assistenz des DetektivKollektivs. Danke, dass du dich an uns wendest!
+        \nBevor du einen Fall an unsere Detektiv*innen weiterleiten kannst, müsstest du erst unserer <a href='https://{api_prefix}detective-collective.org/data-privacy'>Datenschutzerklärung</a> zustimmen.
+        """,
+    gdpr_denied="Alles klar. Schau doch mal in unser Archiv auf detektivkollektiv.de, vielleicht ist Dein Fall ja schon dabei!",
+    duplicate="Diese Nachricht wurde uns schon gemeldet, unsere Detektiv*innen kümmern sich bereits darum! Schau doch mal in unser Archiv auf detektivkollektiv.de, dort findest du den Fall, sobald er gelöst ist.",
+    case_resolved="Gute Nachrichten: Unsere Detektiv*innen haben deinen Fall gelöst! Das Ergebnis findest du hier: {url}",
+    rate_limited="Nicht so schnell! Du hast mir gerade sehr viele Nachrichten geschickt, warte bitte eine Minute, bevor du weitermachst.",
+    search_usage="Schreibe hinter /search, wonach du im Archiv suchen möchtest, z.B. \"/search Impfung\".",
+    search_results="Diese gelösten Fälle habe ich im Archiv gefunden:\n\n{results}",
+)
+
+# Button labels that differ from the default ones (which are defined with the menus)
+LABELS = {
+    "default": {},
+    "plain": {
+        "überspringen ⏩": "überspringen",
+        "⏪ zurück": "zurück",
+        "anderer Messenger 📱": "anderer Messenger",
+        "anderes soziales Netzwerk 📢": "anderes soziales Netzwerk",
+        "Internet allgemein (z.B. Nachrichtenseite) 💻": "Internet allgemein (z.B. Nachrichtenseite)",
+        "mündlich im Gespräch 💬": "mündlich im Gespräch",
+        "Ja! ✔️": "Ja!",
+    },
+}
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import ConversationHandler, TypeHandler
+from telegram.utils.promise import Promise
+
+logger = logging.getLogger(__name__)
+
+
+class IdleConversationHandler(ConversationHandler):
+    """ConversationHandler that ends conversations which got no update for `idle_timeout` seconds
+    and doesn't keep the promises of finished handlers.
+
+    PTB's `conversation_timeout` schedules a JobQueue job per conversation, which keeps the last
+    update and context of every open conversation in memory. Instead, the time of the last update
+    of every conversation is kept in an ordered dict (oldest first), and `sweep`, which is run
+    periodically, ends the idle conversations from the front of it. `on_idle(key)` is called for
+    every idle conversation, also for the ones that have already ended, so that their user data
+    can be dropped.
+
+    A handler that runs asynchronously returns a `Promise`, which PTB only resolves to the next
+    state when the next update of the conversation arrives. Until then the promise (with its
+    future, task and locks) stays in memory, for abandoned conversations forever. `sweep` also
+    replaces the promises of finished handlers by their states.
+
+    PTB drops the updates of a conversation that arrive while its handler is still running (unless
+    a handler for the `WAITING` state takes them). With `replay` they are kept instead and, once the
+    handler has finished (see `finished`), passed to `replay` in the order they arrived, to be
+    dispatched again.
+
+    Parameters
+    ----------
+    idle_timeout: float, optional
+        Seconds without an update after which a conversation is ended. Default: 6 hours
+    on_idle: function, optional
+        Called with the key of every conversation that was idle for `idle_timeout`
+    replay: function, optional
+        Called with every update that waited for the handler of its conversation
+    """
+
+    def __init__(self, *args, idle_timeout=6 * 3600, on_idle=None, replay=None, **kwargs):
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.replay = replay
+        self._last_seen = OrderedDict()
+        self._promised = set()
+        self._last_seen_lock = threading.Lock()
+        # Updates by conversation key that arrived while its handler was running, oldest first
+        self._waiting = {}
+        self._waiting_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+        if replay is not None:
+            self.states.setdefault(self.WAITING, []).append(TypeHandler(Update, self._wait))
+
+    @property
+    def conversations(self):
+        return self._conversations
+
+    @conversations.setter
+    def conversations(self, value):
+        # Conversations loaded by the persistence are idle from now on
+        now = time.monotonic()
+        with self._last_seen_lock:
+            self._last_seen = OrderedDict((key, now) for key in value)
+        ConversationHandler.conversations.fset(self, value)
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        key = check_result[0]
+        with self._last_seen_lock:
+            self._last_seen[key] = time.monotonic()
+            self._last_seen.move_to_end(key)
+        return super().handle_update(update, dispatcher, check_result, context)
+
+    def update_state(self, new_state, key):
+        super().update_state(new_state, key)
+        if isinstance(new_state, Promise):
+            with self._last_seen_lock:
+                self._promised.add(key)
+
+    def _resolve(self, key):
+        """Replaces the promise of a finished handler by the state it returned, like
+        `check_update` does. Returns the state, or None if the handler is still running.
+        Requires the conversations lock."""
+        state = self._conversations.get(key)
+        if not isinstance(state, tuple):
+            return state if state is not None else self.END
+        old_state, promise = state
+        if not promise.done.is_set():
+            return None
+        new_state = promise.result(0) if promise.exception is None else None
+        new_state = old_state if new_state is None else new_state
+        new_state = self.END if new_state is None else new_state
+        if new_state == self.END:
+            del self._conversations[key]
+        else:
+            self._conversations[key] = new_state
+        if self.persistent:
+            self.persistence.update_conversation(self.name, key, None if new_state == self.END else new_state)
+        return new_state
+
+    def running_promise(self, update):
+        """Returns the promise of the handler that is still running for the conversation of an
+        update (e.g. the one the update has just started), or None."""
+        if self.per_chat and update.effective_chat is None:
+            return None
+        key = self._get_key(update)
+        with self._conversations_lock:
+            state = self._conversations.get(key)
+        if isinstance(state, tuple) and not state[1].done.is_set():
+            return state[1]
+        return None
+
+    def is_waiting(self, update):
+        """Returns True if the update waits for the handler of its conversation."""
+        key = self._key_of(update)
+        with self._waiting_lock:
+            return any(waiting is update for waiting in self._waiting.get(key, ()))
+
+    def take_waiting(self):
+        """Removes the updates that wait for the handlers of their conversations (e.g. to hand them
+        off on shutdown) and returns them."""
+        with self._waiting_lock:
+            waiting, self._waiting = self._waiting, {}
+        return [update for updates in waiting.values() for update in updates]
+
+    def finished(self, update):
+        """Called once the handler for the conversation of an update has finished (its promise is
+        done): replays the updates that waited for it."""
+        key = self._key_of(update)
+        if key is not None:
+            self._replay(key)
+
+    def _key_of(self, update):
+        if (self.per_chat and update.effective_chat is None) or (self.per_user and update.effective_user is None):
+            return None
+        return self._get_key(update)
+
+    def _wait(self, update, context):
+        key = self._key_of(update)
+        with self._waiting_lock:
+            self._waiting.setdefault(key, []).append(update)
+        # The handler may have finished after `check_update` looked at it
+        if self.running_promise(update) is None:
+            self._replay(key)
+
+    def _replay(self, key):
+        # Under the lock, so an update is either waiting or already passed to `replay` (see `is_waiting`).
+        # The first update starts the next handler, the ones after it wait for that one again.
+        with self._waiting_lock:
+            for update in self._waiting.pop(key, ()):
+                self.replay(update)
+
+    def in_conversation(self, update):
+        """Returns True if the update belongs to a conversation that hasn't ended."""
+        if (self.per_chat and update.effective_chat is None) or (self.per_user and update.effective_user is None):
+            return False
+        return self._get_key(update) in self._conversations
+
+    def resolve_promises(self):
+        """Replaces the promises of finished handlers by their states (which are reported to the
+        persistence)."""
+        with self._last_seen_lock:
+            promised, self._promised = self._promised, set()
+        running = []
+        for key in promised:
+            with self._conversations_lock:
+                if self._resolve(key) is None:
+                    running.append(key)
+        with self._last_seen_lock:
+            self._promised.update(running)
+
+    def sweep(self, now=None):
+        """Resolves the promises of finished handlers and ends the conversations that were idle
+        for longer than `idle_timeout`.
+
+        Returns
+        -------
+        int
+            Number of open conversations that were ended
+        """
+        now = time.monotonic() if now is None else now
+        self.resolve_promises()
+        idle = []
+        with self._last_seen_lock:
+            while self._last_seen:
+                key, last_seen = next(iter(self._last_seen.items()))
+                if now - last_seen < self.idle_timeout:
+                    break
+                del self._last_seen[key]
+                idle.append(key)
+
+        ended = 0
+        for key in idle:
+            with self._conversations_lock:
+                state = self._resolve(key)
+                if state is None:
+                    # A handler is still running, look again after the next timeout
+                    with self._last_seen_lock:
+                        self._last_seen[key] = now
+                    continue
+                if state != self.END:
+                    del self._conversations[key]
+                    if self.persistent:
+                        self.persistence.update_conversation(self.name, key, None)
+                    ended += 1
+            if self.on_idle:
+                self.on_idle(key)
+
+        if ended:
+            logger.info("Ended %s idle conversation(s) of %s", ended, self.name)
+        return ended
@@ -0,0 +1,165 @@
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict, namedtuple
+
+_WORD = re.compile(r"\w+")
+
+Duplicate = namedtuple("Duplicate", ["ref", "exact"])
+"""Indexed submission that matches a text: its reference and whether the normalized texts are equal."""
+
+
+def normalize(text):
+    """Reduces a text to its lower case words, so that whitespace, punctuation and emojis don't matter."""
+    return " ".join(_WORD.findall(unicodedata.normalize("NFKC", text).casefold()))
+
+
+def _digest(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+
+
+def minhash(tokens, shingle=2):
+    """MinHash signature of the word shingles of a text: the minimum values of 32 hash functions
+    (16 bit each, as 64 bytes). The share of equal values in two signatures estimates the Jaccard
+    similarity of the two sets of shingles.
+
+    The 32 hash functions are the 16 bit words of one 64 byte BLAKE2b digest per shingle.
+    """
+    shingles = {" ".join(tokens[i:i + shingle]) for i in range(max(1, len(tokens) - shingle + 1))}
+    hashes = [memoryview(hashlib.blake2b(s.encode()).digest()).cast("H") for s in shingles]
+    return array("H", map(min, zip(*hashes))).tobytes()
+
+
+def similarity(signature, other):
+    """Estimated Jaccard similarity of the texts of two MinHash signatures."""
+    a, b = memoryview(signature).cast("H"), memoryview(other).cast("H")
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class DuplicateIndex:
+    """In-memory index of recently submitted texts, which finds repeated submissions of the same
+    (e.g. forwarded) message.
+
+    Texts match exactly if their normalized forms are equal, or nearly if both have at least
+    `min_tokens` words and the Jaccard similarity of their word pairs (estimated by MinHash) is at
+    least `min_similarity`. Near duplicates are found by locality sensitive hashing: the first
+    values of the signatures are grouped into bands of two, and only entries that share a band
+    with the text are compared.
+
+    The index holds at most `max_items` texts. Entries expire `ttl` seconds after the text was
+    last added or found, and the least recently used entries are evicted first.
+
+    Parameters
+    ----------
+    max_items: int, optional
+        Maximum number of indexed texts. Default: 100000
+    ttl: float, optional
+        Seconds after which an entry that wasn't seen again expires. Default: 30 days
+    min_similarity: float, optional
+        Minimum estimated Jaccard similarity of near duplicates. Default: 0.7
+    min_tokens: int, optional
+        Minimum number of words of texts that are matched nearly. Default: 8
+    """
+
+    # With 4 bands of 2 values, texts with a similarity of 0.7 share a band with a probability
+    # of 93% (0.9 -> 99.9%, 0.3 -> 32%)
+    BANDS = 4
+    BAND_BYTES = 4
+
+    def __init__(self, max_items=100000, ttl=30 * 24 * 3600, min_similarity=0.7, min_tokens=8):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.min_tokens = min_tokens
+
+        # digest of the normalized text -> [signature or None, ref, expires], least recently used first
+        self._entries = OrderedDict()
+        # per band: band value -> digest of the entry, or a list of digests if several entries share it
+        self._bands = [{} for _ in range(self.BANDS)]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fingerprint(self, text, near=True):
+        tokens = normalize(text).split()
+        signature = minhash(tokens) if near and len(tokens) >= self.min_tokens else None
+        return _digest(" ".join(tokens)), signature
+
+    def _band_keys(self, signature):
+        size = self.BAND_BYTES
+        return [signature[i * size:(i + 1) * size] for i in range(self.BANDS)]
+
+    def find(self, text, near=True):
+        """Returns the `Duplicate` of an indexed text that matches `text` (only exactly unless
+        `near`), or None."""
+        digest, signature = self._fingerprint(text, near)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(digest)
+            exact = entry is not None
+            if not exact and signature is not None:
+                digest = self._find_near(signature)
+                entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            # Texts that keep coming in stay in the index
+            entry[2] = now + self.ttl
+            self._entries.move_to_end(digest)
+            return Duplicate(entry[1], exact)
+
+    def _find_near(self, signature):
+        best, best_similarity = None, self.min_similarity
+        for band, key in zip(self._bands, self._band_keys(signature)):
+            digests = band.get(key)
+            if digests is None:
+                continue
+            for digest in digests if isinstance(digests, list) else (digests,):
+                candidate = similarity(signature, self._entries[digest][0])
+                if candidate >= best_similarity:
+                    best, best_similarity = digest, candidate
+        return best
+
+    def add(self, text, ref, near=True):
+        """Indexes a submitted text under a reference (e.g. the key of the submission). Without
+        `near` it is only found by texts that match it exactly."""
+        digest, signature = self._fingerprint(text, near)
+        now = time.monotonic()
+        with self._lock:
+            if digest in self._entries:
+                self._remove(digest)
+            self._entries[digest] = [signature, ref, now + self.ttl]
+            if signature is not None:
+                for band, key in zip(self._bands, self._band_keys(signature)):
+                    digests = band.get(key)
+                    if digests is None:
+                        band[key] = digest
+                    elif isinstance(digests, list):
+                        digests.append(digest)
+                    else:
+                        band[key] = [digests, digest]
+            self._expire(now)
+
+    def _expire(self, now):
+        while self._entries:
+            digest, entry = next(iter(self._entries.items()))
+            if entry[2] > now and len(self._entries) <= self.max_items:
+                break
+            self._remove(digest)
+
+    def _remove(self, digest):
+        signature = self._entries.pop(digest)[0]
+        if signature is None:
+            return
+        for band, key in zip(self._bands, self._band_keys(signature)):
+            digests = band[key]
+            if isinstance(digests, list):
+                digests.remove(digest)
+                if len(digests) == 1:
+                    band[key] = digests[0]
+            else:
+                del band[key]
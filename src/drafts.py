@@ -0,0 +1,103 @@
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class Draft:
+    """Answers of a user's conversation until the item is submitted, kept in `user_data["draft"]`.
+
+    A record with fixed fields needs less memory than a dict per conversation. The persistence
+    stores it as the dict of `to_dict`. The content is either kept in `content` or, if it is long,
+    in a file of the `ContentStore` named `content_file`. `media` describes an uploaded file and
+    `forward` the origin of a forwarded message (both dicts, see media.py). `file_unique_id`
+    identifies the file in the duplicate index; it isn't submitted.
+    """
+
+    __slots__ = ("content", "content_file", "media", "forward", "contact", "frequency", "channel", "file_unique_id")
+
+    def __init__(self, content=None, content_file=None, media=None, forward=None, contact=None, frequency=None,
+                 channel=None, file_unique_id=None):
+        self.content = content
+        self.content_file = content_file
+        self.media = media
+        self.forward = forward
+        self.contact = contact
+        self.frequency = frequency
+        self.channel = channel
+        self.file_unique_id = file_unique_id
+
+    def to_dict(self):
+        """The fields that are set."""
+        return {field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{field: data[field] for field in cls.__slots__ if field in data})
+
+    def submission(self, store):
+        """The payload of the item submission: the content (text, media and forward origin) and the
+        answers that weren't skipped."""
+        submission = {"content": store.content(self), "media": self.media, "forward": self.forward,
+                      "contact": self.contact, "frequency": self.frequency, "channel": self.channel}
+        return {key: value for key, value in submission.items() if value is not None and value != "skip"}
+
+
+class ContentStore:
+    """Keeps the texts of the drafts: texts longer than `max_chars` are truncated, texts longer
+    than `inline_chars` are written to a file in `directory` instead of being kept in memory (and
+    in the persisted user data).
+
+    Parameters
+    ----------
+    directory: string
+        Directory of the files, created with the first file if it doesn't exist
+    inline_chars: int, optional
+        Longest text kept in memory. Default: 1024
+    max_chars: int, optional
+        Longest text that is kept at all (Telegram messages have at most 4096). Default: 4096
+    """
+
+    def __init__(self, directory, inline_chars=1024, max_chars=4096):
+        self.directory = directory
+        self.inline_chars = inline_chars
+        self.max_chars = max_chars
+        self._directory_created = False
+
+    def set_content(self, draft, text):
+        """Sets the content of a draft, replacing (and deleting the file of) the previous one."""
+        self.discard(draft)
+        if len(text) > self.max_chars:
+            logger.info("Content of %s characters truncated to %s", len(text), self.max_chars)
+            text = text[:self.max_chars]
+        if len(text) > self.inline_chars:
+            if not self._directory_created:
+                os.makedirs(self.directory, exist_ok=True)
+                self._directory_created = True
+            name = "{}.txt".format(uuid.uuid4().hex)
+            with open(os.path.join(self.directory, name), "w", encoding="utf-8") as f:
+                f.write(text)
+            draft.content_file = name
+        else:
+            draft.content = text
+
+    def content(self, draft):
+        """Returns the content of a draft (or None if the file is gone)."""
+        if draft.content_file is None:
+            return draft.content
+        try:
+            with open(os.path.join(self.directory, draft.content_file), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            logger.warning("Content file %s of a draft is missing", draft.content_file)
+            return None
+
+    def discard(self, draft):
+        """Removes the content of a draft."""
+        if draft.content_file is not None:
+            try:
+                os.remove(os.path.join(self.directory, draft.content_file))
+            except FileNotFoundError:
+                pass
+        draft.content = draft.content_file = None
@@ -0,0 +1,72 @@
+import json
+import logging
+import threading
+
+from metrics import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+
+class Health:
+    """Liveness and readiness of the process, for the health checks of the orchestrator.
+
+    The process is ready once it receives and handles updates, and stops being ready when it
+    starts to shut down, so no traffic is sent to it before and after. It is alive as long as all
+    checks added with `add_check` pass; a failing check (e.g. a stuck event loop) means the
+    process should be restarted. The checks aren't run while the process shuts down.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.stopping = False
+        self._checks = []
+        self._lock = threading.Lock()
+
+    def add_check(self, name, check):
+        """Adds a liveness check: `check()` returns True if the part `name` works."""
+        with self._lock:
+            self._checks.append((name, check))
+
+    def failing(self):
+        """Names of the failing liveness checks."""
+        if self.stopping:
+            return []
+        with self._lock:
+            checks = list(self._checks)
+        failing = []
+        for name, check in checks:
+            try:
+                if not check():
+                    failing.append(name)
+            except Exception:
+                logger.exception("Health check %s failed", name)
+                failing.append(name)
+        return failing
+
+
+HEALTH = Health()
+
+
+class HealthHandler(MetricsHandler):
+    """Serves /healthz (liveness) and /readyz (readiness) next to /metrics, with 200 or 503."""
+    health = HEALTH
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/healthz":
+            failing = self.health.failing()
+            self._send_status(not failing, {"status": "failing", "checks": failing} if failing else {"status": "ok"})
+        elif path == "/readyz":
+            ready = self.health.ready and not self.health.stopping
+            self._send_status(ready, {"status": "ready" if ready else "stopping" if self.health.stopping
+                                      else "starting"})
+        else:
+            super().do_GET()
+
+    def _send_status(self, ok, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200 if ok else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,219 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import time
+from logging.handlers import QueueListener
+
+from metrics import Counter
+
+LOG_RECORDS = Counter("bot_log_records_total", "Log records written by the log writer thread", ("level",))
+LOG_DROPPED = Counter("bot_log_records_dropped_total", "Log records that were sampled out or didn't fit into the queue",
+                      ("reason",))
+LOG_SECONDS = Counter("bot_log_seconds_total",
+                      "Time the logging threads spent on log records (creating and queueing them)")
+
+# Fields with personal data: user names are replaced by a pseudonym, texts (and the bodies of responses, which
+# may echo them) by their length and a pseudonym. Personal data must not be passed as arguments of the message,
+# which aren't redacted.
+PSEUDONYMIZED_FIELDS = {"user", "username", "first_name"}
+TEXT_FIELDS = {"content", "text", "caption", "query", "body"}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def event(name, **fields):
+    """Returns the `extra` of a structured log record, e.g.
+
+        logger.info("User provided contact", extra=event("contact", user=user.username, contact=data))
+
+    Field values can be functions (without arguments), which are only called when the record is
+    written.
+    """
+    return {"event": name, "fields": fields}
+
+
+def sampled(rate):
+    """Whether a verbose record should be logged, with probability `rate`:
+
+        if sampled(LOG_SAMPLE_RATE):
+            logger.info(...)
+
+    Deciding before the call saves creating the record, which costs more than queueing it.
+    """
+    if rate >= 1.0 or random.random() < rate:
+        return True
+    LOG_DROPPED.inc("sampled")
+    return False
+
+
+class Redactor:
+    """Replaces personal data in log fields: user names by a keyed hash (the same name gets the
+    same pseudonym, so a user's records can be followed) and texts by their length and hash.
+
+    Parameters
+    ----------
+    key: bytes, optional
+        Key of the hash. Default: random, i.e. pseudonyms change when the process restarts
+    """
+
+    def __init__(self, key=None):
+        self.key = key or os.urandom(16)
+
+    def pseudonym(self, value):
+        return hashlib.blake2b(str(value).encode("utf-8"), key=self.key, digest_size=6).hexdigest()
+
+    def redact(self, name, value):
+        if callable(value):
+            value = value()
+        if value is None:
+            return None
+        if name in PSEUDONYMIZED_FIELDS:
+            return self.pseudonym(value)
+        if name in TEXT_FIELDS:
+            return {"chars": len(value), "hash": self.pseudonym(value)}
+        return value
+
+
+class _FieldsMixin:
+
+    def fields(self, record):
+        """The (evaluated and redacted) fields of a record."""
+        fields = {}
+        if getattr(record, "event", None) is not None:
+            fields["event"] = record.event
+        for name, value in getattr(record, "fields", {}).items():
+            if self.redactor:
+                fields[name] = self.redactor.redact(name, value)
+            else:
+                fields[name] = value() if callable(value) else value
+        return fields
+
+
+class JsonFormatter(_FieldsMixin, logging.Formatter):
+    """Formats a record as one line of JSON with time, level, logger, thread, message, the fields
+    of the record and the exception.
+
+    Parameters
+    ----------
+    redactor: Redactor, optional
+        Redacts the fields with personal data. Default: None (fields are written as they are)
+    """
+
+    def __init__(self, redactor=None):
+        super().__init__()
+        self.redactor = redactor
+
+    def format(self, record):
+        entry = {
+            "time": "{}.{:03d}Z".format(time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)),
+                                        int(record.msecs)),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(self.fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(_FieldsMixin, logging.Formatter):
+    """The classic text format, with the fields of the record appended as key=value."""
+
+    def __init__(self, redactor=None):
+        super().__init__(TEXT_FORMAT)
+        self.redactor = redactor
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = self.fields(record)
+        if fields:
+            message += " " + " ".join("{}={}".format(name, json.dumps(value, default=str, ensure_ascii=False))
+                                      for name, value in fields.items())
+        return message
+
+
+class _QueueHandler(logging.Handler):
+    """Puts records on the log queue as they are. Unlike `logging.handlers.QueueHandler` it
+    doesn't format them, so the message, the fields and the exception are rendered on the writer
+    thread, and it doesn't take a lock. Records are dropped (and counted) when the queue is full
+    instead of blocking the caller. Filters of the handler are not applied."""
+
+    def __init__(self, log_queue, max_size):
+        super().__init__()
+        self.queue = log_queue
+        self.max_size = max_size
+
+    def handle(self, record):
+        if self.queue.qsize() < self.max_size:
+            self.queue.put(record)
+        else:
+            LOG_DROPPED.inc("queue_full")
+        # `created` is taken when the record is created, so this includes the creation
+        LOG_SECONDS.inc(amount=time.time() - record.created)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+
+class _QueueListener(QueueListener):
+
+    def handle(self, record):
+        LOG_RECORDS.inc(record.levelname)
+        super().handle(record)
+
+
+def setup(level="INFO", format="json", redact=True, key=None, queue_size=10000):
+    """Routes all log records through a bounded queue to a writer thread, which formats them and
+    writes them to stderr. The logging threads (handlers, dispatcher, senders) only create the
+    record and queue it. Records still queued are written when the process exits.
+
+    Arguments of records are formatted later on the writer thread, so they should not be
+    changed after logging them.
+
+    Parameters
+    ----------
+    level: string, optional
+        Level of the root logger. Default: "INFO"
+    format: string, optional
+        "json" (one object per line) or "text". Default: "json"
+    redact: bool, optional
+        Redact personal data in the fields of the records (see `Redactor`). Default: True
+    key: string, optional
+        Key of the pseudonyms, so they stay the same across restarts and processes. Default: random
+    queue_size: int, optional
+        Maximum number of queued records. Default: 10000
+
+    Returns
+    -------
+    logging.handlers.QueueListener
+        The writer thread, already started
+    """
+    # The file and line of the caller and the process aren't logged, so don't look them up for every
+    # record (see "Optimization" in the logging documentation)
+    logging._srcfile = None
+    logging.logMultiprocessing = False
+    logging.logProcesses = False
+
+    redactor = Redactor(key.encode("utf-8") if key else None) if redact else None
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter(redactor) if format == "json" else TextFormatter(redactor))
+
+    # SimpleQueue is much cheaper than Queue, the handler keeps it below queue_size
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue, queue_size))
+    root.setLevel(level)
+
+    listener = _QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,195 @@
+import logging
+import mimetypes
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from telegram.utils.helpers import to_timestamp
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TRANSFERS = Counter("bot_media_transfers_total", "Media files streamed from Telegram to the media endpoint",
+                          ("kind", "result"))
+MEDIA_TRANSFER_SECONDS = Histogram("bot_media_transfer_seconds", "Duration of media transfers", ("kind",))
+MEDIA_BYTES = Counter("bot_media_bytes_total", "Bytes of media files transferred", ("kind",))
+
+# Attributes of a message with a file, in the order they are looked up. Animations are also sent
+# as documents, so they have to come first.
+MEDIA_KINDS = ("photo", "video", "animation", "voice", "audio", "video_note", "document")
+
+
+class MediaError(Exception):
+    pass
+
+
+class MediaTooLarge(MediaError):
+    pass
+
+
+def message_media(message):
+    """Returns (kind, file) of the file attached to a message (for photos the largest size), or None."""
+    for kind in MEDIA_KINDS:
+        media = getattr(message, kind, None)
+        if media:
+            return kind, media[-1] if kind == "photo" else media
+    return None
+
+
+def forward_origin(message):
+    """Returns where a forwarded message comes from (chat and date), or None if it wasn't forwarded.
+
+    Only chats (channels, groups) are named; for messages forwarded from users just the type
+    "private" is kept, since they didn't agree to the privacy policy.
+    """
+    if message.forward_date is None:
+        return None
+    origin = {"date": to_timestamp(message.forward_date)}
+    chat = message.forward_from_chat
+    if chat is not None:
+        origin.update(chat_id=chat.id, chat_type=chat.type, chat_title=chat.title, chat_username=chat.username,
+                      message_id=message.forward_from_message_id, signature=message.forward_signature)
+    else:
+        origin["chat_type"] = "private"
+    return {key: value for key, value in origin.items() if value is not None}
+
+
+class _CappedReader:
+    """File-like view of a download that fails once more than `max_bytes` have been read.
+    Requests streams file-like bodies with the length given by `__len__`."""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, raw, length, max_bytes):
+        self.raw = raw
+        self.length = length
+        self.max_bytes = max_bytes
+        self.read_bytes = 0
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        chunk = self.raw.read(None if size is None or size < 0 else size, decode_content=True)
+        self.read_bytes += len(chunk)
+        if self.read_bytes > self.max_bytes:
+            raise MediaTooLarge("File is larger than {} bytes".format(self.max_bytes))
+        return chunk
+
+    def __iter__(self):
+        # Used for chunked uploads if Telegram doesn't tell the size
+        while True:
+            chunk = self.read(self.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class MediaUploader:
+    """Streams files of submitted messages from Telegram's file API to the media endpoint.
+
+    Files are never held in memory: the download is read in chunks while it is uploaded with a
+    PUT to `<upload_url>/<random name>` (which works for the item API as well as for object
+    storage with a pre-authorized bucket URL). Files that Telegram reports as larger than
+    `max_bytes` aren't downloaded at all, transfers that turn out larger are aborted. At most
+    `max_transfers` files are transferred at once, further transfers wait for a free worker.
+
+    Uploads of conversations that are never submitted stay on the media endpoint, which should
+    expire files that no item refers to.
+
+    Parameters
+    ----------
+    upload_url: string
+        URL the files are uploaded to, e.g. "https://api.dev.detective-collective.org/media"
+    max_bytes: int, optional
+        Largest file that is transferred. Default: 20 MB (bots can't download larger files)
+    max_transfers: int, optional
+        Number of concurrent transfers. Default: 4
+    timeout: tuple, optional
+        (connect, read) timeout of the download and the upload in seconds. Default: (3.05, 30)
+    """
+
+    def __init__(self, upload_url, max_bytes=20 * 2 ** 20, max_transfers=4, timeout=(3.05, 30)):
+        self.upload_url = upload_url.rstrip("/")
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        # A download and an upload per transfer
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_transfers, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_transfers, thread_name_prefix="media")
+
+    def upload(self, bot, kind, media):
+        """Transfers a file (`telegram.PhotoSize`, `Video`, `Voice`, ...) on the uploader's threads.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the description of the uploaded file (kind, url, mime_type, size,
+            duration) or raises a `MediaError` (`MediaTooLarge` if the file exceeds `max_bytes`)
+        """
+        return self.executor.submit(self.transfer, bot, kind, media)
+
+    def transfer(self, bot, kind, media):
+        """Transfers a file. Blocks the calling thread; use `upload` from handlers."""
+        start = time.perf_counter()
+        try:
+            uploaded = self._transfer(bot, kind, media)
+        except MediaTooLarge:
+            MEDIA_TRANSFERS.inc(kind, "too_large")
+            raise
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError, MediaError) as e:
+            MEDIA_TRANSFERS.inc(kind, "failed")
+            raise MediaError("Transfer of {} failed: {}".format(kind, e)) from e
+        MEDIA_TRANSFERS.inc(kind, "uploaded")
+        MEDIA_BYTES.inc(kind, amount=uploaded["size"])
+        MEDIA_TRANSFER_SECONDS.observe(time.perf_counter() - start, kind)
+        return uploaded
+
+    def _transfer(self, bot, kind, media):
+        if (media.file_size or 0) > self.max_bytes:
+            raise MediaTooLarge("{} of {} bytes is larger than {} bytes".format(kind, media.file_size, self.max_bytes))
+        try:
+            file = bot.get_file(media.file_id)
+        except Exception as e:
+            # getFile answers "file is too big" for files above the Bot API's download limit
+            raise MediaError("getFile failed: {}".format(e)) from e
+
+        mime_type = getattr(media, "mime_type", None) or ("image/jpeg" if kind == "photo" else
+                                                           "application/octet-stream")
+        extension = mimetypes.guess_extension(mime_type) or ""
+        url = "{}/{}{}".format(self.upload_url, uuid.uuid4().hex, extension)
+
+        # The URL of the file contains the bot token, so neither it nor the errors of requests
+        # (which name the URL) are logged
+        try:
+            download = self.session.get(file.file_path, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise MediaError("Download failed: {}".format(type(e).__name__)) from None
+        with download:
+            if download.status_code != 200:
+                raise MediaError("Download answered with HTTP {}".format(download.status_code))
+            length = file.file_size or int(download.headers.get("Content-Length") or 0)
+            if length > self.max_bytes:
+                raise MediaTooLarge("{} of {} bytes is larger than {} bytes".format(kind, length, self.max_bytes))
+            body = _CappedReader(download.raw, length, self.max_bytes)
+            response = self.session.put(url, data=body if length else iter(body),
+                                        headers={"Content-Type": mime_type}, timeout=self.timeout)
+        if response.status_code >= 400:
+            raise MediaError("Upload answered with HTTP {}".format(response.status_code))
+
+        logger.info("Uploaded %s of %s bytes to %s", kind, body.read_bytes, url)
+        uploaded = {"kind": kind, "url": response.headers.get("Location", url), "mime_type": mime_type,
+                    "size": body.read_bytes, "duration": getattr(media, "duration", None)}
+        return {key: value for key, value in uploaded.items() if value is not None}
+
+    def close(self, wait=True):
+        """Waits for running transfers (if `wait`) and closes the connection pool."""
+        self.executor.shutdown(wait=wait)
+        self.session.close()
@@ -0,0 +1,201 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
+
+# Default histogram buckets (in seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 10, 30)
+
+
+class Registry:
+    """Collection of metrics that is rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + "}"
+
+
+class Counter:
+    """Monotonically increasing counter, e.g. handled updates per handler."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, labels), value)
+                for labels, value in sorted(values.items())]
+
+
+class Histogram:
+    """Distribution of observed values (e.g. latencies) in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                # one count per bucket, +Inf, sum
+                counts = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *labelvalues):
+        """Context manager that observes the duration of its block."""
+        return _Timer(self, labelvalues)
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        lines = []
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labelnames, labels, [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labelnames, labels), counts[-1]))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class _Timer:
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+
+class Gauge:
+    """Current value that is read when the metrics are scraped, e.g. a queue length.
+
+    Parameters
+    ----------
+    collect: callable
+        Returns a dict of label value tuples to the current values
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), collect=None, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.collect = collect
+        registry.register(self)
+
+    def samples(self):
+        try:
+            values = self.collect()
+        except Exception:
+            logger.exception("Could not collect gauge %s", self.name)
+            return []
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, labels), value)
+                for labels, value in sorted(values.items())]
+
+
+TELEGRAM_API_SECONDS = Histogram("bot_telegram_api_request_seconds",
+                                 "Duration of outgoing Bot API requests", ("method",))
+TELEGRAM_API_ERRORS = Counter("bot_telegram_api_errors_total",
+                              "Failed outgoing Bot API requests", ("method", "error"))
+
+
+class InstrumentedRequest(Request):
+    """Bot API connection pool that records the duration and errors of every request by method."""
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        except Exception as e:
+            TELEGRAM_API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - start, method)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def start_http_server(port, listen="0.0.0.0", handler=MetricsHandler):
+    """Serves the metrics on http://listen:port/metrics from a background thread."""
+    server = ThreadingHTTPServer((listen, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,279 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import wait
+
+import requests
+from telegram.error import BadRequest, Unauthorized
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+RESOLVED_CASES = Counter("bot_resolved_cases_total", "Resolved cases reported by the item API")
+NOTIFICATIONS = Counter("bot_case_notifications_total", "Notifications about resolved cases", ("result",))
+FAN_OUT_SECONDS = Histogram("bot_case_fan_out_seconds", "Time to notify all subscribers of a resolved case")
+
+
+class SubscriberIndex:
+    """SQLite index of the chats to notify when a case is resolved.
+
+    Chats subscribe to a submission by its idempotency key (the item id is only known once the
+    item API has answered) and `resolve` maps the key to the item id. Several submissions can
+    belong to the same item (the API merges repeated submissions), and users whose message was
+    already submitted subscribe to the earlier submission. The subscribers of an item are read
+    through the index on the item id and the primary key (key, chat id), so a case with thousands
+    of subscribers doesn't need a table scan.
+
+    Resolved cases are stored before they are fanned out, so a restart continues an interrupted
+    fan-out. Subscriptions of items that are never resolved expire after `ttl` seconds.
+
+    Parameters
+    ----------
+    path: string
+        Path of the SQLite database file, opened (and created) on first use
+    ttl: float, optional
+        Seconds after which subscriptions expire. Default: 180 days
+    """
+
+    def __init__(self, path, ttl=180 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def _conn(self):
+        # Opened on first use (with the lock held), so creating the index doesn't create the file
+        if self._connection is None:
+            self._connection = self._connect()
+        return self._connection
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS subscribers (
+                submission TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                persona TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (submission, chat_id)
+            ) WITHOUT ROWID""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS submissions (
+                submission TEXT PRIMARY KEY,
+                item_id TEXT NOT NULL,
+                created REAL NOT NULL
+            ) WITHOUT ROWID""")
+        conn.execute("CREATE INDEX IF NOT EXISTS submissions_item ON submissions (item_id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS resolved (
+                item_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL
+            ) WITHOUT ROWID""")
+        conn.execute("CREATE TABLE IF NOT EXISTS cursor (id INTEGER PRIMARY KEY CHECK (id = 0), value TEXT)")
+        return conn
+
+    def subscribe(self, submission, chat_id, persona):
+        """Notifies `chat_id` (of the bot `persona`) when the item of a submission is resolved."""
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO subscribers (submission, chat_id, persona, created) "
+                               "VALUES (?, ?, ?, ?)", (submission, chat_id, persona, time.time()))
+
+    def resolve(self, submission, item_id):
+        """Records the item id the item API gave a submission."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO submissions (submission, item_id, created) VALUES (?, ?, ?)",
+                               (submission, str(item_id), time.time()))
+
+    def add_resolved(self, cases, cursor):
+        """Stores resolved cases (dicts with "id") for the fan-out together with the poll cursor."""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO resolved (item_id, payload) VALUES (?, ?)",
+                                   [(str(case["id"]), json.dumps(case)) for case in cases])
+            self._conn.execute("INSERT OR REPLACE INTO cursor (id, value) VALUES (0, ?)", (cursor,))
+
+    def cursor(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM cursor WHERE id = 0").fetchone()
+        return row[0] if row else None
+
+    def resolved(self):
+        """Returns the resolved cases whose fan-out hasn't finished."""
+        with self._lock:
+            rows = self._conn.execute("SELECT payload FROM resolved").fetchall()
+        return [json.loads(payload) for payload, in rows]
+
+    def subscribers(self, item_id, limit):
+        """Returns up to `limit` subscribers (submission, chat id, persona) of an item."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT s.submission, s.chat_id, s.persona FROM submissions i "
+                "JOIN subscribers s ON s.submission = i.submission WHERE i.item_id = ? LIMIT ?",
+                (str(item_id), limit)).fetchall()
+
+    def unsubscribe(self, subscribers):
+        """Removes notified subscribers (as returned by `subscribers`)."""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("DELETE FROM subscribers WHERE submission = ? AND chat_id = ?",
+                                   [(submission, chat_id) for submission, chat_id, _ in subscribers])
+
+    def finish(self, item_id):
+        """Forgets a case once all its subscribers were notified."""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM subscribers WHERE submission IN "
+                               "(SELECT submission FROM submissions WHERE item_id = ?)", (str(item_id),))
+            self._conn.execute("DELETE FROM submissions WHERE item_id = ?", (str(item_id),))
+            self._conn.execute("DELETE FROM resolved WHERE item_id = ?", (str(item_id),))
+
+    def expire(self, now=None):
+        """Removes the subscriptions older than `ttl`. Returns their number."""
+        before = (time.time() if now is None else now) - self.ttl
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            expired = self._conn.execute("DELETE FROM subscribers WHERE created < ?", (before,)).rowcount
+            self._conn.execute("DELETE FROM submissions WHERE created < ?", (before,))
+        return expired
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM subscribers").fetchone()[0]
+
+
+class CaseNotifier:
+    """Polls the item API for resolved cases and notifies their subscribers.
+
+    Every `poll_interval` seconds `GET <poll_url>?since=<cursor>` is requested, which answers
+    with the cases resolved since the cursor and the next cursor:
+
+        {"items": [{"id": 17, "url": "https://..."}, ...], "cursor": "..."}
+
+    (without cursor for the first request). The subscribers of a case are notified in batches
+    of `batch_size`: `notify(persona, chat_id, case)` queues the message (e.g. in the outbound
+    scheduler, which enforces the flood limits) and returns a future. The whole batch is queued
+    at once and waited for, then its subscribers are removed, so a restart repeats at most one
+    batch. Failed notifications (e.g. to users who blocked the bot, or of a persona that isn't
+    configured anymore) aren't repeated.
+
+    Parameters
+    ----------
+    index: SubscriberIndex
+    poll_url: string
+        URL of the resolved cases, e.g. "https://api.dev.detective-collective.org/resolved_items"
+    notify: function
+        Called with (persona, chat id, case), returns a `concurrent.futures.Future`
+    poll_interval: float, optional
+        Seconds between two polls. Default: 60
+    batch_size: int, optional
+        Notifications queued at once. Default: 500
+    timeout: tuple, optional
+        (connect, read) timeout of the poll request in seconds. Default: (3.05, 30)
+    """
+
+    def __init__(self, index, poll_url, notify, poll_interval=60, batch_size=500, timeout=(3.05, 30)):
+        self.index = index
+        self.poll_url = poll_url
+        self.notify = notify
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the poll thread. Fan-outs interrupted by the last stop are continued first."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="case_notifier", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the poll thread after its current batch."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.session.close()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+                for case in self.index.resolved():
+                    if self._stopped.is_set():
+                        break
+                    try:
+                        self.fan_out(case)
+                    except Exception:
+                        # Tried again after the next poll, the other cases go on
+                        logger.exception("Could not notify the subscribers of resolved case %s", case.get("id"))
+                expired = self.index.expire()
+                if expired:
+                    logger.info("%s subscription(s) to case notifications expired", expired)
+            except Exception:
+                logger.exception("Could not notify the subscribers of resolved cases")
+            if self._stopped.wait(self.poll_interval):
+                return
+
+    def poll(self):
+        """Fetches the cases resolved since the last poll and stores them for the fan-out."""
+        cursor = self.index.cursor()
+        try:
+            response = self.session.get(self.poll_url, params={"since": cursor} if cursor else None,
+                                        timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning("Polling resolved cases failed: %s", e)
+            return
+        if response.status_code != 200:
+            logger.warning("Polling resolved cases answered with HTTP %s", response.status_code)
+            return
+        data = response.json()
+        cases = [case for case in data.get("items", []) if "id" in case]
+        if cases or data.get("cursor") != cursor:
+            self.index.add_resolved(cases, data.get("cursor"))
+        RESOLVED_CASES.inc(amount=len(cases))
+
+    def fan_out(self, case):
+        """Notifies all subscribers of a resolved case, batch by batch."""
+        start = time.perf_counter()
+        notified = 0
+        while True:
+            if self._stopped.is_set():
+                # Continued after the next start
+                return
+            subscribers = self.index.subscribers(case["id"], self.batch_size)
+            if not subscribers:
+                break
+            futures = []
+            for _, chat_id, persona in subscribers:
+                try:
+                    futures.append(self.notify(persona, chat_id, case))
+                except Exception as e:
+                    # E.g. a persona that isn't configured anymore; the subscription is dropped with the batch
+                    logger.warning("Could not notify chat %s (persona %s) of resolved case %s: %s", chat_id, persona,
+                                   case["id"], e)
+                    NOTIFICATIONS.inc("failed")
+            wait(futures)
+            for future in futures:
+                error = future.exception()
+                if error is None:
+                    NOTIFICATIONS.inc("sent")
+                    notified += 1
+                elif isinstance(error, (Unauthorized, BadRequest)):
+                    # The user blocked the bot or the chat is gone
+                    NOTIFICATIONS.inc("unreachable")
+                else:
+                    NOTIFICATIONS.inc("failed")
+            self.index.unsubscribe(subscribers)
+        self.index.finish(case["id"])
+        FAN_OUT_SECONDS.observe(time.perf_counter() - start)
+        if notified:
+            logger.info("Notified %s subscriber(s) of resolved case %s", notified, case["id"])
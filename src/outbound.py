@@ -0,0 +1,318 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes (lower is sent first)
+PRIORITY_REPLY = 0
+PRIORITY_ACTION = 1
+# Notifications of many chats (e.g. about a resolved case) don't hold up the conversations
+PRIORITY_NOTIFICATION = 2
+
+OUTBOUND_WAIT_SECONDS = Histogram("bot_outbound_wait_seconds", "Time outgoing calls wait in the outbound scheduler",
+                                  ("method",))
+OUTBOUND_RETRY_AFTER = Counter("bot_outbound_retry_after_total", "Flood limit (429) responses of the Bot API")
+OUTBOUND_COALESCED = Counter("bot_outbound_coalesced_total", "Chat actions merged into an already queued one")
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average and bursts of up to `burst` calls."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until the next call is allowed."""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        """Blocks the bucket for `seconds`, e.g. after a 429 response."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def time_to_full(self, now):
+        """Seconds until the bucket has refilled completely."""
+        self._refill(now)
+        return max(0, self.burst - self.tokens) / self.rate
+
+
+class _Call:
+
+    def __init__(self, bot, chat_id, method, kwargs, priority):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class _Chat:
+
+    def __init__(self, chat_id, bucket):
+        self.chat_id = chat_id
+        self.bucket = bucket
+        self.calls = deque()
+        self.scheduled = False
+        self.in_flight = False
+
+
+class OutboundScheduler:
+    """Central scheduler for all outgoing Bot API calls of the handlers.
+
+    Handlers enqueue calls and never block; a small pool of sender threads makes the calls while
+    respecting Telegram's flood limits with token buckets: one global bucket and one per chat
+    (with a lower rate for groups). Calls of the same chat are sent in order, one at a time. Among
+    the chats that may send, the one whose next call has the highest priority lane goes first, so
+    conversation replies beat chat actions. Answers to callback and inline queries and chat actions
+    are no messages: they only count against the global bucket and are sent from a queue of their
+    own, so they don't wait behind the messages of their chat (e.g. the loading animation of a
+    pressed button stops right away). A `TYPING` action for a chat that already has one queued is
+    merged into the queued one. A 429 response pauses the global bucket (and the chat) for the
+    `retry_after` Telegram asks for and the call is tried again.
+
+    Parameters
+    ----------
+    senders: int, optional
+        Number of sender threads. Default: 4
+    global_rate: float, optional
+        Calls per second over all chats. Default: 30
+    chat_rate: float, optional
+        Calls per second per private chat. Default: 1
+    chat_burst: int, optional
+        Calls a private chat may send at once. Default: 3
+    group_rate: float, optional
+        Calls per second per group chat. Default: 20 / 60
+    """
+
+    def __init__(self, senders=4, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60):
+        self.senders = senders
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._global = TokenBucket(global_rate, global_rate)
+
+        self._chats = {}
+        self._ready = []
+        self._timers = []
+        self._idle = []
+        # Calls that aren't limited per chat: (priority, sequence, call), the queued chat actions by
+        # (chat id, action) and the number of these calls being sent
+        self._direct = []
+        self._actions = {}
+        self._direct_in_flight = 0
+        self._sequence = itertools.count()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def __len__(self):
+        """Number of calls waiting to be sent."""
+        return self._queued
+
+    def start(self):
+        for i in range(self.senders):
+            thread = threading.Thread(target=self._send_loop, name="outbound_{}".format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Sends the remaining calls and stops the sender threads."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def enqueue(self, bot, chat_id, method, priority=PRIORITY_REPLY, **kwargs):
+        """Queues the call `bot.<method>(chat_id=chat_id, **kwargs)`.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the result of the call
+        """
+        return self._put(_Call(bot, chat_id, method, dict(kwargs, chat_id=chat_id), priority))
+
+    def send_message(self, bot, chat_id, text, **kwargs):
+        return self.enqueue(bot, chat_id, "send_message", text=text, **kwargs)
+
+    def edit_message_text(self, bot, chat_id, message_id, text, **kwargs):
+        return self.enqueue(bot, chat_id, "edit_message_text", message_id=message_id, text=text, **kwargs)
+
+    def answer_callback_query(self, bot, chat_id, callback_query_id, **kwargs):
+        """Queues the answer to a callback query from the chat `chat_id`."""
+        call = _Call(bot, chat_id, "answer_callback_query", dict(kwargs, callback_query_id=callback_query_id),
+                     PRIORITY_REPLY)
+        return self._put_direct(call)
+
+    def answer_inline_query(self, bot, user_id, inline_query_id, results, **kwargs):
+        """Queues the answer to an inline query of the user `user_id` (inline queries have no chat)."""
+        call = _Call(bot, user_id, "answer_inline_query",
+                     dict(kwargs, inline_query_id=inline_query_id, results=results), PRIORITY_REPLY)
+        return self._put_direct(call)
+
+    def send_chat_action(self, bot, chat_id, action):
+        with self._cond:
+            call = self._actions.get((chat_id, action))
+            if call is not None:
+                OUTBOUND_COALESCED.inc()
+                return call.future
+            call = _Call(bot, chat_id, "send_chat_action", {"chat_id": chat_id, "action": action}, PRIORITY_ACTION)
+            self._actions[chat_id, action] = call
+            return self._put_direct(call)
+
+    def _put(self, call):
+        with self._cond:
+            self._chat(call.chat_id).calls.append(call)
+            self._queued += 1
+            self._schedule(self._chats[call.chat_id])
+        return call.future
+
+    def _put_direct(self, call):
+        with self._cond:
+            heapq.heappush(self._direct, (call.priority, next(self._sequence), call))
+            self._queued += 1
+            self._cond.notify()
+        return call.future
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            chat = self._chats[chat_id] = _Chat(chat_id, bucket)
+        return chat
+
+    def _schedule(self, chat):
+        """Puts a chat with queued calls on the ready heap, or forgets an idle chat once its
+        bucket is full again. Requires the lock."""
+        if chat.scheduled or chat.in_flight:
+            return
+        now = time.monotonic()
+        if chat.calls:
+            heapq.heappush(self._ready, (chat.calls[0].priority, next(self._sequence), chat.chat_id))
+            chat.scheduled = True
+            self._cond.notify()
+        elif chat.bucket.is_full(now):
+            del self._chats[chat.chat_id]
+        else:
+            # Looked at again by _next_call once the bucket has refilled
+            heapq.heappush(self._idle, (now + chat.bucket.time_to_full(now), chat.chat_id))
+
+    def _next_call(self):
+        """Waits for the next call that may be sent. Returns (chat, call), with chat None for the calls
+        that aren't limited per chat, or (None, None) once the scheduler is stopped and empty. Requires
+        the lock."""
+        while True:
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._timers)
+                chat = self._chats[chat_id]
+                heapq.heappush(self._ready, (chat.calls[0].priority, next(self._sequence), chat_id))
+            while self._idle and self._idle[0][0] <= now:
+                _, chat_id = heapq.heappop(self._idle)
+                chat = self._chats.get(chat_id)
+                if chat is not None and not chat.calls:
+                    self._schedule(chat)
+
+            timeout = self._timers[0][0] - now if self._timers else None
+            if self._ready or self._direct:
+                global_wait = self._global.wait_time(now)
+                if global_wait <= 0:
+                    if self._direct and (not self._ready or self._direct[0][:2] < self._ready[0][:2]):
+                        _, _, call = heapq.heappop(self._direct)
+                        if call.method == "send_chat_action":
+                            self._actions.pop((call.chat_id, call.kwargs["action"]), None)
+                        self._global.take(now)
+                        self._direct_in_flight += 1
+                        self._queued -= 1
+                        return None, call
+                    _, sequence, chat_id = heapq.heappop(self._ready)
+                    chat = self._chats[chat_id]
+                    chat_wait = chat.bucket.wait_time(now)
+                    if chat_wait > 0:
+                        heapq.heappush(self._timers, (now + chat_wait, sequence, chat_id))
+                        continue
+                    self._global.take(now)
+                    chat.bucket.take(now)
+                    chat.scheduled = False
+                    chat.in_flight = True
+                    self._queued -= 1
+                    return chat, chat.calls.popleft()
+                timeout = global_wait if timeout is None else min(timeout, global_wait)
+            elif (self._stopped and not self._timers and not self._direct_in_flight
+                  and not any(c.in_flight for c in self._chats.values())):
+                self._cond.notify_all()
+                return None, None
+
+            self._cond.wait(timeout)
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                chat, call = self._next_call()
+            if call is None:
+                return
+
+            OUTBOUND_WAIT_SECONDS.observe(time.perf_counter() - call.enqueued, call.method)
+            retry_after = None
+            try:
+                result = getattr(call.bot, call.method)(**call.kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+            except Exception as e:
+                logger.error("Outgoing %s to chat %s failed: %s", call.method, call.chat_id, e)
+                call.future.set_exception(e)
+            else:
+                call.future.set_result(result)
+
+            with self._cond:
+                if retry_after is not None:
+                    OUTBOUND_RETRY_AFTER.inc()
+                    logger.warning("Flood limit reached, pausing outgoing calls for %ss", retry_after)
+                    now = time.monotonic()
+                    self._global.pause(now, retry_after)
+                    self._queued += 1
+                    if chat is None:
+                        heapq.heappush(self._direct, (call.priority, next(self._sequence), call))
+                    else:
+                        chat.bucket.pause(now, retry_after)
+                        chat.calls.appendleft(call)
+                if chat is None:
+                    self._direct_in_flight -= 1
+                    self._cond.notify_all()
+                else:
+                    chat.in_flight = False
+                    self._schedule(chat)
@@ -0,0 +1,246 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+
+def _to_json(value):
+    # Records in the user data (e.g. drafts.Draft) are stored as their dict
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def _user_data_json(data, attempts=3):
+    """Serializes the user data of a user, None for empty data. A handler on another thread may
+    change the dict meanwhile, then the serialization is tried again (the handler reports the data
+    again once it has finished)."""
+    if not data:
+        return None
+    for _ in range(attempts - 1):
+        try:
+            return json.dumps(dict(data), default=_to_json)
+        except RuntimeError:
+            # "dictionary changed size during iteration"
+            pass
+    return json.dumps(dict(data), default=_to_json)
+
+
+class BatchedPersistence(BasePersistence):
+    """Base class for the persistence backends of the bot's conversations and `user_data`.
+
+    Updates from the dispatcher and the ConversationHandler only mark the changed users and
+    conversations as dirty (with a snapshot of the user data, as the handlers keep changing the
+    dicts). A background thread writes them to the backend in one batch every `flush_interval`
+    seconds (and `flush` is called by the Updater on shutdown). If a write fails, the batch is
+    written again with the next one. Subclasses
+    implement `_load_user_data`, `_load_conversations` and `_write`. chat_data and bot_data are
+    not used by the bot and not stored. Values with a `to_dict` method are stored as that dict.
+
+    Parameters
+    ----------
+    flush_interval: float, optional
+        Seconds between two writes to the backend. Default: 5
+    """
+
+    def __init__(self, flush_interval=5):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        # Flushes are serialized, so an older batch can't overwrite a newer one
+        self._flush_lock = threading.Lock()
+        self._dirty_users = {}
+        self._dirty_conversations = {}
+        self._stopped = threading.Event()
+        self._flush_thread = None
+
+    def get_user_data(self):
+        return defaultdict(dict, self._load_user_data())
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return self._load_conversations(name)
+
+    def update_conversation(self, name, key, new_state):
+        while isinstance(new_state, tuple):
+            # (old state, Promise) while a scheduled handler is still running: keep the old state,
+            # the new one is reported again once the promise is resolved. PTB reports the state after
+            # wrapping it, so the old state is itself a (old state, Promise) tuple.
+            new_state = new_state[0]
+        with self._lock:
+            self._dirty_conversations[(name, key)] = new_state
+
+    def update_user_data(self, user_id, data):
+        # Serialized right away: a flush on the persistence thread would read the dict while handlers change it
+        data = _user_data_json(data)
+        with self._lock:
+            self._dirty_users[user_id] = data
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def start(self):
+        """Starts the background thread that writes the changes in batches."""
+        if self._flush_thread is None:
+            self._flush_thread = threading.Thread(target=self._flush_loop, name="persistence", daemon=True)
+            self._flush_thread.start()
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not write conversation state to the persistence backend")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                users, self._dirty_users = self._dirty_users, {}
+                conversations, self._dirty_conversations = self._dirty_conversations, {}
+            if not users and not conversations:
+                return
+
+            # Empty user data (e.g. after a finished conversation) is None and deleted in the backend
+            try:
+                conversation_states = {(name, json.dumps(list(key))): json.dumps(state) if state is not None else None
+                                       for (name, key), state in conversations.items()}
+                self._write(users, conversation_states)
+            except Exception:
+                # Written with the next batch, unless the users or conversations have changed again meanwhile
+                with self._lock:
+                    for user_id, data in users.items():
+                        self._dirty_users.setdefault(user_id, data)
+                    for key, state in conversations.items():
+                        self._dirty_conversations.setdefault(key, state)
+                raise
+        logger.debug("Persisted %s user(s) and %s conversation(s)", len(users), len(conversation_states))
+
+    def stop(self):
+        """Stops the background thread and writes the remaining changes."""
+        self._stopped.set()
+        self.flush()
+
+    def _load_user_data(self):
+        """Returns a dict of user id to user data."""
+        raise NotImplementedError
+
+    def _load_conversations(self, name):
+        """Returns a dict of conversation key (tuple) to state for the ConversationHandler `name`."""
+        raise NotImplementedError
+
+    def _write(self, user_data, conversations):
+        """Writes serialized user data ({user id: json or None}) and conversation states
+        ({(name, json key): json state or None}) in one batch. None values are deleted."""
+        raise NotImplementedError
+
+
+class SQLitePersistence(BatchedPersistence):
+    """Stores conversations and user data in a local SQLite database.
+
+    Parameters
+    ----------
+    path: string
+        Path of the SQLite database file
+    """
+
+    def __init__(self, path, flush_interval=5):
+        super().__init__(flush_interval)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn_lock = threading.Lock()
+        with self._conn_lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS conversations "
+                               "(name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key))")
+
+    def _load_user_data(self):
+        with self._conn_lock:
+            rows = self._conn.execute("SELECT user_id, data FROM user_data").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def _load_conversations(self, name):
+        with self._conn_lock:
+            rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    def _write(self, user_data, conversations):
+        with self._conn_lock, self._conn:
+            self._conn.executemany("DELETE FROM user_data WHERE user_id = ?",
+                                   [(user_id,) for user_id, data in user_data.items() if data is None])
+            self._conn.executemany("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                                   [(user_id, data) for user_id, data in user_data.items() if data is not None])
+            self._conn.executemany("DELETE FROM conversations WHERE name = ? AND key = ?",
+                                   [key for key, state in conversations.items() if state is None])
+            self._conn.executemany("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                   [key + (state,) for key, state in conversations.items() if state is not None])
+
+
+class RedisPersistence(BatchedPersistence):
+    """Stores conversations and user data in Redis (or a Redis-compatible server).
+
+    Every user and conversation is stored under its own key, so the data can be sharded over a
+    Redis cluster. The `redis` package is only imported when this backend is used.
+
+    Parameters
+    ----------
+    url: string
+        Redis URL, e.g. "redis://localhost:6379/0"
+    prefix: string, optional
+        Prefix of all keys. Default: "telegram_bot"
+    """
+
+    def __init__(self, url, prefix="telegram_bot", flush_interval=5):
+        super().__init__(flush_interval)
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def _user_key(self, user_id):
+        return "{}:user_data:{}".format(self.prefix, user_id)
+
+    def _conversation_key(self, name, key):
+        return "{}:conversation:{}:{}".format(self.prefix, name, key)
+
+    def _scan(self, pattern):
+        keys = list(self._redis.scan_iter(match=pattern, count=1000))
+        if not keys:
+            return []
+        return zip(keys, self._redis.mget(keys))
+
+    def _load_user_data(self):
+        return {int(key.decode().rsplit(":", 1)[1]): json.loads(data)
+                for key, data in self._scan(self._user_key("*")) if data is not None}
+
+    def _load_conversations(self, name):
+        prefix_length = len(self._conversation_key(name, ""))
+        return {tuple(json.loads(key.decode()[prefix_length:])): json.loads(state)
+                for key, state in self._scan(self._conversation_key(name, "*")) if state is not None}
+
+    def _write(self, user_data, conversations):
+        pipeline = self._redis.pipeline(transaction=False)
+        for user_id, data in user_data.items():
+            if data is None:
+                pipeline.delete(self._user_key(user_id))
+            else:
+                pipeline.set(self._user_key(user_id), data)
+        for (name, key), state in conversations.items():
+            if state is None:
+                pipeline.delete(self._conversation_key(name, key))
+            else:
+                pipeline.set(self._conversation_key(name, key), state)
+        pipeline.execute()
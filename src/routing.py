@@ -0,0 +1,116 @@
+from collections import namedtuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import CallbackQueryHandler
+
+Option = namedtuple("Option", ["text", "data", "callback"])
+"""A button of a `Menu`: displayed text, callback_data and the handler called when it is pressed."""
+
+
+class Menu:
+    """Inline keyboard of a conversation step together with the handlers of its buttons.
+
+    The same option table is used to build the keyboard and the callback routes of the state that
+    follows the step, so the two can't drift apart.
+
+    Parameters
+    ----------
+    rows: list
+        Button rows, where each row is a list of `Option`s
+    edit_message: bool, optional
+        If True, the handlers answer a button by editing the text and keyboard of the menu's
+        message in place instead of sending a new message. Default: False
+    """
+
+    def __init__(self, rows, edit_message=False):
+        self.rows = rows
+        self.edit_message = edit_message
+        self.routes = {option.data: option.callback for row in rows for option in row}
+
+    def keyboard(self, labels=None):
+        """Builds the InlineKeyboardMarkup of the menu.
+
+        Parameters
+        ----------
+        labels: dict, optional
+            Replaces button texts (keys) by other texts (values), e.g. for a different language
+        """
+        labels = labels or {}
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(labels.get(option.text, option.text), callback_data=option.data) for option in row]
+            for row in self.rows
+        ])
+
+    def handler(self):
+        """Returns the single CallbackQueryHandler that routes all buttons of the menu."""
+        return CallbackRouteHandler(self.routes, edit_message=self.edit_message)
+
+
+class CallbackRouteHandler(CallbackQueryHandler):
+    """CallbackQueryHandler that picks the callback by a dict lookup of the callback_data,
+    instead of matching one regex pattern per button and handler.
+
+    Only supports context based callbacks (`use_context=True`).
+
+    Parameters
+    ----------
+    routes: dict
+        Maps callback_data to the handler function
+    edit_message: bool, optional
+        Passed to the handlers as `context.edit_message`. Default: False
+    """
+
+    def __init__(self, routes, edit_message=False):
+        super().__init__(self._unrouted)
+        self.routes = routes
+        self.edit_message = edit_message
+
+    def check_update(self, update):
+        if isinstance(update, Update) and update.callback_query:
+            return self.routes.get(update.callback_query.data)
+        return None
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        # check_result is the routed callback
+        context.edit_message = self.edit_message
+        return check_result(update, context)
+
+    @staticmethod
+    def _unrouted(update, context):
+        raise RuntimeError("CallbackRouteHandler calls the routed callbacks directly")
+
+
+class KeyboardRegistry:
+    """Builds the keyboards of all menus once and caches them as serialized JSON.
+
+    python-telegram-bot sends a `reply_markup` that is already a string as it is, so handlers can
+    pass the cached payload instead of building and serializing a new InlineKeyboardMarkup for
+    every message. Variants (e.g. other languages or texts without emojis) are label tables
+    registered with `add_variant`, and every menu is cached once per variant.
+    """
+
+    DEFAULT = "default"
+
+    def __init__(self):
+        self._menus = {}
+        self._variants = {self.DEFAULT: {}}
+        self._payloads = {}
+
+    def add_menu(self, name, menu):
+        self._menus[name] = menu
+
+    def add_variant(self, variant, labels):
+        """Registers a label table that replaces the default button texts."""
+        self._variants[variant] = labels
+
+    def build(self):
+        """Builds and serializes every keyboard in every variant. Call once at startup."""
+        self._payloads = {
+            (name, variant): menu.keyboard(labels).to_json()
+            for name, menu in self._menus.items()
+            for variant, labels in self._variants.items()
+        }
+
+    def get(self, name, variant=DEFAULT):
+        """Returns the serialized keyboard, to be passed as `reply_markup`."""
+        return self._payloads[(name, variant)]
@@ -0,0 +1,565 @@
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter as TermCounter
+from collections import defaultdict
+from functools import lru_cache
+
+import requests
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+SEARCH_SECONDS = Histogram("bot_search_seconds", "Duration of archive searches", ("kind",))
+SEARCH_SYNCED_CASES = Counter("bot_search_synced_cases_total", "Closed cases added to the search index")
+SEARCH_MERGES = Counter("bot_search_merges_total", "Rebuilds of the search index file with the synced cases")
+
+_WORD = re.compile(r"\w+")
+
+# Frequent German words that don't help finding a case
+STOPWORDS = frozenset("""
+aber alle allem allen aller alles als also am an ander andere anderem anderen anderer anderes auch auf aus bei
+bin bis bist da damit dann das dass dasselbe dazu dein deine deinem deinen deiner dem den denn der derer des
+dessen dich die dies diese diesem diesen dieser dieses dir doch dort du durch ein eine einem einen einer eines
+einig einige einigem einigen einiger einiges einmal er es etwas euch euer eure für gegen gewesen hab habe haben
+hat hatte hatten hier hin hinter ich ihm ihn ihnen ihr ihre ihrem ihren ihrer ihres im in indem ins ist jede
+jedem jeden jeder jedes jene jenem jenen jener jenes jetzt kann kein keine keinem keinen keiner keines können
+könnte machen man manche manchem manchen mancher manches mein meine meinem meinen meiner meines mich mir mit
+muss musste nach nicht nichts noch nun nur ob oder ohne sehr sein seine seinem seinen seiner seines selbst
+sich sie sind so solche solchem solchen solcher solches soll sollte sondern sonst um und uns unser unsere
+unter viel vom von vor war waren warst was weg weil weiter welche welchem welchen welcher welches wenn werde
+werden wie wieder will wir wird wirst wo wollen wollte würde würden zu zum zur zwar zwischen
+""".split())
+
+_VOWELS = "aeiouyäöü"
+_UMLAUTS = str.maketrans("äöü", "aou")
+_S_ENDING = "bdfghklmnrt"
+_ST_ENDING = "bdfghklmnt"
+
+
+def _regions(word):
+    """R1 and R2 of the Snowball stemmer: the positions after the first non-vowel that follows
+    a vowel (R1 at least at position 3), and the same again after R1."""
+    def after(start):
+        for i in range(start + 1, len(word)):
+            if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+                return i + 1
+        return len(word)
+
+    r1 = after(0)
+    return max(3, r1), after(r1)
+
+
+@lru_cache(maxsize=100000)
+def stem(word):
+    """Reduces a lower case German word to its stem with the Snowball algorithm for German
+    (https://snowballstem.org/algorithms/german/stemmer.html), e.g. "impfungen" -> "impfung".
+    Umlauts are replaced by their vowels, so "Ärzte" and "Arzt" share the stem "arzt"."""
+    word = word.replace("ß", "ss")
+    # u and y between vowels are consonants
+    letters = list(word)
+    for i in range(1, len(letters) - 1):
+        if letters[i] in "uy" and letters[i - 1] in _VOWELS and letters[i + 1] in _VOWELS:
+            letters[i] = letters[i].upper()
+    word = "".join(letters)
+    r1, r2 = _regions(word)
+
+    # Step 1
+    for suffix in ("ern", "em", "er", "en", "es", "e", "s"):
+        if word.endswith(suffix):
+            if len(word) - len(suffix) >= r1:
+                if suffix == "s" and word[-2:-1] not in tuple(_S_ENDING):
+                    break
+                word = word[:-len(suffix)]
+                if suffix in ("en", "es", "e") and word.endswith("niss"):
+                    word = word[:-1]
+            break
+
+    # Step 2
+    for suffix in ("est", "en", "er", "st"):
+        if word.endswith(suffix):
+            if len(word) - len(suffix) >= r1:
+                if suffix == "st" and (word[-3:-2] not in tuple(_ST_ENDING) or len(word) < 6):
+                    break
+                word = word[:-len(suffix)]
+            break
+
+    # Step 3: derivational suffixes
+    for suffix in ("isch", "lich", "heit", "keit", "end", "ung", "ig", "ik"):
+        if not word.endswith(suffix):
+            continue
+        start = len(word) - len(suffix)
+        if start < r2:
+            break
+        if suffix in ("end", "ung"):
+            word = word[:start]
+            if word.endswith("ig") and not word.endswith("eig") and len(word) - 2 >= r2:
+                word = word[:-2]
+        elif suffix in ("ig", "ik", "isch"):
+            if not word[:start].endswith("e"):
+                word = word[:start]
+        elif suffix in ("lich", "heit"):
+            word = word[:start]
+            if word.endswith(("er", "en")) and len(word) - 2 >= r1:
+                word = word[:-2]
+        else:
+            word = word[:start]
+            if word.endswith("lich") and len(word) - 4 >= r2:
+                word = word[:-4]
+            elif word.endswith("ig") and len(word) - 2 >= r2:
+                word = word[:-2]
+        break
+
+    return word.lower().translate(_UMLAUTS)
+
+
+def normalize(text):
+    """Lower case words of a text, without stop words."""
+    return [word for word in _WORD.findall(unicodedata.normalize("NFKC", text).casefold())
+            if len(word) > 1 and word not in STOPWORDS]
+
+
+def tokenize(text):
+    """Stems of the words of a text."""
+    return [stem(word) for word in normalize(text)]
+
+
+def searchable_text(case):
+    return " ".join(str(case.get(field) or "") for field in ("title", "content", "result"))
+
+
+class _SortedStrings:
+    """Sorted UTF-8 strings in a blob with their offsets (array of n + 1 offsets)."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def bisect(self, value):
+        """Index of the first string >= value."""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, value):
+        i = self.bisect(value)
+        return i if i < len(self) and self[i] == value else None
+
+
+_HEADER = struct.Struct("<8sIId")
+_SECTIONS = ("doc_lengths", "store_offsets", "store", "term_offsets", "terms", "posting_offsets", "postings",
+             "id_offsets", "ids", "id_docs")
+_SECTION = struct.Struct("<QQ")
+_MAGIC = b"DKSRCH01"
+
+
+def write_segment(path, cases):
+    """Writes the index of `cases` (dicts with "id") to a new file at `path`, which replaces the
+    file atomically."""
+    doc_lengths = array("I")
+    store_offsets = array("Q", [0])
+    store = bytearray()
+    postings_of = defaultdict(list)
+    ids = []
+    for doc, case in enumerate(cases):
+        tokens = tokenize(searchable_text(case))
+        doc_lengths.append(len(tokens))
+        for term, frequency in TermCounter(tokens).items():
+            postings_of[term.encode("utf-8")].extend((doc, frequency))
+        store += json.dumps(case, ensure_ascii=False).encode("utf-8")
+        store_offsets.append(len(store))
+        ids.append((str(case["id"]).encode("utf-8"), doc))
+
+    terms = sorted(postings_of)
+    term_offsets, term_blob = _string_table(terms)
+    posting_offsets = array("Q", [0])
+    postings = array("I")
+    for term in terms:
+        postings.extend(postings_of[term])
+        posting_offsets.append(len(postings))
+    ids.sort()
+    id_offsets, id_blob = _string_table([case_id for case_id, _ in ids])
+    id_docs = array("I", [doc for _, doc in ids])
+
+    total_length = sum(doc_lengths)
+    sections = (doc_lengths.tobytes(), store_offsets.tobytes(), bytes(store), term_offsets.tobytes(), term_blob,
+                posting_offsets.tobytes(), postings.tobytes(), id_offsets.tobytes(), id_blob, id_docs.tobytes())
+    position = _HEADER.size + _SECTION.size * len(sections)
+    table, body = bytearray(), bytearray()
+    for section in sections:
+        # Sections start at multiples of 8, so they can be cast to arrays
+        padding = -(position + len(body)) % 8
+        body += bytes(padding)
+        table += _SECTION.pack(position + len(body), len(section))
+        body += section
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(doc_lengths), len(terms), total_length / max(1, len(doc_lengths))))
+        f.write(table)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def _string_table(strings):
+    offsets = array("I", [0])
+    blob = bytearray()
+    for string in strings:
+        blob += string
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+class _Segment:
+    """Read-only index file, mapped into memory. Only the pages a search touches are read."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, self.documents, terms, self.average_length = _HEADER.unpack_from(view)
+        if magic != _MAGIC:
+            raise ValueError("{} is no search index".format(path))
+        sections = {}
+        for i, name in enumerate(_SECTIONS):
+            offset, length = _SECTION.unpack_from(view, _HEADER.size + i * _SECTION.size)
+            sections[name] = view[offset:offset + length]
+        self.doc_lengths = sections["doc_lengths"].cast("I")
+        self.store_offsets = sections["store_offsets"].cast("Q")
+        self.store = sections["store"]
+        self.terms = _SortedStrings(sections["terms"], sections["term_offsets"].cast("I"))
+        self.posting_offsets = sections["posting_offsets"].cast("Q")
+        self.postings = sections["postings"].cast("I")
+        self.ids = _SortedStrings(sections["ids"], sections["id_offsets"].cast("I"))
+        self.id_docs = sections["id_docs"].cast("I")
+        self._norms = None
+
+    def norms(self, k1, b, average_length):
+        """BM25 length normalization `k1 * (1 - b + b * length / average_length)` of every doc, computed
+        on first use and whenever the average length changed by more than 5%."""
+        if self._norms is None or abs(self._norms[0] - average_length) > 0.05 * average_length:
+            self._norms = (average_length, array("d", (k1 * (1 - b + b * length / average_length)
+                                                       for length in self.doc_lengths)))
+        return self._norms[1]
+
+    @classmethod
+    def empty(cls, path):
+        write_segment(path, [])
+        return cls(path)
+
+    def term_postings(self, term):
+        """(doc, frequency) pairs of a term (as memoryview of alternating values), or None."""
+        i = self.terms.find(term.encode("utf-8"))
+        if i is None:
+            return None
+        return self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]]
+
+    def terms_with_prefix(self, prefix, limit):
+        encoded = prefix.encode("utf-8")
+        start = self.terms.bisect(encoded)
+        found = []
+        for i in range(start, min(start + limit, len(self.terms))):
+            term = self.terms[i]
+            if not term.startswith(encoded):
+                break
+            found.append(term.decode("utf-8"))
+        return found
+
+    def doc(self, doc):
+        return json.loads(bytes(self.store[self.store_offsets[doc]:self.store_offsets[doc + 1]]))
+
+    def doc_of(self, case_id):
+        i = self.ids.find(str(case_id).encode("utf-8"))
+        return None if i is None else self.id_docs[i]
+
+    def cases(self):
+        for doc in range(self.documents):
+            yield self.doc(doc)
+
+
+class _Delta:
+    """Cases synced since the index file was written, indexed in memory."""
+
+    def __init__(self):
+        self.cases = {}
+        self.lengths = {}
+        self.postings = defaultdict(dict)
+        # Terms of the postings in sorted order (for the prefix matches) and the terms of each case (for the
+        # removal), so that neither has to go through the whole vocabulary
+        self.terms = []
+        self.terms_of = {}
+        # Docs of the index file that were updated or deleted since
+        self.replaced = set()
+
+    def add(self, case, segment):
+        case_id = str(case["id"])
+        self.remove(case_id, segment)
+        tokens = tokenize(searchable_text(case))
+        frequencies = TermCounter(tokens)
+        self.cases[case_id] = case
+        self.lengths[case_id] = len(tokens)
+        self.terms_of[case_id] = tuple(frequencies)
+        for term, frequency in frequencies.items():
+            if term not in self.postings:
+                insort(self.terms, term)
+            self.postings[term][case_id] = frequency
+
+    def remove(self, case_id, segment):
+        case_id = str(case_id)
+        doc = segment.doc_of(case_id)
+        if doc is not None:
+            self.replaced.add(doc)
+        if self.cases.pop(case_id, None) is not None:
+            del self.lengths[case_id]
+            for term in self.terms_of.pop(case_id):
+                postings = self.postings[term]
+                postings.pop(case_id, None)
+                if not postings:
+                    del self.postings[term]
+                    del self.terms[bisect_left(self.terms, term)]
+
+    def terms_with_prefix(self, prefix, limit):
+        start = bisect_left(self.terms, prefix)
+        terms = self.terms[start:start + limit]
+        return [term for term in terms if term.startswith(prefix)]
+
+
+class SearchIndex:
+    """Local full text index of the closed cases, so that searches (e.g. inline queries on every
+    keystroke) are answered in milliseconds without asking the item API.
+
+    The index is an inverted index of the stems of the cases' title, content and result (German
+    stop words removed, see `stem`), ranked with BM25. It is kept in a file that is mapped into
+    memory (`mmap`), so opening it is instant and the OS only loads the pages searches touch.
+    A background thread fetches the cases closed since the last sync from `sync_url` (same
+    format as for `notifications.CaseNotifier`, cases with "id", "title", "content", "result" and
+    "url"; ids in "deleted" are removed) and indexes them in memory. The synced cases are also
+    appended to a log next to the file, so they survive restarts. Once more than `merge_cases`
+    cases were synced, the file is rewritten with them.
+
+    With `prefix` searches the last word is also matched as the start of a word, for queries that
+    are still being typed.
+
+    Parameters
+    ----------
+    path: string
+        Path of the index file (the log is "<path>.delta")
+    sync_url: string, optional
+        URL of the closed cases. Default: None (no sync)
+    sync_interval: float, optional
+        Seconds between two syncs. Default: 300
+    merge_cases: int, optional
+        Synced cases after which the file is rewritten. Default: 5000
+    k1, b: float, optional
+        BM25 parameters. Default: 1.2, 0.75
+    """
+
+    def __init__(self, path, sync_url=None, sync_interval=300, merge_cases=5000, k1=1.2, b=0.75,
+                 timeout=(3.05, 30)):
+        self.path = path
+        self.sync_url = sync_url
+        self.sync_interval = sync_interval
+        self.merge_cases = merge_cases
+        self.k1 = k1
+        self.b = b
+        self.timeout = timeout
+
+        self._segment = None
+        self._delta = _Delta()
+        self._cursor = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            if self._segment is None:
+                return 0
+            return self._segment.documents - len(self._delta.replaced) + len(self._delta.cases)
+
+    def open(self):
+        """Maps the index file (creating an empty one) and replays the log of synced cases."""
+        self._segment = _Segment(self.path) if os.path.exists(self.path) else _Segment.empty(self.path)
+        replayed = 0
+        if os.path.exists(self.delta_path):
+            with open(self.delta_path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        replayed += self._apply(json.loads(line))
+        logger.info("Search index with %s case(s) opened (%s from the log)", len(self), replayed)
+        return self
+
+    @property
+    def delta_path(self):
+        return self.path + ".delta"
+
+    def start(self):
+        """Starts the background sync."""
+        if self.sync_url and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="search_sync", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def search(self, query, limit=10, prefix=False):
+        """Returns the best matching cases (dicts as synced) for a query, best first."""
+        start = time.perf_counter()
+        words = normalize(query)
+        if not words:
+            return []
+        terms = [stem(word) for word in words]
+        if prefix:
+            # The last word may be incomplete: also match the words it is the start of, and its
+            # longest start that is a stem of its own (e.g. "impfu" matches "impf")
+            partial = words[-1].replace("ß", "ss").translate(_UMLAUTS)
+            with self._lock:
+                terms[-1:] = {terms[-1]} | set(self._segment.terms_with_prefix(partial, 20)) | set(
+                    self._delta.terms_with_prefix(partial, 20)) | {
+                    partial[:i] for i in range(3, len(partial)) if self._segment.terms.find(
+                        partial[:i].encode("utf-8")) is not None}
+
+        with self._lock:
+            results = [self._case(key) for key in self._rank(set(terms), limit)]
+        SEARCH_SECONDS.observe(time.perf_counter() - start, "prefix" if prefix else "words")
+        return results
+
+    def _rank(self, terms, limit):
+        segment, delta = self._segment, self._delta
+        documents = max(1, segment.documents - len(delta.replaced) + len(delta.cases))
+        total_length = segment.average_length * segment.documents + sum(delta.lengths.values())
+        average_length = max(1.0, total_length / documents)
+        norms = segment.norms(self.k1, self.b, average_length)
+        k1, b = self.k1, self.b
+
+        matches = []
+        for term in terms:
+            postings = segment.term_postings(term)
+            delta_postings = delta.postings.get(term, {})
+            frequency = (len(postings) // 2 if postings is not None else 0) + len(delta_postings)
+            if frequency:
+                idf = math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+                matches.append((idf * (k1 + 1), postings, delta_postings))
+        # A term adds less than its weight (idf * (k1 + 1)) to a score. The rare terms are scored first,
+        # and once a doc that none of them matched can't reach the best `limit` scores with the weights
+        # of the remaining (frequent) terms, these only add to the docs found so far (MaxScore)
+        matches.sort(key=lambda match: match[0], reverse=True)
+        remaining = sum(weight for weight, _, _ in matches)
+        scores = defaultdict(float)
+        for weight, postings, delta_postings in matches:
+            if len(scores) >= limit and heapq.nlargest(limit, scores.values())[-1] >= remaining:
+                docs = postings[0::2] if postings is not None else ()
+                if len(scores) * 16 < len(docs):
+                    # Few docs found so far: look them up in the postings (sorted by doc)
+                    for key in scores:
+                        if isinstance(key, str):
+                            continue
+                        i = bisect_left(docs, key)
+                        if i < len(docs) and docs[i] == key:
+                            tf = postings[2 * i + 1]
+                            scores[key] += weight * tf / (tf + norms[key])
+                else:
+                    for doc, tf in zip(docs, postings[1::2]):
+                        if doc in scores:
+                            scores[doc] += weight * tf / (tf + norms[doc])
+                for case_id, tf in delta_postings.items():
+                    if case_id in scores:
+                        norm = k1 * (1 - b + b * delta.lengths[case_id] / average_length)
+                        scores[case_id] += weight * tf / (tf + norm)
+            else:
+                if postings is not None:
+                    for doc, tf in zip(postings[0::2], postings[1::2]):
+                        scores[doc] += weight * tf / (tf + norms[doc])
+                for case_id, tf in delta_postings.items():
+                    norm = k1 * (1 - b + b * delta.lengths[case_id] / average_length)
+                    scores[case_id] += weight * tf / (tf + norm)
+                for doc in delta.replaced:
+                    scores.pop(doc, None)
+            remaining -= weight
+        return heapq.nlargest(limit, scores, key=scores.get)
+
+    def _case(self, key):
+        # Docs of the file are numbers, synced cases are keyed by their id
+        return self._delta.cases[key] if isinstance(key, str) else self._segment.doc(key)
+
+    def sync(self):
+        """Fetches the cases closed since the last sync, logs and indexes them."""
+        try:
+            response = requests.get(self.sync_url, params={"since": self._cursor} if self._cursor else None,
+                                    timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning("Syncing the search index failed: %s", e)
+            return
+        if response.status_code != 200:
+            logger.warning("Syncing the search index answered with HTTP %s", response.status_code)
+            return
+        data = response.json()
+        change = {"items": [case for case in data.get("items", []) if "id" in case],
+                  "deleted": data.get("deleted", []), "cursor": data.get("cursor")}
+        if not change["items"] and not change["deleted"] and change["cursor"] == self._cursor:
+            return
+        with open(self.delta_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(change, ensure_ascii=False) + "\n")
+        SEARCH_SYNCED_CASES.inc(amount=self._apply(change))
+        if len(self._delta.cases) + len(self._delta.replaced) > self.merge_cases:
+            self.merge()
+
+    def _apply(self, change):
+        with self._lock:
+            for case_id in change.get("deleted", []):
+                self._delta.remove(case_id, self._segment)
+            for case in change.get("items", []):
+                self._delta.add(case, self._segment)
+            self._cursor = change.get("cursor", self._cursor)
+        return len(change.get("items", []))
+
+    def merge(self):
+        """Rewrites the index file with the synced cases and empties the log. Only the sync thread
+        changes the index, so the cases don't change while the file is written."""
+        start = time.perf_counter()
+        segment, delta = self._segment, self._delta
+        cases = [case for doc, case in enumerate(segment.cases()) if doc not in delta.replaced]
+        write_segment(self.path, cases + list(delta.cases.values()))
+        merged = _Segment(self.path)
+        with open(self.delta_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"items": [], "deleted": [], "cursor": self._cursor}) + "\n")
+        os.replace(self.delta_path + ".tmp", self.delta_path)
+        with self._lock:
+            self._segment, self._delta = merged, _Delta()
+        SEARCH_MERGES.inc()
+        logger.info("Search index rewritten with %s case(s) in %.1fs", merged.documents, time.perf_counter() - start)
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                logger.exception("Could not sync the search index")
+            if self._stopped.wait(self.sync_interval):
+                return
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SecretError(Exception):
+    pass
+
+
+class EnvSecretSource:
+    """Reads a secret from the environment variable named like the secret in upper case,
+    e.g. TELEGRAM_BOT_TOKEN_LOCAL_DEV for "telegram_bot_token_local_dev"."""
+
+    def get(self, name):
+        try:
+            return os.environ[name.upper()]
+        except KeyError:
+            raise SecretError("Environment variable {} is not set".format(name.upper()))
+
+
+class FileSecretSource:
+    """Reads a secret from the file `<directory>/<name>` (e.g. a mounted Docker/ECS secret).
+
+    Parameters
+    ----------
+    directory: string
+        Directory containing one file per secret
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, name):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return f.read().strip()
+        except OSError as e:
+            raise SecretError("Could not read secret {}: {}".format(name, e))
+
+
+class SecretsManagerSource:
+    """Reads a secret from the AWS Secrets Manager. The secret string is a JSON object, which holds
+    the value under the name of the secret.
+
+    `boto3` is only imported (and the client only created) when the first secret is read, since it
+    adds noticeably to the start time of the bot. The client is reused afterwards. Network errors and
+    secrets without a valid value are raised as `SecretError`, so a cached value can be used instead.
+
+    Parameters
+    ----------
+    region_name: string, optional
+        AWS region of the secrets. Default: "eu-central-1"
+    """
+
+    def __init__(self, region_name="eu-central-1"):
+        self.region_name = region_name
+        self._client = None
+
+    def get(self, name):
+        import boto3
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            if self._client is None:
+                self._client = boto3.session.Session().client(service_name="secretsmanager",
+                                                              region_name=self.region_name)
+            response = self._client.get_secret_value(SecretId=name)
+        except ClientError as e:
+            raise SecretError("Secrets manager error: {}".format(e.response["Error"]["Code"]))
+        except BotoCoreError as e:
+            # e.g. EndpointConnectionError, ReadTimeoutError, NoCredentialsError
+            raise SecretError("Could not reach the secrets manager: {}".format(e))
+        try:
+            return json.loads(response["SecretString"])[name]
+        except (KeyError, TypeError, ValueError) as e:
+            # ValueError includes json.JSONDecodeError; TypeError for binary secrets without SecretString
+            raise SecretError("Secret {} has no valid value: {!r}".format(name, e))
+
+
+class CachedSecretProvider:
+    """Caches the secrets of a source in memory and reads them again once they are older than
+    `ttl`, so that rotated secrets are picked up without a restart. If the refresh fails, the
+    cached value is used until the next attempt.
+
+    Parameters
+    ----------
+    source: object
+        Secret source with a `get(name)` method
+    ttl: float, optional
+        Seconds after which a secret is read again. Default: 3600
+    """
+
+    def __init__(self, source, ttl=3600):
+        self.source = source
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            cached = self._cache.get(name)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+
+        try:
+            value = self.source.get(name)
+        except SecretError:
+            if cached is None:
+                raise
+            logger.exception("Could not refresh secret %s, using the cached value", name)
+            value = cached[0]
+        with self._lock:
+            self._cache[name] = (value, time.monotonic())
+        return value
@@ -0,0 +1,338 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from queue import Empty
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+ROUTED_UPDATES = Counter("bot_routed_updates_total", "Updates routed to the worker processes", ("worker",))
+WORKER_RESTARTS = Counter("bot_worker_restarts_total", "Restarts of worker processes after they exited", ("worker",))
+RESENT_UPDATES = Counter("bot_resent_updates_total",
+                         "Unacknowledged updates sent again to a restarted worker process", ("worker",))
+DROPPED_UPDATES = Counter("bot_dropped_updates_total",
+                          "Updates dropped because too many were pending for a worker process", ("worker",))
+
+
+# Returned by the `handle` function of `serve` for an update that the worker dispatches again later
+DEFERRED = object()
+
+
+def shard_key(update):
+    """The chat id of an update (or the user id for updates without chat, e.g. inline queries),
+    so all updates of a conversation have the same key."""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+def shard_of(key, shards):
+    return zlib.crc32(str(key).encode()) % shards
+
+
+class ShardRouter(Dispatcher):
+    """Dispatcher of the ingress process: instead of handling the updates it hands them to
+    `route(persona, update)`. Used with an `Updater`, so polling and webhooks work as usual."""
+
+    def __init__(self, bot, update_queue, route, job_queue=None):
+        super().__init__(bot, update_queue, workers=0, job_queue=job_queue, use_context=True)
+        self.route = route
+
+    def process_update(self, update):
+        if isinstance(update, Update):
+            self.route(self.bot_data["persona"], update)
+        else:
+            # Errors raised by the polling thread
+            super().process_update(update)
+
+
+class _Worker:
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.inbox = None
+        # sequence number -> (persona, update as JSON) of the routed updates the worker hasn't acknowledged
+        self.unacked = OrderedDict()
+        self.started = 0
+        self.restart_at = None
+        self.restart_delay = 0
+
+
+class WorkerPool:
+    """Runs the conversation handlers in `workers` processes. The ingress process routes every
+    update by the hash of its chat id (`route`), so the updates of a conversation are handled in
+    order by one worker, which keeps the conversation's state in memory and in its persistence.
+
+    Every worker gets its own queue (a `multiprocessing.Queue`). Updates stay pending in the
+    ingress process until the worker acknowledges that it has handled them and written their
+    state (see `serve`). When a worker exits, it is restarted (with backoff if it keeps crashing)
+    and gets the pending updates again, in order. A worker that is stopped with SIGTERM finishes
+    the updates it has read and acknowledges them before it exits.
+
+    The workers are started with "spawn" (not "fork", which would copy the locks of the ingress
+    process's threads) and `target(index, inbox, acks)` is run in them. `env` returns the
+    environment variables of a worker (e.g. WORKER_INDEX), which have to be set before the
+    worker imports its modules.
+
+    Parameters
+    ----------
+    target: function
+        Entry point of the workers, see `serve`
+    workers: int
+        Number of worker processes
+    env: function, optional
+        Called with the index of a worker, returns a dict of environment variables
+    max_pending: int, optional
+        Maximum number of unacknowledged updates per worker. When a worker has as many, `route` waits for
+        its acknowledgements, so the ingress process stops taking new updates (Telegram keeps them).
+        Default: 10000
+    pending_timeout: float, optional
+        Seconds `route` waits for a worker with `max_pending` updates; after that the oldest update is
+        dropped (logged and counted in bot_dropped_updates_total). Default: 60
+    restart_delay: float, optional
+        Seconds before a crashed worker is restarted, doubled (up to 60) while it keeps crashing
+        within a minute. Default: 1
+    """
+
+    def __init__(self, target, workers, env=None, max_pending=10000, pending_timeout=60, restart_delay=1):
+        self.target = target
+        self.env = env or (lambda index: {})
+        self.max_pending = max_pending
+        self.pending_timeout = pending_timeout
+        self.restart_delay = restart_delay
+
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(index) for index in range(workers)]
+        self._acks = self._context.Queue()
+        self._sequence = 0
+        self._lock = threading.Lock()
+        # Notified when updates are acknowledged, for `route` waiting for a worker with too many pending
+        self._acked = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def __len__(self):
+        """Number of updates that haven't been acknowledged by the workers."""
+        with self._lock:
+            return sum(len(worker.unacked) for worker in self._workers)
+
+    def start(self):
+        with self._lock:
+            for worker in self._workers:
+                self._start(worker)
+        for target, name in ((self._receive_acks, "worker_acks"), (self._monitor, "worker_monitor")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def route(self, persona, update):
+        """Sends an update to the worker of its chat. Waits while the worker has `max_pending`
+        unacknowledged updates (up to `pending_timeout`)."""
+        worker = self._workers[shard_of(shard_key(update), len(self._workers))]
+        message = (persona, update.to_json())
+        with self._lock:
+            deadline = time.monotonic() + self.pending_timeout
+            while len(worker.unacked) >= self.max_pending and not self._stopped.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._acked.wait(remaining)
+            self._sequence += 1
+            worker.unacked[self._sequence] = message
+            if len(worker.unacked) > self.max_pending:
+                sequence, (dropped_persona, _) = worker.unacked.popitem(last=False)
+                DROPPED_UPDATES.inc(worker.index)
+                logger.warning("Worker %s didn't acknowledge any of its %s pending updates within %ss, dropping "
+                               "the oldest (%s, sequence %s)", worker.index, self.max_pending,
+                               self.pending_timeout, dropped_persona, sequence)
+            worker.inbox.put((self._sequence,) + message)
+        ROUTED_UPDATES.inc(worker.index)
+
+    def pending_updates(self):
+        """(persona, update as JSON) of the routed updates that the workers haven't acknowledged, in
+        the order they were routed."""
+        with self._lock:
+            pending = [item for worker in self._workers for item in worker.unacked.items()]
+        return [message for _, message in sorted(pending, key=lambda item: item[0])]
+
+    def stop(self, timeout=30):
+        """Stops the workers (which finish the updates they have read) and waits for them."""
+        self._stopped.set()
+        with self._lock:
+            self._acked.notify_all()
+            for worker in self._workers:
+                worker.inbox.put(None)
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                logger.warning("Worker %s didn't stop within %ss, terminating it", worker.index, timeout)
+                worker.process.terminate()
+                worker.process.join()
+        self._acks.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        pending = len(self)
+        if pending:
+            logger.warning("%s routed update(s) weren't handled by the workers", pending)
+
+    def _start(self, worker):
+        # The queue of a crashed worker may be broken (e.g. if it died while reading), so every
+        # process gets a new one with the pending updates
+        worker.inbox = self._context.Queue()
+        for sequence, message in worker.unacked.items():
+            worker.inbox.put((sequence,) + message)
+        if worker.unacked and worker.process is not None:
+            RESENT_UPDATES.inc(worker.index, amount=len(worker.unacked))
+            logger.info("Sending %s pending update(s) to worker %s again", len(worker.unacked), worker.index)
+
+        worker.process = self._context.Process(target=self.target, args=(worker.index, worker.inbox, self._acks),
+                                               name="worker_{}".format(worker.index))
+        # The spawned process inherits the environment at start
+        env = self.env(worker.index)
+        previous = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            worker.process.start()
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        worker.started = time.monotonic()
+        worker.restart_at = None
+
+    def _receive_acks(self):
+        while True:
+            ack = self._acks.get()
+            if ack is None:
+                return
+            index, sequences = ack
+            with self._lock:
+                unacked = self._workers[index].unacked
+                for sequence in sequences:
+                    unacked.pop(sequence, None)
+                self._acked.notify_all()
+
+    def _monitor(self):
+        while not self._stopped.wait(0.5):
+            now = time.monotonic()
+            with self._lock:
+                for worker in self._workers:
+                    if worker.process.is_alive() or self._stopped.is_set():
+                        continue
+                    if worker.restart_at is None:
+                        # Workers that keep crashing are restarted with exponential backoff
+                        crashed_soon = now - worker.started < 60
+                        worker.restart_delay = min(60, worker.restart_delay * 2) if crashed_soon else 0
+                        worker.restart_delay = worker.restart_delay or self.restart_delay
+                        worker.restart_at = now + worker.restart_delay
+                        logger.warning("Worker %s exited with code %s, restarting it in %.0fs", worker.index,
+                                       worker.process.exitcode, worker.restart_delay)
+                    elif now >= worker.restart_at:
+                        WORKER_RESTARTS.inc(worker.index)
+                        self._start(worker)
+
+
+def serve(index, inbox, acks, handle, stopped, checkpoint=None, ack_interval=0.25, drain_timeout=10,
+          readmitted=None):
+    """Worker side of the `WorkerPool`: dispatches the routed updates in order and acknowledges
+    them. Returns when the ingress process stops the worker or `stopped` is set, after the running
+    handlers have finished.
+
+    An update is only acknowledged once its handler has finished and its state has been written
+    (`checkpoint`), so a worker that is killed gets all updates again whose effects it might have
+    lost. Updates of which only the reply was lost are handled (and answered) twice.
+
+    Parameters
+    ----------
+    index: int
+        Index of the worker
+    inbox, acks: multiprocessing.Queue
+        Queues of the routed updates and of the acknowledgements
+    handle: function
+        Called with the sequence, the persona and the update (as JSON), returns the `Promise` of the handler
+        that is still running for the update, None, or `DEFERRED` if the update is put on `readmitted` later
+    stopped: threading.Event
+        Set to stop the worker (e.g. on SIGTERM)
+    checkpoint: function, optional
+        Writes the state of the finished handlers, called before updates are acknowledged
+    ack_interval: float, optional
+        Seconds between two acknowledgements. Default: 0.25
+    drain_timeout: float, optional
+        Seconds to wait for the running handlers when the worker stops. Default: 10
+    readmitted: queue.Queue, optional
+        (sequence, persona, update as JSON) of the deferred updates (e.g. delayed by the admission control)
+        when they are due. They are dispatched by `handle` again and acknowledged like the routed ones;
+        deferred updates that are still waiting when the worker stops aren't acknowledged, so the ingress
+        process hands them off
+    """
+    # (sequence, promise or None) of the dispatched updates that haven't been acknowledged
+    dispatched = []
+    last_ack = time.monotonic()
+
+    def acknowledge():
+        finished, running = [], []
+        for sequence, promise in dispatched:
+            if promise is None or promise.done.is_set():
+                finished.append(sequence)
+            else:
+                running.append((sequence, promise))
+        if not finished:
+            return
+        # The handlers have finished before the checkpoint, so it includes their state
+        if checkpoint:
+            try:
+                checkpoint()
+            except Exception:
+                logger.exception("Could not write the state of the handled updates")
+                return
+        # A slow handler doesn't hold back the acknowledgements of the updates after it
+        dispatched[:] = running
+        acks.put((index, finished))
+
+    def dispatch(sequence, persona, data):
+        promise = None
+        try:
+            promise = handle(sequence, persona, data)
+        except Exception:
+            logger.exception("Could not handle routed update %s", sequence)
+        # A deferred update is acknowledged once it has been dispatched again
+        if promise is not DEFERRED:
+            dispatched.append((sequence, promise))
+
+    while not stopped.is_set():
+        while readmitted is not None:
+            try:
+                dispatch(*readmitted.get_nowait())
+            except Empty:
+                break
+        try:
+            item = inbox.get(timeout=0.2)
+        except Empty:
+            item = False
+        if item is None:
+            break
+        if item:
+            dispatch(*item)
+        if dispatched and time.monotonic() - last_ack >= ack_interval:
+            acknowledge()
+            last_ack = time.monotonic()
+
+    # Let the running handlers finish, so their updates needn't be handled again
+    deadline = time.monotonic() + drain_timeout
+    for sequence, promise in dispatched:
+        if promise is not None:
+            promise.done.wait(max(0, deadline - time.monotonic()))
+    acknowledge()
@@ -0,0 +1,115 @@
+import builtins
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def process_start_time():
+    """Time (as time.time) at which the process was started, read from /proc on Linux. Elsewhere the
+    time at which this module was imported."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22 is the start time in clock ticks after boot; the name in field 2 may contain spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+class ImportTimer:
+    """Measures the time of every module imported with an `import` statement while it is installed,
+    like `python -X importtime`: the self time of a module excludes the imports it makes itself, the
+    cumulative time includes them."""
+
+    def __init__(self):
+        # module name -> (self seconds, cumulative seconds)
+        self.times = {}
+        self._local = threading.local()
+        self._import = None
+
+    def install(self):
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def uninstall(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def slowest(self, count=20):
+        """(name, self seconds, cumulative seconds) of the `count` imports with the highest cumulative
+        time."""
+        return sorted(((name,) + times for name, times in self.times.items()), key=lambda item: -item[2])[:count]
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+        stack = self._local.__dict__.setdefault("stack", [])
+        # Time spent in the imports of this module
+        stack.append(0)
+        start = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.times[name] = (elapsed - children, elapsed)
+
+
+class StartupProfile:
+    """Times the phases of the startup (e.g. imports done, receiving, first update handled) from the
+    start of the process. With `profile_imports` the imports are timed as well, and the slowest of
+    them are logged together with the phases once the first update has been handled.
+
+    Parameters
+    ----------
+    profile_imports: bool, optional
+        Whether to time the imports (from now on) and log the report. Default: False
+    """
+
+    def __init__(self, profile_imports=False):
+        self.started = process_start_time()
+        # phase -> seconds after the start of the process
+        self.phases = {}
+        self.import_timer = None
+        self._lock = threading.Lock()
+        if profile_imports:
+            self.import_timer = ImportTimer()
+            self.import_timer.install()
+
+    def mark(self, phase):
+        """Records the time of a phase, unless it has already been recorded (e.g. "first_update")."""
+        if phase in self.phases:
+            return
+        with self._lock:
+            if phase in self.phases:
+                return
+            self.phases[phase] = time.time() - self.started
+        if phase == "first_update":
+            self.report()
+
+    def report(self):
+        """Logs the phases and the slowest imports (only when the imports are profiled)."""
+        if self.import_timer is None:
+            return
+        self.import_timer.uninstall()
+        lines = ["Startup profile, seconds after the start of the process: {}".format(
+            ", ".join("{} {:.3f}".format(phase, seconds) for phase, seconds in self.phases.items()))]
+        lines.append("Slowest imports ({:.3f}s in all), self | cumulative ms:".format(
+            sum(times[0] for times in self.import_timer.times.values())))
+        for name, self_seconds, cumulative in self.import_timer.slowest():
+            lines.append("{:10.1f} | {:10.1f} | {}".format(self_seconds * 1000, cumulative * 1000, name))
+        logger.info("\n".join(lines))
+
+
+# STARTUP_PROFILE=1 logs the startup phases and the slowest imports once the first update has been handled. The
+# imports are timed from here on, so this module is imported before the others.
+PROFILE = StartupProfile(profile_imports=os.environ.get("STARTUP_PROFILE", "0") != "0")
@@ -0,0 +1,169 @@
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+ITEM_API_SECONDS = Histogram("bot_item_api_request_seconds", "Duration of item API requests (single attempts)",
+                             ("path", "status"))
+ITEM_API_RETRIES = Counter("bot_item_api_retries_total", "Retried item API requests", ("path",))
+
+
+class SubmissionError(Exception):
+    pass
+
+
+class ItemResult:
+    """Answer of the item API to one item of a batch submission, with the attributes of a
+    `requests.Response` that the callbacks of the submission queue use.
+
+    Parameters
+    ----------
+    status_code: int
+        HTTP status the item would have been answered with on its own
+    body: dict, optional
+        JSON body of that answer, e.g. {"id": 17}
+    headers: dict, optional
+        Headers of that answer, e.g. {"new-item-created": "True"}
+    """
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = CaseInsensitiveDict(headers or {})
+
+    @property
+    def text(self):
+        return json.dumps(self.body)
+
+    def json(self):
+        if self.body is None:
+            raise ValueError("No JSON body")
+        return self.body
+
+
+class SubmissionClient:
+    """Shared HTTP client for the item API (e.g. `/item_submission`).
+
+    All requests go through one `requests.Session`, so connections (and TLS sessions) to the API
+    are pooled and reused. Requests are run on the client's own thread pool, which keeps a slow
+    backend from blocking the dispatcher. Failed requests (connection errors, timeouts, 5xx) are
+    retried with jittered exponential backoff until the per-request deadline is reached.
+
+    Parameters
+    ----------
+    base_url: string
+        Base URL of the item API, e.g. "https://api.dev.detective-collective.org"
+    pool_size: int, optional
+        Number of pooled connections and worker threads. Default: 8
+    timeout: tuple, optional
+        (connect, read) timeout of a single attempt in seconds. Default: (3.05, 10)
+    deadline: float, optional
+        Maximum time for a request including all retries (in seconds). Default: 30
+    retries: int, optional
+        Maximum number of retries after the first attempt. Default: 3
+    backoff: float, optional
+        Base of the exponential backoff between retries (in seconds). Default: 0.5
+    keep_warm_interval: float, optional
+        Idle time after which a pooled connection is refreshed (in seconds). Default: 60
+    """
+
+    def __init__(self, base_url, pool_size=8, timeout=(3.05, 10), deadline=30, retries=3, backoff=0.5,
+                 keep_warm_interval=60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.keep_warm_interval = keep_warm_interval
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="item_api")
+
+        self._last_used = 0
+        self._stopped = threading.Event()
+        self._keep_warm_thread = None
+
+    def submit(self, path, payload, headers=None, compress=False):
+        """Posts `payload` as JSON to `path` on the client's thread pool.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the `requests.Response` or raises a `SubmissionError`
+        """
+        return self.executor.submit(self.post, path, payload, headers, compress)
+
+    def post(self, path, payload, headers=None, compress=False):
+        """Posts `payload` as JSON to `path` and retries on connection errors, timeouts and 5xx
+        responses. With `compress` the body is sent gzip-compressed (`Content-Encoding: gzip`).
+        Blocks the calling thread; use `submit` from handlers."""
+        url = "{}{}".format(self.base_url, path)
+        data = json.dumps(payload)
+        if compress:
+            # Compressed once, the retries send the same bytes
+            data = gzip.compress(data.encode("utf-8"), compresslevel=6)
+            headers = dict(headers or {}, **{"Content-Encoding": "gzip", "Content-Type": "application/json"})
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            remaining = deadline - time.monotonic()
+            start = time.perf_counter()
+            try:
+                response = self.session.post(url, data=data, headers=headers,
+                                             timeout=(self.timeout[0], max(0.1, min(self.timeout[1], remaining))))
+                self._last_used = time.monotonic()
+                ITEM_API_SECONDS.observe(time.perf_counter() - start, path, response.status_code)
+                if response.status_code < 500:
+                    return response
+                error = "HTTP {}".format(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                ITEM_API_SECONDS.observe(time.perf_counter() - start, path, type(e).__name__)
+                error = e
+
+            attempt += 1
+            # "Full jitter" backoff, so that retries of many clients don't hit the API at once
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if attempt > self.retries or time.monotonic() + delay >= deadline:
+                raise SubmissionError("POST {} failed after {} attempt(s): {}".format(url, attempt, error))
+
+            logger.warning("POST %s failed (%s), retrying in %.2fs", url, error, delay)
+            ITEM_API_RETRIES.inc(path)
+            time.sleep(delay)
+
+    def start_keep_warm(self):
+        """Starts a background thread that refreshes an idle pooled connection, so that the next
+        submission doesn't have to pay for a new TCP and TLS handshake."""
+        if self._keep_warm_thread is None:
+            self._keep_warm_thread = threading.Thread(target=self._keep_warm, name="item_api_keep_warm", daemon=True)
+            self._keep_warm_thread.start()
+
+    def _keep_warm(self):
+        while not self._stopped.wait(self.keep_warm_interval):
+            if time.monotonic() - self._last_used < self.keep_warm_interval:
+                continue
+            try:
+                self.session.head(self.base_url, timeout=self.timeout)
+                self._last_used = time.monotonic()
+            except requests.RequestException as e:
+                logger.debug("Keep-warm request to %s failed: %s", self.base_url, e)
+
+    def close(self, wait=True):
+        """Stops the keep-warm thread, waits for pending requests (if `wait`) and closes the pool."""
+        self._stopped.set()
+        self.executor.shutdown(wait=wait)
+        self.session.close()
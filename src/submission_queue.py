@@ -0,0 +1,298 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import wait
+from email.utils import parsedate_to_datetime
+
+from logs import event
+from metrics import Counter, Histogram
+from submission_client import ItemResult, SubmissionError
+
+logger = logging.getLogger(__name__)
+
+SUBMISSION_REQUESTS = Counter("bot_submission_requests_total", "Requests that sent item submissions", ("kind",))
+SUBMISSION_BATCH_SIZE = Histogram("bot_submission_batch_size", "Item submissions per batch request",
+                                  buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+# Answers that don't reject the submission itself: it is sent again later (after Retry-After, if given)
+RETRY_STATUSES = (408, 429)
+
+
+def retry_after(response):
+    """Seconds the `Retry-After` header of a response asks to wait, or None."""
+    value = (getattr(response, "headers", None) or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class SubmissionQueue:
+    """Durable write-behind queue for item submissions.
+
+    `put` appends a submission to a SQLite database (WAL mode) and returns right away. A background
+    drainer posts the queued submissions to the item API in batches through a `SubmissionClient`
+    and only removes them once the API has answered, so delivery is at-least-once. Every entry
+    carries an idempotency key (sent as `Idempotency-Key` header), which stays the same across
+    retries. Entries that are still queued when the process stops are sent after the next start.
+
+    With a `batch_endpoint` the drainer collects submissions for up to `batch_window` seconds (or
+    until `batch_size` are due) and sends them in one gzip-compressed request:
+
+        {"items": [{"idempotency_key": "...", "item": {...}}, ...]}
+
+    which the API answers with the result of every item, as it would have answered the item alone:
+
+        {"results": [{"idempotency_key": "...", "status": 201, "body": {"id": 17}, "new_item_created": true}, ...]}
+
+    The results are mapped back to the entries by idempotency key and passed to `on_result` (as
+    `ItemResult`), so every submission is handled like after a single request. Items without
+    result or with a 5xx status are retried. If the API doesn't answer the batch with 200, the
+    entries are sent one by one; on 404 or 405 (no batch endpoint) batching is switched off.
+
+    Answers with 408 or 429 (to the batch or to an item) don't reject a submission, it is sent
+    again after the time given by `Retry-After` or after a backoff. Errors of the drainer itself
+    (e.g. a locked database or a failing `on_result`) are logged, the entries stay queued.
+
+    Parameters
+    ----------
+    path: string
+        Path of the SQLite database file, opened (and created) on first use
+    client: SubmissionClient
+        Client used to post the submissions
+    endpoint: string, optional
+        Path of the submission endpoint. Default: "/item_submission"
+    batch_size: int, optional
+        Maximum number of submissions sent by one drain step (concurrently or in one batch request).
+        Default: 20
+    poll_interval: float, optional
+        How often the drainer looks for due entries when it isn't woken up (in seconds). Default: 5
+    max_backoff: float, optional
+        Maximum delay before a failed submission is tried again (in seconds). Default: 300
+    on_result: callable, optional
+        Called with (idempotency key, submission, response) once a submission was answered
+    batch_endpoint: string, optional
+        Path of the batch submission endpoint, e.g. "/item_submissions". Default: None (no batches)
+    batch_window: float, optional
+        Seconds a batch waits for more submissions before it is sent. Default: 0.5
+    """
+
+    def __init__(self, path, client, endpoint="/item_submission", batch_size=20, poll_interval=5, max_backoff=300,
+                 on_result=None, batch_endpoint=None, batch_window=0.5):
+        self.client = client
+        self.endpoint = endpoint
+        self.batch_endpoint = batch_endpoint
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.on_result = on_result
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._flushing = False
+        self._drainer = None
+
+    @property
+    def _conn(self):
+        # Opened on first use (with the lock held), so creating the queue doesn't create the file
+        if self._connection is None:
+            self._connection = self._connect()
+        return self._connection
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL only risks the last transactions on power loss, not on a process crash
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS submissions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                not_before REAL NOT NULL DEFAULT 0
+            )""")
+        return conn
+
+    def put(self, submission):
+        """Appends a submission to the queue and returns its idempotency key."""
+        key = str(uuid.uuid4())
+        with self._lock:
+            self._conn.execute("INSERT INTO submissions (idempotency_key, payload) VALUES (?, ?)",
+                               (key, json.dumps(submission)))
+        self._wakeup.set()
+        return key
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+
+    def start(self):
+        """Starts the background drainer. Entries left over from a previous run are sent first."""
+        if self._drainer is None:
+            pending = len(self)
+            if pending:
+                logger.info("Replaying %s queued item submission(s)", pending)
+            self._drainer = threading.Thread(target=self._drain, name="submission_queue", daemon=True)
+            self._drainer.start()
+
+    def flush(self):
+        """Sends the queued entries right away, e.g. on shutdown before `stop`: the entries waiting to
+        be retried are tried once more, and from now on batches don't wait for `batch_window`."""
+        self._flushing = True
+        with self._lock:
+            self._conn.execute("UPDATE submissions SET not_before = 0")
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        """Stops the drainer after its current batch. Queued entries stay on disk (call `flush` and wait
+        until the queue is empty to send them first)."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._drainer is not None:
+            self._drainer.join(timeout)
+            self._drainer = None
+
+    def _due_entries(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, idempotency_key, payload, attempts FROM submissions WHERE not_before <= ? "
+                "ORDER BY id LIMIT ?", (time.time(), self.batch_size)).fetchall()
+
+    def _drain(self):
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                entries = self._due_entries()
+                if not entries:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+
+                if self.batch_endpoint:
+                    self._send_batch(self._fill_batch(entries))
+                else:
+                    self._send_each(entries)
+                failures = 0
+            except Exception:
+                # The entries stay queued, the drainer must not die (e.g. on a locked database)
+                failures += 1
+                delay = min(self.max_backoff, random.uniform(1, 2 ** failures))
+                logger.exception("Sending the queued item submissions failed, trying again in %.0fs", delay)
+                self._stopped.wait(delay)
+
+    def _fill_batch(self, entries):
+        """Waits up to `batch_window` for more due entries, until the batch is full."""
+        deadline = time.monotonic() + self.batch_window
+        while len(entries) < self.batch_size and not self._stopped.is_set() and not self._flushing:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._wakeup.wait(remaining)
+            self._wakeup.clear()
+            entries = self._due_entries()
+        return entries
+
+    def _send_each(self, entries):
+        futures = {}
+        for entry in entries:
+            _, key, payload, _ = entry
+            future = self.client.submit(self.endpoint, json.loads(payload), headers={"Idempotency-Key": key})
+            futures[future] = entry
+        SUBMISSION_REQUESTS.inc("single", amount=len(futures))
+        wait(futures)
+
+        for future, (row_id, key, payload, attempts) in futures.items():
+            try:
+                response = future.result()
+            except Exception as e:
+                # SubmissionError, but also e.g. a ChunkedEncodingError while reading the answer
+                self._retry_later(row_id, attempts, e)
+                continue
+            self._finish(row_id, key, payload, attempts, response)
+
+    def _send_batch(self, entries):
+        items = [{"idempotency_key": key, "item": json.loads(payload)} for _, key, payload, _ in entries]
+        SUBMISSION_REQUESTS.inc("batch")
+        SUBMISSION_BATCH_SIZE.observe(len(items))
+        try:
+            response = self.client.post(self.batch_endpoint, {"items": items}, compress=True)
+        except SubmissionError as e:
+            for row_id, _, _, attempts in entries:
+                self._retry_later(row_id, attempts, e)
+            return
+
+        if response.status_code in RETRY_STATUSES:
+            delay = retry_after(response)
+            for row_id, _, _, attempts in entries:
+                self._retry_later(row_id, attempts, "HTTP {}".format(response.status_code), delay)
+            return
+        if response.status_code != 200:
+            if response.status_code in (404, 405):
+                logger.warning("The item API has no batch endpoint %s, sending item submissions one by one",
+                               self.batch_endpoint)
+                self.batch_endpoint = None
+            else:
+                logger.warning("Batch of %s item submissions was answered with %s, sending them one by one",
+                               len(entries), response.status_code)
+            return self._send_each(entries)
+
+        try:
+            results = {result["idempotency_key"]: result for result in response.json()["results"]}
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Invalid answer to a batch of item submissions, sending them one by one: %s", e)
+            return self._send_each(entries)
+        for row_id, key, payload, attempts in entries:
+            result = results.get(key)
+            if result is None or result.get("status", 500) >= 500 or result.get("status") in RETRY_STATUSES:
+                self._retry_later(row_id, attempts, "no result in the batch" if result is None else
+                                  "HTTP {} in the batch".format(result.get("status")))
+                continue
+            headers = {}
+            if "new_item_created" in result:
+                headers["new-item-created"] = str(bool(result["new_item_created"]))
+            self._finish(row_id, key, payload, attempts, ItemResult(result["status"], result.get("body"), headers))
+
+    def _finish(self, row_id, key, payload, attempts, response):
+        if response.status_code in RETRY_STATUSES:
+            # Rate limited or timed out, not rejected
+            self._retry_later(row_id, attempts, "HTTP {}".format(response.status_code), retry_after(response))
+            return
+        if response.status_code >= 400:
+            # The API rejected the submission itself, retrying it won't help
+            logger.error("Item submission %s was rejected with %s", key, response.status_code,
+                         extra=event("submission_rejected", key=key, status=response.status_code, body=response.text))
+        with self._lock:
+            self._conn.execute("DELETE FROM submissions WHERE id = ?", (row_id,))
+        if self.on_result is not None:
+            try:
+                self.on_result(key, json.loads(payload), response)
+            except Exception:
+                # The submission has been answered, so it isn't sent again
+                logger.exception("Handling the answer to item submission %s failed", key)
+
+    def _retry_later(self, row_id, attempts, error, delay=None):
+        """Sends an entry again after `delay` seconds (e.g. from Retry-After), by default after an
+        exponential backoff with jitter."""
+        if delay is None:
+            delay = random.uniform(1, 2 ** (attempts + 1))
+        delay = min(self.max_backoff, delay)
+        logger.warning("Item submission failed (%s attempt(s)), retrying in %.0fs: %s", attempts + 1, delay, error)
+        with self._lock:
+            self._conn.execute("UPDATE submissions SET attempts = attempts + 1, not_before = ? WHERE id = ?",
+                               (time.time() + delay, row_id))
@@ -1,21 +1,61 @@
+# Imported first, so that it can time the other imports (STARTUP_PROFILE=1)
+import startup
 import os
-from telegram import *
-from telegram.ext import *
+import asyncio
+import signal
+from telegram import Bot, ChatAction, InlineQueryResultArticle, InputTextMessageContent, ParseMode, Update
+from telegram.ext import (CommandHandler, ConversationHandler, Filters, InlineQueryHandler, JobQueue,
+                          MessageHandler, Updater)
+from telegram.error import TelegramError
+from telegram.utils.promise import Promise
 import logging
+import threading
+import time
 from time import sleep
 from functools import wraps
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
 import json
-import boto3
-import base64
-from botocore.exceptions import ClientError
-
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO)
+import aio
+import logs
+from logs import event, sampled
+from submission_client import SubmissionClient
+from submission_queue import SubmissionQueue
+from outbound import PRIORITY_NOTIFICATION, OutboundScheduler
+from dedup import DuplicateIndex
+from drafts import ContentStore, Draft
+from media import MediaError, MediaTooLarge, MediaUploader, forward_origin, message_media
+from notifications import CaseNotifier, SubscriberIndex
+from search import SearchIndex
+from admission import AdmissionControl, Blocklist, SlidingWindowLimiter
+from conversations import IdleConversationHandler
+from persistence import RedisPersistence, SQLitePersistence
+from sharding import DEFERRED, ShardRouter, WorkerPool, serve
+from routing import KeyboardRegistry, Menu, Option
+import catalog
+from metrics import Counter, Gauge, Histogram, InstrumentedRequest, start_http_server
+from health import HEALTH, HealthHandler
+from secrets_provider import (CachedSecretProvider, EnvSecretSource, FileSecretSource, SecretError,
+                              SecretsManagerSource)
+
+startup.PROFILE.mark("imports")
+
+# Log records are written by a background thread, as JSON lines (LOG_FORMAT "json") or as text ("text").
+# User names and texts in the fields of the records are pseudonymized unless LOG_REDACT is "0"; set
+# LOG_REDACTION_KEY to keep the pseudonyms across restarts. The records of every conversation step are only
+# written with the probability LOG_SAMPLE_RATE.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_REDACT = os.environ.get("LOG_REDACT", "1") != "0"
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.1"))
+logs.setup(level=LOG_LEVEL, format=LOG_FORMAT, redact=LOG_REDACT, key=os.environ.get("LOG_REDACTION_KEY"),
+           queue_size=int(os.environ.get("LOG_QUEUE_SIZE", "10000")))
 
 logger = logging.getLogger(__name__)
 
 GDPR, CONTENT, ADD_INFO, CONTACT, FREQUENCY, CHANNEL, SUBMIT = range(7)
+STATE_NAMES = {GDPR: "GDPR", CONTENT: "CONTENT", ADD_INFO: "ADD_INFO", CONTACT: "CONTACT", FREQUENCY: "FREQUENCY",
+               CHANNEL: "CHANNEL", SUBMIT: "SUBMIT", ConversationHandler.END: "END"}
 
 # For API calls and web links (e.g. to the archive)
 API_PREFIX = "dev."
@@ -30,49 +70,351 @@ except KeyError:
     # if environment variable is not set (e.g. in local debugging): use local dev bot token
     SECRET_NAME = "telegram_bot_token_local_dev"
 
+# Where secrets (bot tokens) are read from: "secretsmanager" (AWS), "env" (environment variable named like
+# the secret in upper case) or "file" (one file per secret in SECRETS_DIR). Secrets are cached and read again
+# after SECRET_TTL seconds, so a rotated bot token is picked up without a restart.
+SECRET_SOURCE = os.environ.get("SECRET_SOURCE", "secretsmanager")
+SECRETS_DIR = os.environ.get("SECRETS_DIR", "/run/secrets")
+SECRET_TTL = float(os.environ.get("SECRET_TTL", "3600"))
+
+# Personas (text catalogs, see catalog.py) served by this process, each with its own bot token
+BOT_PERSONAS = os.environ.get("BOT_PERSONAS", catalog.DEFAULT_PERSONA).split(",")
+
+# With WORKERS > 0 this process only receives the updates and routes them by the hash of their chat id to
+# WORKERS worker processes (see sharding.py), which handle the conversations. Every worker has its own
+# submission queue and SQLite persistence, in files with the suffix "_<index>" (worker 0 uses the files of
+# the single-process mode), and sends at most OUTBOUND_GLOBAL_RATE / WORKERS messages per second. The
+# duplicate index is per worker, so repeated submissions are only found within the chats of a worker.
+WORKERS = int(os.environ.get("WORKERS", "0"))
+# Set by the ingress process for its workers
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if "WORKER_INDEX" in os.environ else None
+
+
+def worker_path(path):
+    """Returns the path of a worker's own copy of a file (e.g. bot_state_2.db for worker 2)."""
+    if not WORKER_INDEX:
+        return path
+    root, ext = os.path.splitext(path)
+    return "{}_{}{}".format(root, WORKER_INDEX, ext)
+
+
+# Size of the thread pool that runs the handlers of all personas
+HANDLER_WORKERS = int(os.environ.get("HANDLER_WORKERS", "8"))
+handler_pool = ThreadPoolExecutor(max_workers=HANDLER_WORKERS, thread_name_prefix="handler")
+
+# How the `typing` decorator delays and runs the handlers: "asyncio" (the handler coroutines share one
+# event loop), "scheduled" (JobQueue and handler pool, does not block the dispatcher) or "sleep" (blocks
+# the dispatcher thread for the typing delay)
+TYPING_MODE = os.environ.get("TYPING_MODE", "asyncio")
+event_loop = aio.EventLoopThread()
+TYPING_SECONDS = float(os.environ.get("TYPING_SECONDS", "0.75"))
+
+# All outgoing messages and chat actions are sent by the outbound scheduler, which keeps within Telegram's
+# flood limits (OUTBOUND_GLOBAL_RATE messages per second over all chats, OUTBOUND_CHAT_RATE per chat). The
+# defaults are slightly below the documented limits (30/s and 1/s), as varying request latencies can
+# bunch up the calls on Telegram's side.
+OUTBOUND_SENDERS = int(os.environ.get("OUTBOUND_SENDERS", "4"))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "28"))
+if WORKER_INDEX is not None:
+    OUTBOUND_GLOBAL_RATE /= max(1, WORKERS)
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "0.95"))
+outbound = OutboundScheduler(senders=OUTBOUND_SENDERS, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE)
+
+# Base URLs of the Bot API (e.g. a local Bot API server) and of the item API
+BOT_API_URL = os.environ.get("BOT_API_URL", "https://api.telegram.org")
+ITEM_API_URL = os.environ.get("ITEM_API_URL", "https://api.{}detective-collective.org".format(API_PREFIX))
+
+# Shared, pooled client for the item API
+submission_client = SubmissionClient(ITEM_API_URL)
+
+# How updates are received: "polling" (single long-poll loop) or "webhook" (HTTP server for the updates
+# Telegram pushes to WEBHOOK_URL; several replicas can run behind a load balancer). The webhook of a persona is
+# WEBHOOK_URL/WEBHOOK_PATH/<persona>: WEBHOOK_PATH is a secret shared by the replicas (it authenticates Telegram)
+# and doesn't change with the bot token, so a rotated token doesn't break the delivery or end up in the URL.
+UPDATE_MODE = os.environ.get("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "").strip("/")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+# Maximum number of concurrent HTTPS connections Telegram opens to the webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "100"))
+
+# Port of the HTTP endpoint with the Prometheus metrics (/metrics), 0 to disable it. Worker processes
+# serve their metrics on the following ports (METRICS_PORT + 1 + index).
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+if METRICS_PORT and WORKER_INDEX is not None:
+    METRICS_PORT += 1 + WORKER_INDEX
+# The same port serves /healthz (liveness: the dispatchers and the event loop work) and /readyz (readiness: the
+# bot receives updates and isn't shutting down) for the health checks of the orchestrator and the load balancer.
+
+# On SIGTERM (or SIGINT) the bot stops receiving updates and is no longer ready, handles the updates it has
+# received and waits for the running handlers, the queued item submissions (see SUBMISSION_QUEUE_PATH) and the
+# queued messages, for at most DRAIN_TIMEOUT seconds. The last long poll can take another 10 seconds, keep both
+# below the time the orchestrator waits before SIGKILL (e.g. the stopTimeout of ECS, 30 seconds by default). Updates
+# that weren't handled by then are written to HANDOFF_DIR, from where the bot picks them up every HANDOFF_INTERVAL
+# seconds. Mount a volume shared by the replicas there, so that the instance that replaces this one handles them.
+# Item submissions that weren't delivered are logged and stay in the submission queue.
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "15"))
+HANDOFF_DIR = os.environ.get("HANDOFF_DIR", "handoff")
+HANDOFF_INTERVAL = float(os.environ.get("HANDOFF_INTERVAL", "5"))
+
+# Location of the on-disk queue of item submissions (mount a volume here to keep it across containers)
+SUBMISSION_QUEUE_PATH = worker_path(os.environ.get("SUBMISSION_QUEUE_PATH", "submission_queue.db"))
+# Queued submissions are sent to SUBMISSION_BATCH_ENDPOINT in gzip-compressed batches of up to SUBMISSION_BATCH_SIZE,
+# collected for SUBMISSION_BATCH_WINDOW seconds. An empty SUBMISSION_BATCH_ENDPOINT sends every submission to
+# /item_submission on its own (SUBMISSION_BATCH_SIZE at once), as does an item API without the batch endpoint.
+SUBMISSION_BATCH_ENDPOINT = os.environ.get("SUBMISSION_BATCH_ENDPOINT", "/item_submissions") or None
+SUBMISSION_BATCH_SIZE = int(os.environ.get("SUBMISSION_BATCH_SIZE", "100"))
+SUBMISSION_BATCH_WINDOW = float(os.environ.get("SUBMISSION_BATCH_WINDOW", "0.5"))
+
+# Where conversation states and user data are stored: "sqlite" (PERSISTENCE_PATH), "redis" (REDIS_URL)
+# or "none" (memory only)
+PERSISTENCE = os.environ.get("PERSISTENCE", "sqlite")
+PERSISTENCE_PATH = worker_path(os.environ.get("PERSISTENCE_PATH", "bot_state.db"))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", "5"))
+
+# Recently submitted texts are indexed, so that repeated submissions of the same message are answered
+# right away (DEDUP_MAX_ITEMS texts, kept for DEDUP_TTL seconds after they were last seen; 0 disables it)
+DEDUP_MAX_ITEMS = int(os.environ.get("DEDUP_MAX_ITEMS", "100000"))
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", str(30 * 24 * 3600)))
+duplicates = DuplicateIndex(max_items=DEDUP_MAX_ITEMS, ttl=DEDUP_TTL) if DEDUP_MAX_ITEMS else None
+
+# Conversations without an update for CONVERSATION_IDLE_TIMEOUT seconds are ended and their user data is
+# dropped, checked every CONVERSATION_SWEEP_INTERVAL seconds
+CONVERSATION_IDLE_TIMEOUT = float(os.environ.get("CONVERSATION_IDLE_TIMEOUT", str(6 * 3600)))
+CONVERSATION_SWEEP_INTERVAL = float(os.environ.get("CONVERSATION_SWEEP_INTERVAL", "60"))
+
+# Texts to check are truncated to CONTENT_MAX_CHARS characters. Until they are submitted, texts longer than
+# CONTENT_INLINE_CHARS are kept in files in CONTENT_DIR instead of in memory.
+CONTENT_DIR = os.environ.get("CONTENT_DIR", "drafts")
+CONTENT_INLINE_CHARS = int(os.environ.get("CONTENT_INLINE_CHARS", "1024"))
+CONTENT_MAX_CHARS = int(os.environ.get("CONTENT_MAX_CHARS", "4096"))
+content_store = ContentStore(CONTENT_DIR, inline_chars=CONTENT_INLINE_CHARS, max_chars=CONTENT_MAX_CHARS)
+
+# Photos, videos, voice messages etc. are streamed from Telegram to MEDIA_UPLOAD_URL, at most MEDIA_TRANSFERS
+# at once. Bots can only download files up to 20 MB.
+MEDIA_UPLOAD_URL = os.environ.get("MEDIA_UPLOAD_URL", "{}/media".format(ITEM_API_URL))
+MEDIA_MAX_BYTES = int(os.environ.get("MEDIA_MAX_BYTES", str(20 * 2 ** 20)))
+MEDIA_TRANSFERS = int(os.environ.get("MEDIA_TRANSFERS", "4"))
+media_uploader = MediaUploader(MEDIA_UPLOAD_URL, max_bytes=MEDIA_MAX_BYTES, max_transfers=MEDIA_TRANSFERS)
+
+# Submitters (and users whose message had already been submitted) are notified when their case is resolved.
+# NOTIFICATION_POLL_URL is polled for resolved cases every NOTIFICATION_POLL_INTERVAL seconds (0 disables the
+# notifications), the notifications of a case are queued in batches of NOTIFICATION_BATCH_SIZE behind the
+# conversation replies. The chats to notify are kept in NOTIFICATION_PATH for NOTIFICATION_TTL seconds.
+NOTIFICATION_POLL_URL = os.environ.get("NOTIFICATION_POLL_URL", "{}/resolved_items".format(ITEM_API_URL))
+NOTIFICATION_POLL_INTERVAL = float(os.environ.get("NOTIFICATION_POLL_INTERVAL", "60"))
+NOTIFICATION_BATCH_SIZE = int(os.environ.get("NOTIFICATION_BATCH_SIZE", "500"))
+NOTIFICATION_PATH = worker_path(os.environ.get("NOTIFICATION_PATH", "notifications.db"))
+NOTIFICATION_TTL = float(os.environ.get("NOTIFICATION_TTL", str(180 * 24 * 3600)))
+subscribers = SubscriberIndex(NOTIFICATION_PATH, ttl=NOTIFICATION_TTL) if NOTIFICATION_POLL_INTERVAL else None
+# Bot of every persona, for the notifications
+_bots = {}
+# Webhook URL of every persona this process receives the updates of (UPDATE_MODE webhook)
+_webhook_urls = {}
+
+# Inline queries ("@<bot> impfung" in any chat) and /search are answered from a local index of the closed cases,
+# which is kept in SEARCH_INDEX_PATH and synced from SEARCH_SYNC_URL every SEARCH_SYNC_INTERVAL seconds (0 disables
+# the sync). After SEARCH_MERGE_CASES synced cases the index file is rewritten. Inline mode has to be enabled for
+# the bot with BotFather (/setinline).
+SEARCH_SYNC_URL = os.environ.get("SEARCH_SYNC_URL", "{}/resolved_items".format(ITEM_API_URL))
+SEARCH_SYNC_INTERVAL = float(os.environ.get("SEARCH_SYNC_INTERVAL", "300"))
+SEARCH_INDEX_PATH = worker_path(os.environ.get("SEARCH_INDEX_PATH", "search_index.bin"))
+SEARCH_MERGE_CASES = int(os.environ.get("SEARCH_MERGE_CASES", "5000"))
+search_index = SearchIndex(SEARCH_INDEX_PATH, sync_url=SEARCH_SYNC_URL if SEARCH_SYNC_INTERVAL else None,
+                           sync_interval=SEARCH_SYNC_INTERVAL, merge_cases=SEARCH_MERGE_CASES)
+
+# Admission control before the conversation: updates of the ids in BLOCKLIST_PATH (one per line, shared by all
+# workers and replicas) are ignored, as are updates of users and chats above ADMISSION_USER_LIMIT and
+# ADMISSION_CHAT_LIMIT updates and users above ADMISSION_START_LIMIT /start commands per ADMISSION_WINDOW
+# seconds. Inline queries (one per keystroke) only count against ADMISSION_INLINE_LIMIT per user and ADMISSION_WINDOW
+# seconds. While more than ADMISSION_DELAY_DEPTH updates are waiting or being handled, updates that don't continue
+# a conversation are handled ADMISSION_DELAY seconds later, above ADMISSION_SHED_DEPTH they are dropped.
+ADMISSION_WINDOW = float(os.environ.get("ADMISSION_WINDOW", "60"))
+ADMISSION_USER_LIMIT = int(os.environ.get("ADMISSION_USER_LIMIT", "30"))
+ADMISSION_CHAT_LIMIT = int(os.environ.get("ADMISSION_CHAT_LIMIT", "60"))
+ADMISSION_START_LIMIT = int(os.environ.get("ADMISSION_START_LIMIT", "5"))
+ADMISSION_INLINE_LIMIT = int(os.environ.get("ADMISSION_INLINE_LIMIT", "120"))
+ADMISSION_DELAY_DEPTH = int(os.environ.get("ADMISSION_DELAY_DEPTH", "1000"))
+ADMISSION_SHED_DEPTH = int(os.environ.get("ADMISSION_SHED_DEPTH", "5000"))
+ADMISSION_DELAY = float(os.environ.get("ADMISSION_DELAY", "2"))
+BLOCKLIST_PATH = os.environ.get("BLOCKLIST_PATH")
+# Shared by the personas, so the limits are per user and not per bot
+user_limiter = SlidingWindowLimiter(ADMISSION_USER_LIMIT, ADMISSION_WINDOW)
+chat_limiter = SlidingWindowLimiter(ADMISSION_CHAT_LIMIT, ADMISSION_WINDOW)
+start_limiter = SlidingWindowLimiter(ADMISSION_START_LIMIT, ADMISSION_WINDOW)
+inline_limiter = SlidingWindowLimiter(ADMISSION_INLINE_LIMIT, ADMISSION_WINDOW)
+blocklist = Blocklist(BLOCKLIST_PATH) if BLOCKLIST_PATH else None
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds",
+                            "Run time of the conversation handlers (until their messages are delivered)", ("handler",))
+TYPING_DELAY = Histogram("bot_typing_delay_seconds",
+                         "Time from receiving an update until its handler runs (typing delay and waiting for a worker)",
+                         ("handler",))
+STATES_ENTERED = Counter("bot_conversation_states_total", "Conversation states entered", ("state",))
+DUPLICATES_FOUND = Counter("bot_duplicate_submissions_total", "Submitted texts that were already submitted",
+                           ("match",))
+IDLE_CONVERSATIONS_ENDED = Counter("bot_idle_conversations_ended_total",
+                                   "Conversations ended after CONVERSATION_IDLE_TIMEOUT without an update", ("persona",))
+_busy_workers = 0
+_busy_workers_lock = threading.Lock()
+# Handlers that have been started by the `typing` decorator and haven't finished, and their updates
+# (id of the update object -> (persona, update)), which are handed off if the handlers don't finish while draining
+_pending_handlers = 0
+_pending_updates = {}
+
 
 class TelegramTokenError(Exception):
     pass
 
-def get_telegram_token():
-    """Gets the telegram bot token for the respective stage (dev/qa/prod) from the secrets manager.
+
+def get_secret_source():
+    """Creates the secret source configured by `SECRET_SOURCE`."""
+    if SECRET_SOURCE == "env":
+        return EnvSecretSource()
+    if SECRET_SOURCE == "file":
+        return FileSecretSource(SECRETS_DIR)
+    return SecretsManagerSource(region_name='eu-central-1')
+
+
+secrets = CachedSecretProvider(get_secret_source(), ttl=SECRET_TTL)
+
+
+def get_telegram_token(secret_name=SECRET_NAME):
+    """Gets the telegram bot token for the respective stage (dev/qa/prod) from the secret source.
+    The token is cached for SECRET_TTL seconds.
+
     Parameters
     ----------
-    is_test: boolean
-        If this method is called from a test
-    SECRET_NAME: string
-        The name of the telegram bot token in the secrets manager
+    secret_name: string, optional
+        The name of the telegram bot token in the secrets manager. Default: SECRET_NAME
     """
+    try:
+        return secrets.get(secret_name)
+    except SecretError as e:
+        logger.exception("Could not get telegram bot token %s: %s", secret_name, e)
+        raise TelegramTokenError
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name='eu-central-1'
-    )
 
+def get_persona_token(persona):
+    """Gets the bot token of a persona: from the environment variable TELEGRAM_BOT_TOKEN_<PERSONA> if
+    set, else from the secret source (SECRET_NAME for the default persona, SECRET_NAME_<persona> for
+    the others)."""
+    token = os.environ.get("TELEGRAM_BOT_TOKEN_{}".format(persona.upper()))
+    if token:
+        return token
+    if persona == catalog.DEFAULT_PERSONA:
+        return get_telegram_token()
+    return get_telegram_token("{}_{}".format(SECRET_NAME, persona))
+
+
+def refresh_token(context):
+    """Repeating job: switches the bot to a rotated token once the secret has changed."""
+    bot = context.bot
+    token = get_persona_token(context.bot_data["persona"])
+    if token != bot.token:
+        logger.info("Bot token of persona %s was rotated", context.bot_data["persona"])
+        bot.token = token
+        bot.base_url = "{}/bot{}".format(BOT_API_URL, token)
+        bot.base_file_url = "{}/file/bot{}".format(BOT_API_URL, token)
+        url = _webhook_urls.get(context.bot_data["persona"])
+        if url:
+            # Registered again with the new token, the URL stays the same
+            try:
+                bot.set_webhook(url, max_connections=WEBHOOK_MAX_CONNECTIONS)
+            except TelegramError:
+                logger.exception("Could not register the webhook of persona %s again", context.bot_data["persona"])
+
+
+def sweep_conversations(context):
+    """Repeating job: ends the conversations of the persona that have been idle for too long."""
+    ended = context.job.context.sweep()
+    if ended:
+        IDLE_CONVERSATIONS_ENDED.inc(context.bot_data["persona"], amount=ended)
+
+
+def drop_idle_user(dispatcher, key):
+    """Drops the user data (with the draft) and the empty chat data of an idle conversation."""
+    chat_id, user_id = key
+    user_data = dispatcher.user_data.pop(user_id, None)
+    if user_data:
+        discard_draft(user_data)
+        if dispatcher.persistence:
+            dispatcher.persistence.update_user_data(user_id, {})
+    if not dispatcher.chat_data.get(chat_id):
+        dispatcher.chat_data.pop(chat_id, None)
+
+
+def _run_pooled(promise):
+    """Runs a handler promise on the handler pool and keeps track of the busy workers."""
+    global _busy_workers
+    with _busy_workers_lock:
+        _busy_workers += 1
     try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=SECRET_NAME
-        )
+        promise.run()
+    finally:
+        with _busy_workers_lock:
+            _busy_workers -= 1
 
-        print(get_secret_value_response)
 
-        # Decrypts secret using the associated KMS CMK.
-        secret = get_secret_value_response['SecretString']
-        telegram_bot_token = json.loads(secret)[SECRET_NAME]
+def _run_delayed_handler(context):
+    """JobQueue callback of the scheduled `typing` mode: hands the delayed handler
+    (stored as a `Promise` in the job context) to the shared handler pool."""
+    handler_pool.submit(_run_pooled, context.job.context)
 
-        return telegram_bot_token
 
-    except ClientError as e:
-        logging.exception("Could not get telegram bot token from the secrets manager. Secrets manager error: {}".format(
-            e.response['Error']['Code']))
-        raise TelegramTokenError
+async def _run_handler(function, received, update, context, *args, **kwargs):
+    """Runs a conversation handler coroutine and records its metrics. `received` is the time
+    (time.perf_counter) at which the update reached the `typing` decorator."""
+    global _pending_handlers
+    name = function.__name__
+    TYPING_DELAY.observe(time.perf_counter() - received, name)
+    try:
+        with HANDLER_SECONDS.time(name):
+            state = await function(update, context, *args, **kwargs)
+    finally:
+        with _busy_workers_lock:
+            _pending_handlers -= 1
+            _pending_updates.pop(id(update), None)
+    STATES_ENTERED.inc(STATE_NAMES.get(state, str(state)))
+    startup.PROFILE.mark("first_update")
+    if context.dispatcher.persistence and update.effective_user:
+        # The dispatcher reported the user data to the persistence before the handler changed it
+        context.dispatcher.persistence.update_user_data(update.effective_user.id, context.user_data)
+    return state
+
+
+async def _run_delayed(delay, *args, **kwargs):
+    """Handler coroutine of the "asyncio" mode: waits for the typing delay on the event loop."""
+    await asyncio.sleep(delay)
+    return await _run_handler(*args, **kwargs)
+
+
+def _run_in_thread(*args, **kwargs):
+    """Runs a handler coroutine to completion on the calling thread ("scheduled" and "sleep" modes)."""
+    return aio.run(_run_handler(*args, **kwargs))
+
+
+def _finish(promise, update, context):
+    """Runs the promise of a conversation handler, then lets the conversation replay the updates
+    that arrived while the handler was running."""
+    promise.run()
+    context.bot_data["conversations"].finished(update)
 
 
 def typing(original_function=None, seconds=None):
     """Makes the bot look like its typing To be used as a decorator, e.g. "@typing" or "@typing(seconds=2)". 
 
+    The handlers are coroutines. In the default "asyncio" mode (`TYPING_MODE`) they are run on the
+    shared event loop after an `asyncio.sleep`, so a handler doesn't hold a thread while the bot is
+    typing or while its messages are sent. In the "scheduled" mode the handler is scheduled on the
+    JobQueue and run on the handler pool. In both modes the decorated function returns a `Promise`
+    right away, which the ConversationHandler resolves to the next state once the handler has run.
+    Updates of the conversation that arrive in the meantime are handled after it (see `replay` of
+    `IdleConversationHandler`).
+    The "sleep" mode keeps the old blocking behaviour.
+
     Parameters
     ----------
     seconds: int, optional
@@ -83,12 +425,31 @@ def typing(original_function=None, seconds=None):
 
         @wraps(function)
         def wrapped_function(update, context, *args, **kwargs):
-            context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=ChatAction.TYPING)
-            if seconds: 
-                sleep(seconds)
-            else: 
-                sleep(0.75)
-            return function(update, context,  *args, **kwargs)
+            global _pending_handlers
+            received = time.perf_counter()
+            with _busy_workers_lock:
+                _pending_handlers += 1
+                _pending_updates[id(update)] = (context.bot_data["persona"], update)
+            chat_id = update.effective_message.chat_id
+            if update.callback_query:
+                # Stops the loading animation of the pressed button right away
+                outbound.answer_callback_query(context.bot, chat_id, update.callback_query.id)
+            outbound.send_chat_action(context.bot, chat_id, ChatAction.TYPING)
+            delay = seconds or TYPING_SECONDS
+            if TYPING_MODE == "sleep":
+                sleep(delay)
+                return _run_in_thread(function, received, update, context,  *args, **kwargs)
+
+            if TYPING_MODE == "asyncio":
+                future = event_loop.submit(_run_delayed(delay, function, received, update, context, *args, **kwargs))
+                promise = Promise(future.result, (), {})
+                future.add_done_callback(lambda _: _finish(promise, update, context))
+                return promise
+
+            promise = Promise(_run_in_thread, (function, received, update, context) + args, kwargs)
+            context.job_queue.run_once(_run_delayed_handler, delay,
+                                       context=Promise(_finish, (promise, update, context), {}))
+            return promise
 
         return wrapped_function
 
@@ -98,266 +459,849 @@ def typing(original_function=None, seconds=None):
     return _decorate
 
 
+def pooled(function):
+    """Runs a handler outside of the conversations (e.g. the search) on the handler pool, so that slow
+    calls don't hold up the dispatcher thread and the updates queued behind it. To be used as a decorator."""
+
+    @wraps(function)
+    def wrapped_function(update, context, *args, **kwargs):
+        handler_pool.submit(_run_pooled, Promise(function, (update, context) + args, kwargs))
+
+    return wrapped_function
+
+
+def keyboard(context, name):
+    """Returns the prebuilt keyboard `name` in the variant of the bot's persona."""
+    return keyboards.get(name, context.bot_data["persona"])
+
+
+def text(context, name, **fields):
+    """Returns the text `name` from the catalog of the bot's persona."""
+    return catalog.TEXTS[context.bot_data["persona"]][name].format(api_prefix=API_PREFIX, **fields)
+
+
+def get_draft(context):
+    """Returns the draft of the user's submission, which is created on first use."""
+    draft = context.user_data.get("draft")
+    if not isinstance(draft, Draft):
+        # Drafts loaded by the persistence are dicts, user data of older versions has the fields at the top
+        data = draft or {field: context.user_data.pop(field) for field in Draft.__slots__ if field in context.user_data}
+        draft = context.user_data["draft"] = Draft.from_dict(data)
+    return draft
+
+
+def duplicate_index_text(content, file_unique_id=None):
+    """The text under which a submission is kept in the duplicate index: its content, for files the
+    file_unique_id of the file followed by the caption."""
+    if file_unique_id is None:
+        return content
+    return "{} {}".format(file_unique_id, content or "")
+
+
+def discard_draft(user_data):
+    """Removes the draft (and the file of its content) from the user data."""
+    draft = user_data.pop("draft", None)
+    if draft:
+        content_store.discard(draft if isinstance(draft, Draft) else Draft.from_dict(draft))
+
+
+async def send(context, chat_id, text, **kwargs):
+    """Sends a message through the outbound scheduler and waits until it has been delivered."""
+    return await asyncio.wrap_future(outbound.send_message(context.bot, chat_id, text, **kwargs))
+
+
+async def reply(update, context, text, **kwargs):
+    """Answers an update with a message. If the update is the answer to a menu with `edit_message`,
+    the menu's message is edited in place (text and keyboard) instead."""
+    query = update.callback_query
+    if query and getattr(context, "edit_message", False):
+        return await asyncio.wrap_future(outbound.edit_message_text(
+            context.bot, query.message.chat_id, query.message.message_id, text, **kwargs))
+    return await send(context, update.effective_chat.id, text, **kwargs)
+
+
 @typing
-def start(update, context):
+async def start(update, context):
         """Send message on `/start`."""
 
         # Get user that sent /start and log his name
         user = update.message.from_user
-        logger.info("User {} started a new conversation. Metadata: \n{}".format(user.username, update))
+        logger.info("User started a new conversation", extra=event("start", user=user.username))
 
         # Clear all previous user data
+        discard_draft(context.user_data)
         context.user_data.clear()
 
-        # Build InlineKeyboard where each button has a displayed text
-        # and a string as callback_data
-        # The keyboard is a list of button rows, where each row is in turn
-        # a list (hence `[[...]]`).
-        keyboard = [
-            [InlineKeyboardButton("ja", callback_data="ja"),
-            InlineKeyboardButton("nein", callback_data="nein")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        hello_text = """
-        Hi {}, hier ist Derrick - die tüchtige Assistenz des DetektivKollektivs. Danke, dass du dich an uns wendest! 🤩
-        \nBevor du einen Fall an unsere Detektiv*innen weiterleiten kannst, müsstest du erst unserer <a href='https://{}detective-collective.org/data-privacy'>Datenschutzerklärung</a> zustimmen.
-        """
-        update.message.reply_text(hello_text.format(user.first_name, API_PREFIX), parse_mode=ParseMode.HTML)
+        chat_id = update.message.chat_id
+        await send(context, chat_id, text(context, "hello", first_name=user.first_name), parse_mode=ParseMode.HTML)
         # Send message with text and appended InlineKeyboard
-        update.message.reply_text(
-            "Bist du mit der Datenschutzerklärung einverstanden?",
-            reply_markup=reply_markup
+        await send(
+            context, chat_id,
+            text(context, "gdpr_question"),
+            reply_markup=keyboard(context, "gdpr")
         )
         # Tell ConversationHandler that we're in state `FIRST` now
         return GDPR
 
 
 @typing
-def gdpr_accepted(update, context):
+async def gdpr_accepted(update, context):
     """Returns `ConversationHandler.END`, which tells the
     ConversationHandler that the conversation is over"""
-    query = update.callback_query
-    query.from_user.send_message("Super, dann kann's ja losgehen! Schicke mir bitte jetzt die Nachricht, die du überprüfen lassen möchtest.")
+    await reply(update, context, text(context, "gdpr_accepted"))
     return CONTENT
 
 
 @typing
-def gdpr_denied(update, context):
+async def gdpr_denied(update, context):
     """Returns `ConversationHandler.END`, which tells the
     ConversationHandler that the conversation is over"""
-    query = update.callback_query
-    query.from_user.send_message("Alles klar. Schau doch mal in unser Archiv auf https://{}detective-collective.org/archive, vielleicht ist Dein Fall ja schon dabei!".format(API_PREFIX))
+    await reply(update, context, text(context, "gdpr_denied"))
     return ConversationHandler.END
 
 
 @typing
-def ask_additional_info(update, context):
-
-    user = update.message.from_user
-    context.user_data["content"] = update.message.text
-    logger.info("User %s wants to submit new item: %s", user.username, context.user_data["content"])
-
-    keyboard = [
-            [InlineKeyboardButton("ja", callback_data="ja"),
-            InlineKeyboardButton("nein", callback_data="nein")]
-        ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-        
-    update.message.reply_text(
-        "Möchtest du uns noch ein paar zusätzliche Informationen zu deinem Fall geben?",
-        reply_markup=reply_markup
+async def ask_additional_info(update, context):
+
+    message = update.message
+    user = message.from_user
+    # Photos, videos etc. carry their text in the caption
+    content = message.text or message.caption
+    media = message_media(message)
+    logger.info("User wants to submit new item", extra=event("content", user=user.username, content=content,
+                                                             media=media[0] if media else None,
+                                                             forwarded=message.forward_date is not None))
+
+    # A file is only a duplicate of the same file (with the same caption), not of any item with its caption
+    file_unique_id = media[1].file_unique_id if media else None
+    duplicate_text = duplicate_index_text(content, file_unique_id)
+    duplicate = None
+    if duplicates is not None and duplicate_text:
+        duplicate = duplicates.find(duplicate_text, near=file_unique_id is None)
+    if duplicate:
+        DUPLICATES_FOUND.inc("exact" if duplicate.exact else "near")
+        logger.info("Item was already submitted", extra=event("duplicate", user=user.username, ref=duplicate.ref,
+                                                              exact=duplicate.exact))
+        if subscribers is not None:
+            subscribers.subscribe(duplicate.ref, message.chat_id, context.bot_data["persona"])
+        await reply(update, context, text(context, "duplicate"))
+        return ConversationHandler.END
+
+    draft = get_draft(context)
+    draft.media = None
+    if media:
+        try:
+            draft.media = await asyncio.wrap_future(media_uploader.upload(context.bot, *media))
+        except MediaTooLarge as e:
+            logger.info("Media not accepted: %s", e, extra=event("media_too_large", user=user.username))
+            await reply(update, context, text(context, "media_too_large", max_mb=MEDIA_MAX_BYTES // 2 ** 20))
+            return CONTENT
+        except MediaError as e:
+            logger.warning("Media not accepted: %s", e, extra=event("media_failed", user=user.username))
+            await reply(update, context, text(context, "media_failed"))
+            return CONTENT
+
+    if content:
+        content_store.set_content(draft, content)
+    else:
+        content_store.discard(draft)
+    draft.forward = forward_origin(message)
+    draft.file_unique_id = file_unique_id
+
+    await reply(
+        update, context,
+        text(context, "add_info_question"),
+        reply_markup=keyboard(context, "add_info")
     )
 
     return ADD_INFO
 
 
 @typing
-def ask_contact(update, context):
+async def ask_contact(update, context):
 
     query = update.callback_query
     user =  query.from_user
-    logger.info("User %s wants to provide contact.", user.username)
-
-    keyboard = [
-            [InlineKeyboardButton("Familie / enge Freunde", callback_data="family"),
-            InlineKeyboardButton("Bekannte", callback_data="acquaintance")],
-            [InlineKeyboardButton("Fremde", callback_data="stranger"),
-            InlineKeyboardButton("selbst online gefunden", callback_data="internet")],
-            [InlineKeyboardButton("überspringen ⏩", callback_data="skip")]
-        ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    user.send_message("Alles klar! Wer hat dir die Nachricht geschickt?",reply_markup=reply_markup)      
+    if sampled(LOG_SAMPLE_RATE):
+        logger.info("User wants to provide contact", extra=event("ask_contact", user=user.username))
+
+    await reply(update, context, text(context, "contact_question"), reply_markup=keyboard(context, "contact"))
 
     return CONTACT
 
 
 @typing
-def ask_frequency(update, context):
+async def ask_frequency(update, context):
 
     query = update.callback_query
     user =  query.from_user
-    context.user_data["contact"] = query.data
-    logger.info("User %s provided contact: %s", user.username, context.user_data["contact"])
-    logger.info("User %s wants to provide frequency.", user.username)
-
-    keyboard = [
-            [InlineKeyboardButton("1", callback_data="1"),
-            InlineKeyboardButton("2", callback_data="2"),
-            InlineKeyboardButton("3", callback_data="3")],
-            [InlineKeyboardButton("4", callback_data="4"),
-            InlineKeyboardButton("5", callback_data="5"),
-            InlineKeyboardButton("6+", callback_data="6+")],
-            [InlineKeyboardButton("⏪ zurück", callback_data="back"),
-            InlineKeyboardButton("überspringen ⏩", callback_data="skip")]
-        ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    user.send_message("Okay. Wie oft hat dich die Nachricht insgesamt erreicht?",reply_markup=reply_markup)        
+    if query.data != "back":
+        get_draft(context).contact = query.data
+    if sampled(LOG_SAMPLE_RATE):
+        logger.info("User wants to provide frequency", extra=event("ask_frequency", user=user.username,
+                                                                   contact=query.data))
+
+    await reply(update, context, text(context, "frequency_question"), reply_markup=keyboard(context, "frequency"))
 
     return FREQUENCY
 
 
 @typing
-def ask_channel(update, context):
+async def ask_channel(update, context):
 
     query = update.callback_query
     user =  query.from_user
-    context.user_data["frequency"] = query.data
-    logger.info("User %s provided frequency: %s", user.username, context.user_data["frequency"])
-    logger.info("User %s wants to provide channel.", user.username)
-
-    keyboard = [
-            [InlineKeyboardButton("Telegram", callback_data="Telegram"),
-            InlineKeyboardButton("WhatsApp", callback_data="WhatsApp")],
-            [InlineKeyboardButton("Facebook", callback_data="Facebook"),
-            InlineKeyboardButton("Instagram", callback_data="Instagram")],
-            [InlineKeyboardButton("Twitter", callback_data="Twitter"),
-            InlineKeyboardButton("YouTube", callback_data="YouTube")],
-            [InlineKeyboardButton("anderer Messenger 📱", callback_data="messenger")],
-            [InlineKeyboardButton("anderes soziales Netzwerk 📢", callback_data="social_network")],
-            [InlineKeyboardButton("Internet allgemein (z.B. Nachrichtenseite) 💻", callback_data="internet")],
-            [InlineKeyboardButton("mündlich im Gespräch 💬", callback_data="in_person")],
-            [InlineKeyboardButton("⏪ zurück", callback_data="back"),
-            InlineKeyboardButton("überspringen ⏩", callback_data="skip")]
-        ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    user.send_message("Okay. Auf welchem Weg hat dich die Nachricht erreicht?",reply_markup=reply_markup)        
+    if query.data != "back":
+        get_draft(context).frequency = query.data
+    if sampled(LOG_SAMPLE_RATE):
+        logger.info("User wants to provide channel", extra=event("ask_channel", user=user.username,
+                                                                 frequency=query.data))
+
+    await reply(update, context, text(context, "channel_question"), reply_markup=keyboard(context, "channel"))
 
     return CHANNEL
 
 
 @typing
-def confirm_submit_item(update, context):
+async def confirm_submit_item(update, context):
     query = update.callback_query
     user =  query.from_user
-    context.user_data["channel"] = query.data
-    logger.info("User %s provided channel: %s", user.username, context.user_data["channel"])
+    get_draft(context).channel = query.data
+    if sampled(LOG_SAMPLE_RATE):
+        logger.info("User provided channel", extra=event("channel", user=user.username, channel=query.data))
 
-    keyboard = [
-        [InlineKeyboardButton("⏪ zurück", callback_data="back"),
-        InlineKeyboardButton("Ja! ✔️", callback_data="submit")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    user.send_message("Fertig! Möchtest du den Fall jetzt einreichen?",reply_markup=reply_markup)        
+    await reply(update, context, text(context, "submit_question"), reply_markup=keyboard(context, "submit"))
 
     return SUBMIT
 
 
+def log_submission_result(key, submission, r):
+    """Logs the response of an item submission, called by the submission queue."""
+    logger.info("Item submission %s sent. Response code: %s", key, r.status_code,
+                extra=event("submission_sent", key=key, status=r.status_code,
+                            new_item_created=r.headers.get("new-item-created"), body=lambda: r.text))
+    if subscribers is not None and r.status_code < 400:
+        try:
+            item_id = r.json().get("id")
+        except ValueError:
+            item_id = None
+        if item_id is not None:
+            subscribers.resolve(key, item_id)
+
+
+def case_url(case):
+    """Link to the result of a case (the archive if the item API didn't send one)."""
+    return case.get("url") or "https://{}detective-collective.org/archive".format(API_PREFIX)
+
+
+def notify_subscriber(persona, chat_id, case):
+    """Queues the notification about a resolved case, called by the case notifier."""
+    if persona not in _bots:
+        raise ValueError("Unknown persona {!r}".format(persona))
+    message = catalog.TEXTS[persona]["case_resolved"].format(api_prefix=API_PREFIX, url=case_url(case))
+    return outbound.send_message(_bots[persona], chat_id, message, priority=PRIORITY_NOTIFICATION)
+
+
+def continues_conversation(conversation, update):
+    """Returns True for the updates that continue a running conversation: answers to the menus
+    and messages that aren't commands."""
+    message = update.message
+    if update.callback_query is None and (message is None or (message.text or "").startswith("/")):
+        return False
+    return conversation.in_conversation(update)
+
+
+def tell_limited(update, context):
+    """Asks a user that was rate limited by the admission control to slow down."""
+    outbound.send_message(context.bot, update.effective_chat.id, text(context, "rate_limited"),
+                          priority=PRIORITY_NOTIFICATION)
+
+
+@pooled
+def search_inline(update, context):
+    """Answers an inline query with the best matching closed cases. The last word of the query is
+    matched as the start of a word, since the query is sent while the user is typing."""
+    query = update.inline_query
+    results = []
+    for case in search_index.search(query.query, limit=10, prefix=True):
+        url = case_url(case)
+        title = case.get("title") or url
+        results.append(InlineQueryResultArticle(
+            id=str(case["id"]), title=title, description=case.get("result") or case.get("content"), url=url,
+            input_message_content=InputTextMessageContent(text(context, "search_result", title=title, url=url))))
+    outbound.answer_inline_query(context.bot, query.from_user.id, query.id, results, cache_time=300)
+
+
+@pooled
+def search_command(update, context):
+    """Answers `/search <words>` with the best matching closed cases."""
+    chat_id = update.effective_chat.id
+    query = " ".join(context.args or ())
+    if not query:
+        outbound.send_message(context.bot, chat_id, text(context, "search_usage"))
+        return
+    cases = search_index.search(query, limit=5)
+    logger.info("User searched the archive", extra=event("search", user=update.effective_user.username,
+                                                          query=query, results=len(cases)))
+    if not cases:
+        outbound.send_message(context.bot, chat_id, text(context, "search_empty", query=query))
+        return
+    results = "\n\n".join(text(context, "search_result", title=case.get("title") or case_url(case), url=case_url(case))
+                           for case in cases)
+    outbound.send_message(context.bot, chat_id, text(context, "search_results", results=results),
+                          disable_web_page_preview=True)
+
+
 @typing
-def submit_item(update, context):
+async def submit_item(update, context):
     query = update.callback_query
     user =  query.from_user
-    logger.info("User %s wants to submit item.", user.username)
-
-    # Prepare new item submission
-    new_submission = context.user_data
-    print(new_submission)
-    to_remove = []
-    for key in new_submission:
-        if new_submission[key] == "skip":
-            to_remove.append(key)
-    for key in to_remove:
-        new_submission.pop(key)
-    # TODO: set telegram_id (requires model to be changed)
-    # new_submission["telegram_id"] = user.id
-    print(new_submission)
-
-    # Call API endpoint /item_submission
-    api_url = "https://api.{}detective-collective.org/item_submission".format(API_PREFIX)
-    r = requests.post(api_url, data = json.dumps(new_submission))
-    
-    logger.info("New item submitted by user {}. Response code: {}. New item created: {}. Body: {}".format(user.username, r.status_code, r.headers["new-item-created"], r.text))
-
-    query.from_user.send_message("Vielen Dank, dein Fall wurde nun eingereicht! Wir melden uns bei dir, sobald unsere Detektiv*innen Deinen Fall gelöst haben.")
+    logger.info("User wants to submit item", extra=event("submit", user=user.username))
+
+    # Prepare new item submission (without skipped answers) and drop the draft
+    draft = get_draft(context)
+    new_submission = draft.submission(content_store)
+    duplicate_text = duplicate_index_text(new_submission.get("content"), draft.file_unique_id)
+    discard_draft(context.user_data)
+
+    # Queue the submission for API endpoint /item_submission, it is sent in the background. The chat is
+    # kept by the bot (not sent with the item) to notify the user when the case is resolved.
+    key = submission_queue.put(new_submission)
+    logger.info("Item submission %s queued", key, extra=event("submission_queued", user=user.username, key=key))
+    if subscribers is not None:
+        subscribers.subscribe(key, query.message.chat_id, context.bot_data["persona"])
+    if duplicates is not None and duplicate_text:
+        duplicates.add(duplicate_text, key, near=draft.file_unique_id is None)
+
+    await reply(update, context, text(context, "submitted"))
     return ConversationHandler.END
 
 
-def main():
-    """Start the bot."""
-    # Create the Updater and pass it your bot's token.
-    # Make sure to set use_context=True to use the new context based callbacks
-    # Post version 12 this will no longer be necessary
-    updater = Updater(get_telegram_token(), use_context=True)
+# Messages accepted as the item to check: texts (also forwarded ones) and files with an optional caption
+CONTENT_FILTER = (Filters.text | Filters.photo | Filters.video | Filters.animation | Filters.voice | Filters.audio
+                  | Filters.video_note | Filters.document)
+
+# Keyboards of the conversation steps. Each menu is named after the state its answers are handled in
+# and also provides the callback routes of that state. The answers to menus with `edit_message` replace
+# the menu's message (so "back" shows the previous question in the same message); the privacy question
+# stays in the chat history.
+GDPR_MENU = Menu([
+    [Option("ja", "ja", gdpr_accepted), Option("nein", "nein", gdpr_denied)]
+])
+ADD_INFO_MENU = Menu([
+    [Option("ja", "ja", ask_contact), Option("nein", "nein", submit_item)]
+], edit_message=True)
+CONTACT_MENU = Menu([
+    [Option("Familie / enge Freunde", "family", ask_frequency), Option("Bekannte", "acquaintance", ask_frequency)],
+    [Option("Fremde", "stranger", ask_frequency), Option("selbst online gefunden", "internet", ask_frequency)],
+    [Option("überspringen ⏩", "skip", ask_frequency)]
+], edit_message=True)
+FREQUENCY_MENU = Menu([
+    [Option("1", "1", ask_channel), Option("2", "2", ask_channel), Option("3", "3", ask_channel)],
+    [Option("4", "4", ask_channel), Option("5", "5", ask_channel), Option("6+", "6+", ask_channel)],
+    [Option("⏪ zurück", "back", ask_contact), Option("überspringen ⏩", "skip", ask_channel)]
+], edit_message=True)
+CHANNEL_MENU = Menu([
+    [Option("Telegram", "Telegram", confirm_submit_item), Option("WhatsApp", "WhatsApp", confirm_submit_item)],
+    [Option("Facebook", "Facebook", confirm_submit_item), Option("Instagram", "Instagram", confirm_submit_item)],
+    [Option("Twitter", "Twitter", confirm_submit_item), Option("YouTube", "YouTube", confirm_submit_item)],
+    [Option("anderer Messenger 📱", "messenger", confirm_submit_item)],
+    [Option("anderes soziales Netzwerk 📢", "social_network", confirm_submit_item)],
+    [Option("Internet allgemein (z.B. Nachrichtenseite) 💻", "internet", confirm_submit_item)],
+    [Option("mündlich im Gespräch 💬", "in_person", confirm_submit_item)],
+    [Option("⏪ zurück", "back", ask_frequency), Option("überspringen ⏩", "skip", confirm_submit_item)]
+], edit_message=True)
+SUBMIT_MENU = Menu([
+    [Option("⏪ zurück", "back", ask_channel), Option("Ja! ✔️", "submit", submit_item)]
+], edit_message=True)
+
+keyboards = KeyboardRegistry()
+keyboards.add_menu("gdpr", GDPR_MENU)
+keyboards.add_menu("add_info", ADD_INFO_MENU)
+keyboards.add_menu("contact", CONTACT_MENU)
+keyboards.add_menu("frequency", FREQUENCY_MENU)
+keyboards.add_menu("channel", CHANNEL_MENU)
+keyboards.add_menu("submit", SUBMIT_MENU)
+for persona, labels in catalog.LABELS.items():
+    keyboards.add_variant(persona, labels)
+
+
+submission_queue = SubmissionQueue(SUBMISSION_QUEUE_PATH, submission_client, on_result=log_submission_result,
+                                   batch_endpoint=SUBMISSION_BATCH_ENDPOINT, batch_size=SUBMISSION_BATCH_SIZE,
+                                   batch_window=SUBMISSION_BATCH_WINDOW)
+notifier = CaseNotifier(subscribers, NOTIFICATION_POLL_URL, notify_subscriber, poll_interval=NOTIFICATION_POLL_INTERVAL,
+                        batch_size=NOTIFICATION_BATCH_SIZE) if subscribers is not None else None
+
+
+def get_persistence(persona):
+    """Creates the persistence backend configured by `PERSISTENCE` for a persona, or returns None."""
+    if PERSISTENCE == "sqlite":
+        path = PERSISTENCE_PATH
+        if persona != catalog.DEFAULT_PERSONA:
+            root, ext = os.path.splitext(PERSISTENCE_PATH)
+            path = "{}_{}{}".format(root, persona, ext)
+        return SQLitePersistence(path, flush_interval=PERSISTENCE_FLUSH_INTERVAL)
+    if PERSISTENCE == "redis":
+        return RedisPersistence(REDIS_URL, prefix="telegram_bot:{}".format(persona),
+                                flush_interval=PERSISTENCE_FLUSH_INTERVAL)
+    return None
+
+
+def create_bot(persona, request):
+    """Creates the Bot of a persona, using the connection pool `request`."""
+    return Bot(get_persona_token(persona), base_url="{}/bot".format(BOT_API_URL),
+               base_file_url="{}/file/bot".format(BOT_API_URL), request=request)
+
+
+def create_updater(persona, request):
+    """Creates the Updater of a persona with the conversation handler registered.
+
+    Parameters
+    ----------
+    persona: string
+        Name of the persona's text catalog (see catalog.py)
+    request: telegram.utils.request.Request
+        Connection pool to the Bot API, shared by all personas
+    """
+    persistence = get_persistence(persona)
+    bot = create_bot(persona, request)
+    # The handlers run on the shared `handler_pool`, so the dispatcher doesn't need its own workers
+    updater = Updater(bot=bot, workers=0, use_context=True, persistence=persistence)
 
     # Get the dispatcher to register handlers
-    # TODO: replace dev with env variable
     dp = updater.dispatcher
+    dp.bot_data["persona"] = persona
 
-    # Setup conversation handler with the states FIRST and SECOND
-    # Use the pattern parameter to pass CallbackQueries with specific
-    # data pattern to the corresponding handlers.
-    # ^ means "start of line/string"
-    # $ means "end of line/string"
-    # So ^ABC$ will only allow 'ABC'
-    conv_handler = ConversationHandler(
+    # Setup conversation handler with the states GDPR ... SUBMIT
+    # The answers to the inline keyboards are routed by a single handler per state,
+    # which looks up the callback_data in the routes of the state's menu.
+    conv_handler = IdleConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            GDPR: [CallbackQueryHandler(gdpr_accepted, pattern='^ja$'),
-                    CallbackQueryHandler(gdpr_denied, pattern='^nein$')],
-            CONTENT: [MessageHandler(Filters.text, ask_additional_info)],
-            ADD_INFO: [CallbackQueryHandler(ask_contact, pattern='^ja$'),
-                    CallbackQueryHandler(submit_item, pattern='^nein$')],
-            CONTACT: [CallbackQueryHandler(ask_frequency, pattern='^family$'),
-                    CallbackQueryHandler(ask_frequency, pattern='^acquaintance$'),
-                    CallbackQueryHandler(ask_frequency, pattern='^stranger$'),
-                    CallbackQueryHandler(ask_frequency, pattern='^internet$'),
-                    CallbackQueryHandler(ask_frequency, pattern='^skip$')],
-            FREQUENCY: [CallbackQueryHandler(ask_contact, pattern='^back$'),
-                    CallbackQueryHandler(ask_channel, pattern='^1$'),
-                    CallbackQueryHandler(ask_channel, pattern='^2$'),
-                    CallbackQueryHandler(ask_channel, pattern='^3$'),
-                    CallbackQueryHandler(ask_channel, pattern='^4$'),
-                    CallbackQueryHandler(ask_channel, pattern='^5$'),
-                    CallbackQueryHandler(ask_channel, pattern='^6\+$'),
-                    CallbackQueryHandler(ask_channel, pattern='^skip$')],
-            CHANNEL: [CallbackQueryHandler(ask_frequency, pattern='^back$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^Telegram$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^WhatsApp$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^Facebook$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^Instagram$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^Twitter$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^YouTube$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^messenger$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^social_network$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^internet$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^in_person$'),
-                    CallbackQueryHandler(confirm_submit_item, pattern='^skip$')],
-            SUBMIT: [CallbackQueryHandler(ask_channel, pattern='^back$'),
-                    CallbackQueryHandler(submit_item, pattern='^submit$')],
+            GDPR: [GDPR_MENU.handler()],
+            CONTENT: [MessageHandler(CONTENT_FILTER, ask_additional_info)],
+            ADD_INFO: [ADD_INFO_MENU.handler()],
+            CONTACT: [CONTACT_MENU.handler()],
+            FREQUENCY: [FREQUENCY_MENU.handler()],
+            CHANNEL: [CHANNEL_MENU.handler()],
+            SUBMIT: [SUBMIT_MENU.handler()],
         },
-        fallbacks=[CommandHandler('start', start)]
+        fallbacks=[CommandHandler('start', start)],
+        name="submission",
+        persistent=persistence is not None,
+        idle_timeout=CONVERSATION_IDLE_TIMEOUT,
+        on_idle=lambda key: drop_idle_user(dp, key),
+        # Updates that arrive while the handler of their conversation is running are dispatched after it
+        replay=lambda update: admission.requeue(update, dp)
     )
 
+    # Updates that the admission control rejects don't reach the handlers of the later groups
+    admission = AdmissionControl(
+        user_limiter, chat_limiter, start_limiter, blocklist,
+        depth=lambda: updater.update_queue.qsize() + _pending_handlers,
+        priority=lambda update: continues_conversation(conv_handler, update),
+        delay_depth=ADMISSION_DELAY_DEPTH, shed_depth=ADMISSION_SHED_DEPTH, delay=ADMISSION_DELAY,
+        on_limited=tell_limited, inline_limiter=inline_limiter)
+    dp.add_handler(admission.handler(), group=-1)
+    dp.bot_data["admission"] = admission
+
+    # /search is answered in every state of the conversation (it would be taken as the message to check
+    # otherwise), so it comes before the ConversationHandler
+    dp.add_handler(CommandHandler("search", search_command))
+
     # Add ConversationHandler to dispatcher that will be used for handling
     # updates
     dp.add_handler(conv_handler)
+    dp.add_handler(InlineQueryHandler(search_inline))
+    dp.bot_data["conversations"] = conv_handler
+
+    if persistence:
+        persistence.start()
+
+    # Check for a rotated token whenever the cached secret expires
+    updater.job_queue.run_repeating(refresh_token, SECRET_TTL, first=SECRET_TTL)
+    updater.job_queue.run_repeating(sweep_conversations, CONVERSATION_SWEEP_INTERVAL,
+                                    first=CONVERSATION_SWEEP_INTERVAL, context=conv_handler)
+
+    return updater
+
+
+def create_ingress_updater(persona, request, pool):
+    """Creates the Updater of a persona in the ingress process, which hands the updates to the
+    worker processes of `pool` instead of handling them."""
+    job_queue = JobQueue()
+    dispatcher = ShardRouter(create_bot(persona, request), Queue(), pool.route, job_queue=job_queue)
+    job_queue.set_dispatcher(dispatcher)
+    dispatcher.bot_data["persona"] = persona
+    updater = Updater(dispatcher=dispatcher, workers=None, use_context=True)
+    updater.job_queue.run_repeating(refresh_token, SECRET_TTL, first=SECRET_TTL)
+    return updater
+
+
+def start_services(updaters):
+    """Registers the gauges of the updaters and starts the metrics endpoint and the background
+    services that handle the conversations (event loop, outbound scheduler, submission queue,
+    case notifications)."""
+    _bots.update((u.dispatcher.bot_data["persona"], u.bot) for u in updaters)
+    Gauge("bot_update_queue_depth", "Updates waiting for the dispatcher", ("persona",),
+          lambda: {(u.dispatcher.bot_data["persona"],): u.update_queue.qsize() for u in updaters})
+    Gauge("bot_open_conversations", "Conversations that haven't ended (or been ended as idle)", ("persona",),
+          lambda: {(u.dispatcher.bot_data["persona"],): len(u.dispatcher.bot_data["conversations"].conversations)
+                   for u in updaters})
+    Gauge("bot_handler_pool_workers", "Threads of the handler pool", (),
+          lambda: {(): HANDLER_WORKERS})
+    Gauge("bot_handler_pool_busy_workers", "Threads of the handler pool that are running a handler", (),
+          lambda: {(): _busy_workers})
+    Gauge("bot_handler_pool_queued", "Handlers waiting for a thread of the handler pool", (),
+          lambda: {(): handler_pool._work_queue.qsize()})
+    Gauge("bot_pending_handlers", "Handlers that have been started and haven't finished (typing delay included)", (),
+          lambda: {(): _pending_handlers})
+    if TYPING_MODE == "asyncio":
+        event_loop.start()
+
+    Gauge("bot_outbound_queue_length", "Outgoing messages and chat actions waiting to be sent", (),
+          lambda: {(): len(outbound)})
+    Gauge("bot_duplicate_index_items", "Texts in the index of recent submissions", (),
+          lambda: {(): len(duplicates) if duplicates is not None else 0})
+    Gauge("bot_submission_queue_length", "Item submissions waiting to be sent", (),
+          lambda: {(): len(submission_queue)})
+    Gauge("bot_case_subscribers", "Chats waiting for the notification about their case", (),
+          lambda: {(): len(subscribers) if subscribers is not None else 0})
+    Gauge("bot_search_index_cases", "Closed cases in the search index", (),
+          lambda: {(): len(search_index)})
+    Gauge("bot_startup_seconds", "Seconds from the start of the process until a phase of the startup", ("phase",),
+          lambda: {(phase,): seconds for phase, seconds in startup.PROFILE.phases.items()})
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT, handler=HealthHandler)
+
+    HEALTH.add_check("dispatcher", lambda: all(u.dispatcher.running for u in updaters if u.running))
+    if TYPING_MODE == "asyncio":
+        HEALTH.add_check("event_loop", event_loop.responsive)
+    outbound.start()
+    submission_client.start_keep_warm()
+    submission_queue.start()
+    if notifier is not None:
+        notifier.start()
+    search_index.open()
+    search_index.start()
+    startup.PROFILE.mark("services")
+
+
+def start_receiving(updaters):
+    """Starts receiving the updates of every updater, by polling or with a webhook (UPDATE_MODE)."""
+    for i, updater in enumerate(updaters):
+        if UPDATE_MODE == "webhook":
+            if not WEBHOOK_URL or not WEBHOOK_PATH:
+                raise ValueError("WEBHOOK_URL and WEBHOOK_PATH must be set when UPDATE_MODE is 'webhook'")
+            # The webhook server answers every update with 200 right away and puts it on the
+            # dispatcher's update queue. TLS is terminated by the load balancer in front of it, in which
+            # case the Updater doesn't register the webhook itself. Every persona listens on its own
+            # port (WEBHOOK_PORT, WEBHOOK_PORT + 1, ...).
+            persona = updater.dispatcher.bot_data["persona"]
+            url_path = "{}/{}".format(WEBHOOK_PATH, persona)
+            updater.start_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT + i, url_path=url_path)
+            _webhook_urls[persona] = "{}/{}".format(WEBHOOK_URL.rstrip("/"), url_path)
+            updater.bot.set_webhook(_webhook_urls[persona], max_connections=WEBHOOK_MAX_CONNECTIONS)
+        else:
+            updater.start_polling()
+    updaters[0].job_queue.run_repeating(pick_up_handoff, HANDOFF_INTERVAL, first=0, context=updaters)
+    HEALTH.add_check("receiving", lambda: all(u.running for u in updaters))
+    HEALTH.ready = True
+    startup.PROFILE.mark("receiving")
+
+
+def wait_for_stop_signal():
+    """Blocks until the process gets SIGINT, SIGTERM or SIGABRT."""
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    # A timeout keeps the main thread responsive to the signals
+    while not stop.wait(1):
+        pass
+
+
+def wait_until(condition, deadline):
+    """Waits until `condition()` is true or the deadline (time.monotonic) has passed, and returns
+    whether the condition is true."""
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        sleep(0.05)
+    return True
+
+
+def stop_receiving(updaters):
+    """Stops receiving updates and reports the process as not ready. Updates of a poll that is still
+    running aren't queued (they are fetched again by the next instance), the webhook server is shut
+    down (Telegram retries the updates it couldn't deliver)."""
+    HEALTH.stopping = True
+    for updater in updaters:
+        updater.running = False
+        if updater.httpd:
+            updater.httpd.shutdown()
+            updater.httpd = None
+
+
+def take_queued_updates(updater):
+    """Removes the updates that haven't been dispatched yet from the update queue of an updater."""
+    updates = []
+    while True:
+        try:
+            item = updater.update_queue.get_nowait()
+        except Empty:
+            return updates
+        if isinstance(item, Update):
+            updates.append(item)
+
+
+def hand_off(updater, updates):
+    """Writes the updates that weren't handled to a file in HANDOFF_DIR, from where the next instance
+    picks them up (see `pick_up_handoff`). Telegram doesn't send them again: webhook updates have been
+    answered and polled updates are confirmed by the next poll."""
+    if not updates:
+        return
+    persona = updater.dispatcher.bot_data["persona"]
+    os.makedirs(HANDOFF_DIR, exist_ok=True)
+    path = os.path.join(HANDOFF_DIR, "{}-{}-{}.jsonl".format(persona, os.getpid(), int(time.time() * 1000)))
+    # Written under a temporary name, so that no instance picks up a partial file
+    with open(path + ".tmp", "w") as f:
+        for update in updates:
+            f.write(json.dumps({"persona": persona, "update": update.to_dict()}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    logger.info("Handed off %s update(s) of %s to %s", len(updates), persona, path)
+
+
+def pick_up_handoff(context):
+    """Job that queues the updates other instances handed off in HANDOFF_DIR (see `hand_off`). Every
+    file is claimed by renaming it, so that only one instance handles its updates."""
+    if HEALTH.stopping or not os.path.isdir(HANDOFF_DIR):
+        return
+    updaters = {u.dispatcher.bot_data["persona"]: u for u in context.job.context}
+    for name in sorted(os.listdir(HANDOFF_DIR)):
+        if not name.endswith(".jsonl"):
+            continue
+        path = os.path.join(HANDOFF_DIR, name)
+        claimed = "{}.{}.claimed".format(path, os.getpid())
+        try:
+            os.replace(path, claimed)
+        except FileNotFoundError:
+            continue
+        count = 0
+        with open(claimed) as f:
+            for line in f:
+                entry = json.loads(line)
+                updater = updaters.get(entry["persona"])
+                if updater is None:
+                    logger.warning("Dropping a handed off update of the unknown persona %s", entry["persona"])
+                    continue
+                updater.update_queue.put(Update.de_json(entry["update"], updater.bot))
+                count += 1
+        os.remove(claimed)
+        logger.info("Picked up %s handed off update(s) from %s", count, name)
+
+
+def log_undelivered_submissions():
+    undelivered = len(submission_queue)
+    if undelivered:
+        logger.warning("%s item submission(s) weren't delivered, they stay queued in %s until the next start",
+                       undelivered, SUBMISSION_QUEUE_PATH)
+
+
+def drain(updaters, timeout):
+    """Stops receiving, waits up to `timeout` seconds until the received updates have been handled
+    and their item submissions and messages sent, and hands off the updates that weren't handled. Returns the deadline
+    (time.monotonic) for stopping the remaining services."""
+    deadline = time.monotonic() + timeout
+    stop_receiving(updaters)
+    submission_queue.flush()
+
+    def idle():
+        return (all(u.update_queue.empty() and not u.dispatcher.bot_data["admission"].delayed for u in updaters)
+                and not _pending_handlers and not len(submission_queue) and not len(outbound))
+
+    if not wait_until(idle, deadline):
+        logger.warning("Handlers, item submissions or messages were still pending after %ss", timeout)
+    log_undelivered_submissions()
+    # The handlers that are still running on the loop are dropped, their updates are handed off (as are the
+    # delayed ones); the messages they have queued are still sent
+    event_loop.stop(timeout=1)
+    with _busy_workers_lock:
+        running = list(_pending_updates.values())
+    for updater in updaters:
+        persona = updater.dispatcher.bot_data["persona"]
+        # The dispatcher only stops once its queue is empty
+        unhandled = take_queued_updates(updater)
+        updater.job_queue.stop()
+        updater.dispatcher.stop()
+        unhandled += updater.dispatcher.bot_data["conversations"].take_waiting()
+        unhandled += updater.dispatcher.bot_data["admission"].take_delayed()
+        unhandled += [update for update_persona, update in running if update_persona == persona]
+        # A delayed or replayed update may also be queued already
+        unhandled = {update.update_id: update for update in unhandled}
+        hand_off(updater, [unhandled[update_id] for update_id in sorted(unhandled)])
+    return deadline
+
+
+def run_worker(index, inbox, acks):
+    """Entry point of a worker process (WORKERS > 0): handles the updates that the ingress process
+    routes to it, until the ingress process stops it or it gets SIGTERM."""
+    stopped = threading.Event()
+    # Ctrl-C reaches all processes, the ingress process stops the workers after it stopped receiving
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+    keyboards.build()
+    request = InstrumentedRequest(con_pool_size=OUTBOUND_SENDERS + 4 * len(BOT_PERSONAS))
+    updaters = [create_updater(persona, request) for persona in BOT_PERSONAS]
+    start_services(updaters)
+    for updater in updaters:
+        updater.job_queue.start()
+    HEALTH.ready = True
+    logger.info("Worker %s of %s started", index, WORKERS)
+
+    dispatchers = {u.dispatcher.bot_data["persona"]: u.dispatcher for u in updaters}
+    # The worker doesn't run the dispatcher threads, so the delayed updates are dispatched again (and only
+    # then acknowledged) by `serve`, as (sequence, persona, update as JSON)
+    readmitted = Queue()
+    sequences = {}
+
+    def readmit(update, dispatcher):
+        persona = dispatcher.bot_data["persona"]
+        readmitted.put((sequences.pop((persona, update.update_id)), persona, update.to_json()))
+
+    for dispatcher in dispatchers.values():
+        dispatcher.bot_data["admission"].readmit = readmit
+
+    def handle(sequence, persona, data):
+        dispatcher = dispatchers[persona]
+        update = Update.de_json(json.loads(data), dispatcher.bot)
+        # Known before the update is dispatched, as the delay may be due right away
+        sequences[persona, update.update_id] = sequence
+        dispatcher.process_update(update)
+        # Waiting for the handler of its conversation or delayed (in this order, as a waiting update
+        # is delayed when it's replayed)
+        if (dispatcher.bot_data["conversations"].is_waiting(update)
+                or dispatcher.bot_data["admission"].is_delayed(update)):
+            return DEFERRED
+        sequences.pop((persona, update.update_id), None)
+        return dispatcher.bot_data["conversations"].running_promise(update)
+
+    def checkpoint():
+        for dispatcher in dispatchers.values():
+            dispatcher.bot_data["conversations"].resolve_promises()
+            if dispatcher.persistence:
+                dispatcher.persistence.flush()
+
+    serve(index, inbox, acks, handle, stopped, checkpoint, readmitted=readmitted)
+    HEALTH.stopping = True
+    submission_queue.flush()
+    wait_until(lambda: not len(submission_queue), time.monotonic() + DRAIN_TIMEOUT)
+    log_undelivered_submissions()
+
+    for updater in updaters:
+        updater.job_queue.stop()
+    # The delayed updates and the ones waiting for their conversation haven't been acknowledged, so the
+    # ingress process hands them off
+    delayed = sum(len(u.dispatcher.bot_data["admission"].take_delayed())
+                  + len(u.dispatcher.bot_data["conversations"].take_waiting()) for u in updaters)
+    if delayed:
+        logger.info("Leaving %s delayed or waiting update(s) to the ingress process", delayed)
+    if notifier is not None:
+        notifier.stop(timeout=10)
+    search_index.stop(timeout=10)
+    submission_queue.stop(timeout=10)
+    outbound.stop(timeout=10)
+    event_loop.stop(timeout=10)
+    for updater in updaters:
+        # Keep the states of the handlers that have finished by now
+        updater.dispatcher.bot_data["conversations"].sweep()
+        if updater.persistence:
+            updater.dispatcher.update_persistence()
+            updater.persistence.flush()
+    request.stop()
+    logger.info("Worker %s stopped", index)
+
+
+def run_ingress():
+    """Receives the updates of all personas and routes them to the WORKERS worker processes."""
+    pool = WorkerPool(run_worker, WORKERS, env=lambda index: {"WORKER_INDEX": str(index)})
+    request = InstrumentedRequest(con_pool_size=4 * len(BOT_PERSONAS))
+    updaters = [create_ingress_updater(persona, request, pool) for persona in BOT_PERSONAS]
+
+    Gauge("bot_update_queue_depth", "Updates waiting to be routed to the workers", ("persona",),
+          lambda: {(u.dispatcher.bot_data["persona"],): u.update_queue.qsize() for u in updaters})
+    Gauge("bot_routed_updates_pending", "Routed updates that the workers haven't acknowledged yet", (),
+          lambda: {(): len(pool)})
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT, handler=HealthHandler)
+
+    pool.start()
+    start_receiving(updaters)
+    wait_for_stop_signal()
+
+    # Stop receiving first (the updates received so far are still routed), then the workers, which finish
+    # the updates routed to them. The updates they didn't acknowledge are handed off.
+    logger.info("Stopping, draining for up to %ss", DRAIN_TIMEOUT)
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    stop_receiving(updaters)
+    wait_until(lambda: all(u.update_queue.empty() for u in updaters), deadline)
+    unhandled = {u.dispatcher.bot_data["persona"]: take_queued_updates(u) for u in updaters}
+    for updater in updaters:
+        updater.job_queue.stop()
+        updater.dispatcher.stop()
+    pool.stop(timeout=max(1, deadline - time.monotonic()))
+    for persona, data in pool.pending_updates():
+        if persona in unhandled:
+            updater = updaters[BOT_PERSONAS.index(persona)]
+            unhandled[persona].append(Update.de_json(json.loads(data), updater.bot))
+    for updater in updaters:
+        hand_off(updater, unhandled[updater.dispatcher.bot_data["persona"]])
+    request.stop()
 
-    # Start the Bot
-    updater.start_polling()
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+def main():
+    """Start the bots of all personas in BOT_PERSONAS."""
+    if WORKERS:
+        return run_ingress()
+
+    # Build and serialize all inline keyboards once
+    keyboards.build()
+
+    # One connection pool to the Bot API for all bots: a connection per outbound sender thread
+    # plus a few for the dispatcher, polling and job queue threads of every bot
+    request = InstrumentedRequest(con_pool_size=OUTBOUND_SENDERS + 4 * len(BOT_PERSONAS))
+    updaters = [create_updater(persona, request) for persona in BOT_PERSONAS]
+
+    start_services(updaters)
+
+    # Start the Bots
+    start_receiving(updaters)
+
+    # Run the bots until you press Ctrl-C or the process receives SIGINT,
+    # SIGTERM or SIGABRT, then drain them
+    wait_for_stop_signal()
+    logger.info("Stopping, draining for up to %ss", DRAIN_TIMEOUT)
+    deadline = drain(updaters, DRAIN_TIMEOUT)
+
+    def remaining():
+        return max(1, deadline - time.monotonic())
+
+    if notifier is not None:
+        notifier.stop(timeout=remaining())
+    search_index.stop(timeout=remaining())
+    submission_queue.stop(timeout=remaining())
+    outbound.stop(timeout=remaining())
+    event_loop.stop(timeout=remaining())
+    for updater in updaters:
+        # Keep the states of the handlers that have finished by now
+        updater.dispatcher.bot_data["conversations"].sweep()
+        if updater.persistence:
+            updater.dispatcher.update_persistence()
+            updater.persistence.flush()
+    request.stop()
+    logger.info("Stopped")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()